@@ -0,0 +1,455 @@
+# bench_embedding.py
+"""
+Benchmarks de l'API d'embeddings.
+
+Mode "health" : sature le serveur avec des requêtes /embed/batch depuis
+plusieurs threads et mesure en parallèle la latence du health check (GET /).
+Lancer le même mode avant et après un changement pour comparer :
+
+    python bench_embedding.py health --url http://127.0.0.1:10000 --duration 20
+
+Mode "load" : pilote /embed avec N clients concurrents et une distribution
+de longueurs de texte, contre une URL ou une instance lancée dans le
+processus (--in-process, mêmes variables d'environnement que le serveur).
+Débit et latences p50/p95/p99 sont écrits en JSON ; --baseline compare au
+résultat de référence et sort en erreur au-delà de --threshold :
+
+    python bench_embedding.py load --in-process --lengths mixed --output bench.json
+    python bench_embedding.py compare baseline.json bench.json --threshold 0.10
+
+Mode "quantization" : charge le modèle en local et mesure le recall@k de
+chaque type de sortie (float16, int8, ubinary) par rapport à float32 sur un
+jeu de test tenu à l'écart de la calibration int8 :
+
+    python bench_embedding.py quantization --corpus textes.txt
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from importlib import metadata
+
+import numpy as np
+
+
+def http_get(url, timeout=30.0):
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return resp.read()
+
+
+def http_post_json(url, payload, timeout=120.0):
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return resp.read()
+
+
+def percentile(values, q):
+    """Percentile (0-100) par rang le plus proche ; None si aucune valeur."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Rang le plus proche : plus petite valeur dont le rang atteint q % (ceil, pas round)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q * len(ordered) / 100.0) - 1))
+    return ordered[rank]
+
+
+def summarize_ms(latencies):
+    """Résumé en millisecondes d'une liste de latences en secondes."""
+    if not latencies:
+        return {"count": 0}
+    ms = [x * 1000.0 for x in latencies]
+    return {
+        "count": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 2),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms), 2),
+    }
+
+
+def run_health(args):
+    base = args.url.rstrip("/")
+    stop = threading.Event()
+    loaded = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+    text = " ".join(["the quick brown fox jumps over the lazy dog"] * args.words_repeat)
+    payload = {"items": [{"id": i, "text": text} for i in range(args.batch_items)]}
+
+    def saturate():
+        while not stop.is_set():
+            try:
+                http_post_json(base + "/embed/batch", payload)
+                ok = True
+            except Exception:
+                ok = False
+            with lock:
+                loaded["requests" if ok else "errors"] += 1
+
+    # Latence de référence du health check, serveur au repos
+    idle = []
+    for _ in range(args.idle_probes):
+        start = time.perf_counter()
+        http_get(base + "/")
+        idle.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=saturate, daemon=True) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    time.sleep(args.warmup)
+
+    busy, failures = [], 0
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            http_get(base + "/", timeout=args.probe_timeout)
+            busy.append(time.perf_counter() - start)
+        except Exception:
+            failures += 1
+        time.sleep(args.probe_interval)
+
+    stop.set()
+    for t in threads:
+        t.join(timeout=args.probe_timeout)
+
+    report = {
+        "mode": "health",
+        "url": base,
+        "concurrency": args.concurrency,
+        "batch_items": args.batch_items,
+        "health_idle": summarize_ms(idle),
+        "health_saturated": summarize_ms(busy),
+        "health_failures": failures,
+        "load_requests": loaded["requests"],
+        "load_errors": loaded["errors"],
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# Distributions de longueurs (en mots) : liste de (poids, min, max)
+LENGTH_PROFILES = {
+    "short": [(1.0, 3, 12)],
+    "medium": [(1.0, 20, 80)],
+    "long": [(1.0, 150, 400)],
+    # Trafic type : surtout des requêtes courtes, quelques documents
+    "mixed": [(0.7, 3, 12), (0.25, 20, 80), (0.05, 150, 400)],
+}
+
+BENCH_WORDS = ("customer order delivery refund account password shipping invoice payment warranty "
+               "battery screen laptop phone return exchange broken late premium discount store "
+               "support article update install error message settings network printer email").split()
+
+
+def parse_lengths(spec):
+    """Profil nommé, ou "poids:min-max,..." (ex. "0.8:3-12,0.2:100-300")."""
+    if spec in LENGTH_PROFILES:
+        return LENGTH_PROFILES[spec]
+    profile = []
+    for part in spec.split(","):
+        weight, _, bounds = part.partition(":")
+        low, _, high = bounds.partition("-")
+        profile.append((float(weight), int(low), int(high or low)))
+    return profile
+
+
+def make_texts(count, profile, seed, unique=True):
+    """Textes déterministes pour un seed donné ; uniques pour ne pas mesurer le cache."""
+    rng = random.Random(seed)
+    weights = [w for w, _, _ in profile]
+    texts = []
+    for i in range(count):
+        _, low, high = rng.choices(profile, weights)[0]
+        words = [rng.choice(BENCH_WORDS) for _ in range(rng.randint(low, high))]
+        if unique:
+            words.append(f"#{seed}-{i}")
+        texts.append(" ".join(words))
+    return texts
+
+
+def package_versions():
+    versions = {"python": platform.python_version()}
+    for name in ("torch", "sentence-transformers", "transformers", "onnxruntime", "numpy", "fastapi", "uvicorn"):
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            continue
+    return versions
+
+
+def start_in_process(host="127.0.0.1", timeout=300.0):
+    """Lance embedding_server dans un thread uvicorn sur un port libre ; renvoie (url, arrêt)."""
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config("embedding_server:app", host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    url = f"http://{host}:{port}"
+    deadline = time.monotonic() + timeout
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError("In-process server did not start")
+        time.sleep(0.1)
+
+    def stop():
+        server.should_exit = True
+        thread.join(timeout=30)
+
+    return url, stop
+
+
+def drive(url, texts, concurrency, timeout):
+    """Envoie les textes à /embed depuis `concurrency` clients en boucle fermée."""
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    cursor = iter(range(len(texts)))
+
+    def client():
+        while True:
+            with lock:
+                i = next(cursor, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                http_post_json(url + "/embed", {"text": texts[i]}, timeout=timeout)
+                status = 200
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except Exception:
+                status = "error"
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, statuses, time.perf_counter() - start
+
+
+# Métriques comparées : (chemin, sens) ; +1 = plus haut vaut mieux
+COMPARED = [
+    (("throughput_rps",), 1),
+    (("latency", "p50_ms"), -1),
+    (("latency", "p95_ms"), -1),
+    (("latency", "p99_ms"), -1),
+]
+
+
+def compare_reports(baseline, current, threshold):
+    """Écart relatif par métrique ; régression si pire que le seuil (0.10 = 10 %)."""
+    rows, regressed = [], False
+    for path, direction in COMPARED:
+        old, new = baseline, current
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change * direction > threshold
+        regressed = regressed or worse
+        rows.append({"metric": ".".join(path), "baseline": old, "current": new,
+                     "change": round(change, 4), "regression": worse})
+    return {"threshold": threshold, "regression": regressed, "metrics": rows}
+
+
+def run_load(args):
+    profile = parse_lengths(args.lengths)
+    stop = None
+    if args.in_process:
+        url, stop = start_in_process()
+    else:
+        url = args.url.rstrip("/")
+    try:
+        # Préchauffage hors mesure (allocation des buffers, premières passes)
+        drive(url, make_texts(args.warmup, profile, args.seed + 1, args.unique), args.concurrency, args.timeout)
+        texts = make_texts(args.requests, profile, args.seed, args.unique)
+        latencies, statuses, elapsed = drive(url, texts, args.concurrency, args.timeout)
+    finally:
+        if stop is not None:
+            stop()
+
+    ok = statuses.get(200, 0)
+    words = [len(text.split()) for text in texts]
+    report = {
+        "mode": "load",
+        "target": "in-process" if args.in_process else url,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "lengths": args.lengths,
+        "mean_words": round(statistics.fmean(words), 1),
+        "seed": args.seed,
+        "unique_texts": args.unique,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(ok / elapsed, 2) if elapsed else None,
+        "latency": summarize_ms(latencies),
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "versions": package_versions(),
+        "cpu_count": os.cpu_count(),
+        "env": {name: os.environ[name] for name in sorted(os.environ)
+                if name.startswith(("EMBED", "MICROBATCH", "INFERENCE", "BUCKET", "LENGTH_BUCKETING", "ONNX"))},
+    }
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparison"] = compare_reports(json.load(f), report, args.threshold)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if report.get("comparison", {}).get("regression"):
+        sys.exit(1)
+    return report
+
+
+def run_compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    comparison = compare_reports(baseline, current, args.threshold)
+    print(json.dumps(comparison, indent=2))
+    if comparison["regression"]:
+        sys.exit(1)
+    return comparison
+
+
+def load_corpus(path, size, seed):
+    """Textes du corpus (une ligne par texte) ou, à défaut, textes synthétiques."""
+    if path:
+        with open(path, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+        return texts[:size] if size else texts
+    rng = random.Random(seed)
+    words = ("product order delivery price refund account password shipping size color "
+             "cotton leather phone laptop screen battery warranty store invoice payment "
+             "discount gift return exchange broken late fast cheap premium blue red").split()
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(3, 30))) for _ in range(size)]
+
+
+def recall_at_k(truth, approx):
+    k = truth.shape[1]
+    return float(sum(len(set(t) & set(a)) for t, a in zip(truth, approx)) / (k * len(truth)))
+
+
+def run_quantization(args):
+    from sentence_transformers import SentenceTransformer
+    from embedding_quantization import Int8Calibration, quantize
+    from embedding_reduction import nearest
+
+    texts = load_corpus(args.corpus, args.size, args.seed)
+    model = SentenceTransformer(args.model)
+    vectors = model.encode(texts, batch_size=64, normalize_embeddings=True)
+    # Moitié pour calibrer int8, moitié tenue à l'écart pour mesurer le recall
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(vectors))
+    calib, held = vectors[order[: len(order) // 2]], vectors[order[len(order) // 2 :]]
+    queries = rng.choice(len(held), size=min(args.queries, len(held)), replace=False)
+    k = min(args.k, len(held) - 1)
+    # Les requêtes font partie de held : leur propre ligne est exclue des voisins
+    truth = nearest(held[queries] @ held.T, k, queries)
+
+    calibration = Int8Calibration.fit(calib, args.model, args.percentile)
+    report = {"mode": "quantization", "model": args.model, "corpus": len(texts), "held_out": len(held),
+              "queries": len(queries), "k": k, "results": {}}
+    for dtype in ("float32", "float16", "int8", "ubinary"):
+        codes, _ = quantize(held, dtype, calibration)
+        if dtype == "ubinary":
+            # Distance de Hamming : popcount (table de 256 entrées) du XOR des codes empaquetés
+            popcount = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+            scores = np.stack([-popcount[np.bitwise_xor(codes[q], codes)].sum(axis=1) for q in queries])
+            scores = scores.astype(np.float32)
+        elif dtype == "int8":
+            decoded = calibration.dequantize(codes)
+            scores = decoded[queries] @ decoded.T
+        else:
+            decoded = codes.astype(np.float32)
+            scores = decoded[queries] @ decoded.T
+        report["results"][dtype] = {
+            "bytes_per_vector": int(codes[0].nbytes),
+            f"recall@{k}": round(recall_at_k(truth, nearest(scores, k, queries)), 4),
+        }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sawem Embedding API benchmarks")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    health = sub.add_parser("health", help="health-check latency while /embed/batch saturates the server")
+    health.add_argument("--url", default="http://127.0.0.1:10000")
+    health.add_argument("--concurrency", type=int, default=4)
+    health.add_argument("--batch-items", type=int, default=64)
+    health.add_argument("--words-repeat", type=int, default=20)
+    health.add_argument("--duration", type=float, default=20.0)
+    health.add_argument("--warmup", type=float, default=2.0)
+    health.add_argument("--idle-probes", type=int, default=20)
+    health.add_argument("--probe-interval", type=float, default=0.05)
+    health.add_argument("--probe-timeout", type=float, default=30.0)
+    health.set_defaults(func=run_health)
+
+    load = sub.add_parser("load", help="/embed throughput and latency percentiles under concurrent load")
+    target = load.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://127.0.0.1:10000")
+    target.add_argument("--in-process", action="store_true", help="start embedding_server in this process")
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--requests", type=int, default=2000)
+    load.add_argument("--warmup", type=int, default=100)
+    load.add_argument("--lengths", default="mixed",
+                      help=f"{', '.join(LENGTH_PROFILES)} or weight:min-max,... in words")
+    load.add_argument("--unique", action=argparse.BooleanOptionalAction, default=True,
+                      help="make every text unique so the embedding cache is bypassed")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--timeout", type=float, default=120.0)
+    load.add_argument("--output", default=None, help="write the JSON report to this file")
+    load.add_argument("--baseline", default=None, help="baseline JSON report to compare against")
+    load.add_argument("--threshold", type=float, default=0.10, help="allowed relative regression")
+    load.set_defaults(func=run_load)
+
+    compare = sub.add_parser("compare", help="compare two load reports, exit 1 on regression")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.10)
+    compare.set_defaults(func=run_compare)
+
+    quant = sub.add_parser("quantization", help="recall@k of float16/int8/ubinary outputs vs float32")
+    quant.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    quant.add_argument("--corpus", default=None, help="text file, one document per line (default: synthetic)")
+    quant.add_argument("--size", type=int, default=5000)
+    quant.add_argument("--queries", type=int, default=200)
+    quant.add_argument("--k", type=int, default=10)
+    quant.add_argument("--percentile", type=float, default=None)
+    quant.add_argument("--seed", type=int, default=0)
+    quant.set_defaults(func=run_quantization)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# cpu_budget.py
+"""
+Répartition des cœurs entre workers gunicorn et threads torch.
+
+Sans réglage, chaque worker laisse torch prendre autant de threads intra-op
+que de cœurs visibles : avec 2 workers sur 4 cœurs, 8 threads de calcul se
+disputent 4 cœurs. Ici le nombre de cœurs réellement disponibles est lu en
+tenant compte du quota cgroup (v1 ou v2) et de l'affinité CPU, puis réparti :
+
+    cœurs = workers x passes avant simultanées x threads intra-op
+
+gunicorn.conf.py calcule la part de chaque worker (CPU_BUDGET), que le
+serveur découpe entre son pool d'inférence et les threads torch.
+
+Calibration (mesure hors HTTP, modèle chargé une fois puis fork) :
+
+    python cpu_budget.py calibrate --model sentence-transformers/all-MiniLM-L6-v2
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_paths():
+    """Chemins du cgroup courant par contrôleur ("" pour cgroup v2)."""
+    paths = {}
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        _, controllers, path = line.split(":", 2)
+        for controller in controllers.split(",") if controllers else [""]:
+            paths[controller] = path
+    return paths
+
+
+def cgroup_cpu_limit():
+    """Quota CPU du cgroup en cœurs (fractionnaire), None si illimité."""
+    paths = _cgroup_paths()
+    # cgroup v2 : "max 100000" ou "<quota> <période>"
+    for base in (os.path.join("/sys/fs/cgroup", paths.get("", "/").lstrip("/")), "/sys/fs/cgroup"):
+        value = _read(os.path.join(base, "cpu.max"))
+        if value:
+            quota, _, period = value.partition(" ")
+            if quota == "max":
+                return None
+            return int(quota) / int(period or 100000)
+    # cgroup v1 : cpu.cfs_quota_us = -1 si illimité
+    for base in (os.path.join("/sys/fs/cgroup/cpu", paths.get("cpu", "/").lstrip("/")), "/sys/fs/cgroup/cpu"):
+        quota, period = _read(os.path.join(base, "cpu.cfs_quota_us")), _read(os.path.join(base, "cpu.cfs_period_us"))
+        if quota and period:
+            return None if int(quota) <= 0 else int(quota) / int(period)
+    return None
+
+
+def available_cores():
+    """Cœurs utilisables : affinité CPU, bornée par le quota cgroup (CPU_CORES pour forcer)."""
+    if os.getenv("CPU_CORES"):
+        return max(1, int(os.getenv("CPU_CORES")))
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        # Un quota de 1.5 cœur laisse tout de même travailler 2 threads
+        cores = min(cores, math.ceil(limit))
+    return max(1, cores)
+
+
+def default_workers(cores):
+    """Workers gunicorn par défaut : 2 au plus, pas plus que de cœurs."""
+    return max(1, min(2, cores))
+
+
+def thread_plan(budget, concurrent_passes=None):
+    """Découpe le budget d'un processus : (passes avant simultanées, threads intra-op).
+
+    Une seule passe par défaut : le micro-batcher attend chaque encodage avant
+    de lancer le suivant, tout le budget va donc aux threads intra-op (comme
+    le recommande la calibration).
+    """
+    budget = max(1, int(budget))
+    passes = max(1, min(int(concurrent_passes or 1), budget))
+    return passes, max(1, budget // passes)
+
+
+def configure_torch(intra_op, inter_op=1):
+    """Fixe les threads torch ; inter-op ne peut l'être qu'avant tout travail parallèle."""
+    import torch
+
+    torch.set_num_threads(int(intra_op))
+    try:
+        torch.set_num_interop_threads(int(inter_op))
+    except RuntimeError:
+        # Déjà fixé (ou pool déjà démarré) dans ce processus
+        pass
+
+
+def _calibration_worker(encoder, texts, batch_size, threads, barrier, duration, results):
+    configure_torch(threads)
+    encoder.encode(texts[:batch_size], batch_size=batch_size)
+    barrier.wait()
+    done, start = 0, time.perf_counter()
+    while time.perf_counter() - start < duration:
+        offset = done % len(texts)
+        encoder.encode(texts[offset:offset + batch_size], batch_size=batch_size)
+        done += batch_size
+    results.put(done / (time.perf_counter() - start))
+
+
+def calibrate(encoder, texts, cores, batch_size=32, duration=10.0, oversubscribe=False):
+    """Débit total (textes/s) pour chaque combinaison processus x threads."""
+    import multiprocessing
+
+    # fork : le modèle chargé ici est partagé, comme avec preload_app
+    ctx = multiprocessing.get_context("fork")
+    totals = (cores, 2 * cores) if oversubscribe else (cores,)
+    combos = [(p, total // p) for total in totals for p in range(1, total + 1) if total % p == 0]
+    results = []
+    for processes, threads in combos:
+        barrier, queue = ctx.Barrier(processes), ctx.Queue()
+        procs = [
+            ctx.Process(target=_calibration_worker, args=(encoder, texts, batch_size, threads, barrier, duration, queue))
+            for _ in range(processes)
+        ]
+        for p in procs:
+            p.start()
+        rates = [queue.get() for _ in procs]
+        for p in procs:
+            p.join()
+        results.append({"workers": processes, "threads": threads, "items_per_sec": round(sum(rates), 1)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU budget detection and worker x thread calibration")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("show", help="print detected cores and the default split")
+    cal = sub.add_parser("calibrate", help="sweep worker x thread combinations and recommend the fastest")
+    cal.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"))
+    cal.add_argument("--cores", type=int, default=None, help="override detected cores")
+    cal.add_argument("--batch-size", type=int, default=32)
+    cal.add_argument("--duration", type=float, default=10.0, help="seconds per combination")
+    cal.add_argument("--lengths", default="mixed", help="length profile, see bench_embedding.py")
+    cal.add_argument("--oversubscribe", action="store_true", help="also measure 2x oversubscribed splits")
+    args = parser.parse_args(argv)
+
+    cores = available_cores()
+    if args.command == "show":
+        workers = default_workers(cores)
+        passes, threads = thread_plan(cores // workers)
+        report = {"cores": cores, "cgroup_limit": cgroup_cpu_limit(), "workers": workers,
+                  "concurrent_passes_per_worker": passes, "intra_op_threads": threads}
+        print(json.dumps(report, indent=2))
+        return report
+
+    from sentence_transformers import SentenceTransformer
+
+    from bench_embedding import make_texts, parse_lengths
+
+    cores = args.cores or cores
+    texts = make_texts(args.batch_size * 16, parse_lengths(args.lengths), seed=0)
+    encoder = SentenceTransformer(args.model)
+    results = calibrate(encoder, texts, cores, args.batch_size, args.duration, args.oversubscribe)
+    best = max(results, key=lambda r: r["items_per_sec"])
+    report = {
+        "model": args.model,
+        "cores": cores,
+        "results": sorted(results, key=lambda r: -r["items_per_sec"]),
+        "recommended": best,
+        "env": {"WEB_CONCURRENCY": best["workers"], "CPU_BUDGET": best["threads"], "INFERENCE_WORKERS": 1},
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
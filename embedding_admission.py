@@ -0,0 +1,108 @@
+# embedding_admission.py
+"""
+Contrôle d'admission des requêtes d'embedding.
+
+Le travail en cours (en file ou en calcul) est compté en tokens estimés,
+pas en requêtes : un lot de 500 documents ne pèse pas comme une requête
+courte. Au-delà de max_tokens, la requête est refusée tout de suite (429)
+plutôt que d'allonger la latence de tous ; Retry-After est le temps
+nécessaire pour écouler le travail en cours au débit observé.
+
+L'estimation ne tokenise pas : nombre de caractères / chars_per_token,
+plafonné à max_seq_length puisque le modèle tronque au-delà. Un worker
+gunicorn = un contrôleur (le plafond vaut par processus). Toutes les
+méthodes sont appelées depuis la boucle asyncio : pas de verrou.
+"""
+
+import math
+import time
+
+# Motifs de refus : plafond de tokens, ou file du micro-batcher pleine
+REJECT_REASONS = ("tokens", "queue_full")
+
+
+class AdmissionController:
+    """Plafond de tokens en cours et débit d'écoulement (moyenne mobile exponentielle)."""
+
+    def __init__(self, max_tokens, chars_per_token=4.0, max_tokens_per_text=None, min_retry=1, max_retry=60):
+        self.max_tokens = int(max_tokens)
+        self.chars_per_token = float(chars_per_token)
+        self.max_tokens_per_text = max_tokens_per_text
+        self.min_retry = int(min_retry)
+        self.max_retry = int(max_retry)
+        self.queued_tokens = 0
+        self.admitted = 0
+        self.rejected = dict.fromkeys(REJECT_REASONS, 0)
+        self.drain_rate = None  # tokens/s
+        # Débit mesuré sur le temps où du travail était en cours : une période
+        # creuse ne doit pas faire croire à un serveur lent
+        self._drained = 0
+        self._busy = 0.0
+        self._busy_since = None
+
+    @property
+    def enabled(self):
+        return self.max_tokens > 0
+
+    def estimate(self, texts, truncated=True):
+        """Tokens estimés ; truncated=False pour des textes découpés en fenêtres (non tronqués)."""
+        # +2 : tokens spéciaux ([CLS], [SEP]) ajoutés à chaque texte
+        cap = self.max_tokens_per_text if truncated else None
+        total = 0
+        for text in texts:
+            tokens = math.ceil(len(text) / self.chars_per_token) + 2
+            total += min(tokens, cap) if cap else tokens
+        return total
+
+    def try_acquire(self, tokens, reason="tokens"):
+        """Réserve tokens ; False (et refus compté) si le plafond serait dépassé.
+
+        Une requête plus grosse que le plafond passe quand rien n'est en cours,
+        sinon elle ne serait jamais servie. Une réservation vide (lot sans
+        texte) est toujours admise et ne compte pas dans le débit.
+        """
+        if tokens <= 0:
+            self.admitted += 1
+            return True
+        if self.enabled and self.queued_tokens and self.queued_tokens + tokens > self.max_tokens:
+            self.reject(reason)
+            return False
+        if not self.queued_tokens:
+            self._busy_since = time.monotonic()
+        self.queued_tokens += tokens
+        self.admitted += 1
+        return True
+
+    def reject(self, reason):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def release(self, tokens):
+        if tokens <= 0:
+            return
+        now = time.monotonic()
+        self.queued_tokens -= tokens
+        self._drained += tokens
+        if self._busy_since is not None:
+            self._busy += now - self._busy_since
+        self._busy_since = now if self.queued_tokens else None
+        if self._busy >= 1.0:
+            rate = self._drained / self._busy
+            self.drain_rate = rate if self.drain_rate is None else 0.7 * self.drain_rate + 0.3 * rate
+            self._drained, self._busy = 0, 0.0
+
+    def retry_after(self):
+        """Secondes avant qu'une nouvelle tentative ait une chance d'être admise."""
+        if not self.drain_rate:
+            return self.min_retry
+        return max(self.min_retry, min(self.max_retry, math.ceil(self.queued_tokens / self.drain_rate)))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "max_tokens": self.max_tokens,
+            "queued_tokens": self.queued_tokens,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "drain_tokens_per_sec": round(self.drain_rate, 1) if self.drain_rate else None,
+            "retry_after": self.retry_after(),
+        }
@@ -0,0 +1,253 @@
+# embedding_backends.py
+"""
+Backends d'inférence interchangeables.
+
+  - torch : SentenceTransformer.encode (par défaut)
+  - onnx  : le transformer est exporté une fois en ONNX (éventuellement
+            quantifié en int8 dynamique), mis en cache sur disque, puis exécuté
+            avec onnxruntime ; le pooling et la normalisation reproduisent
+            ceux du pipeline SentenceTransformer.
+
+onnxruntime et onnx sont des dépendances optionnelles, importées seulement
+quand le backend onnx est demandé.
+
+Vérification de parité et comparaison de débit :
+
+    python embedding_backends.py --model sentence-transformers/all-MiniLM-L6-v2
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+def load_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("EMBEDDING_BACKEND=onnx requires onnxruntime (pip install onnxruntime onnx)")
+    return onnxruntime
+
+
+def pooling_config(st_model):
+    """Mode de pooling et présence d'une normalisation L2 dans le pipeline."""
+    from sentence_transformers import models
+
+    mode, normalize = "mean", False
+    for module in st_model:
+        if isinstance(module, models.Pooling):
+            mode = module.get_pooling_mode_str()
+        elif isinstance(module, models.Normalize):
+            normalize = True
+    return mode, normalize
+
+
+def export_onnx(st_model, path, opset=17):
+    """Exporte le transformer (token embeddings) avec batch et longueur dynamiques."""
+    import torch
+
+    transformer = st_model[0].auto_model
+    dummy = st_model.tokenizer(["export"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *inputs):
+            return self.inner(**dict(zip(input_names, inputs)), return_dict=False)[0]
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer.eval()),
+            tuple(dummy[name] for name in input_names),
+            tmp,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            dynamo=False,
+        )
+    os.replace(tmp, path)
+
+
+def quantize_onnx(src, dst):
+    """Quantification dynamique int8 des poids (MatMul / Gemm)."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp = dst + ".tmp"
+    quantize_dynamic(src, tmp, weight_type=QuantType.QInt8)
+    os.replace(tmp, dst)
+
+
+class OnnxEncoder:
+    """Même interface que SentenceTransformer.encode pour l'essentiel, via onnxruntime."""
+
+    def __init__(self, st_model, model_name, cache_dir="onnx_cache", quantize=True, intra_op_threads=None):
+        ort = load_onnxruntime()
+        self.st_model = st_model
+        self.tokenizer = st_model.tokenizer
+        self.max_seq_length = st_model.max_seq_length
+        self.pooling, self.normalize = pooling_config(st_model)
+
+        directory = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name).strip("_"))
+        fp32_path = os.path.join(directory, "model.onnx")
+        if not os.path.exists(fp32_path):
+            export_onnx(st_model, fp32_path)
+        self.path = fp32_path
+        if quantize:
+            self.path = os.path.join(directory, "model.int8.onnx")
+            if not os.path.exists(self.path):
+                quantize_onnx(fp32_path, self.path)
+
+        self.ort = ort
+        self.intra_op_threads = intra_op_threads
+        # Session créée à la première passe : ses threads ne survivraient pas au
+        # fork des workers gunicorn si le modèle est préchargé dans le maître
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    options = self.ort.SessionOptions()
+                    options.graph_optimization_level = self.ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    if self.intra_op_threads:
+                        options.intra_op_num_threads = int(self.intra_op_threads)
+                    self._session = self.ort.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+                    self.input_names = [i.name for i in self._session.get_inputs()]
+        return self._session
+
+    def get_sentence_embedding_dimension(self):
+        return self.st_model.get_sentence_embedding_dimension()
+
+    def _pool(self, hidden, mask):
+        if self.pooling == "cls":
+            return hidden[:, 0]
+        if self.pooling == "max":
+            return np.where(mask[..., None] > 0, hidden, -1e9).max(axis=1)
+        weights = mask[..., None].astype(np.float32)
+        return (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = np.empty((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        # Comme SentenceTransformer : tri par longueur pour limiter le padding
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            idx = order[start:start + batch_size]
+            features = self.tokenizer(
+                [texts[i] for i in idx],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            session = self.session
+            feeds = {name: features[name].astype(np.int64) for name in self.input_names}
+            hidden = session.run(None, feeds)[0]
+            out[idx] = self._pool(hidden, features["attention_mask"])
+        if self.normalize or normalize_embeddings:
+            out /= np.clip(np.linalg.norm(out, axis=1, keepdims=True), 1e-12, None)
+        return out[0] if single else out
+
+
+def encoder_id(model_name, backend="torch", quantize=True):
+    """Identité des vecteurs produits : clé de cache et nom des artefacts dérivés.
+
+    Le backend torch garde le nom du modèle (caches et fichiers existants
+    restent valides) ; onnx et sa variante int8 ont leurs propres clés.
+    """
+    if backend == "torch":
+        return model_name
+    return f"{model_name}@{backend}-int8" if quantize else f"{model_name}@{backend}"
+
+
+def create_encoder(
+    st_model, model_name, backend="torch", cache_dir="onnx_cache", quantize=True, max_batch_tokens=None, threads=None
+):
+    """Encodeur à utiliser pour les passes avant selon EMBEDDING_BACKEND.
+
+    threads fixe les threads intra-op d'onnxruntime (torch est réglé par
+    cpu_budget.configure_torch). Avec max_batch_tokens, les textes sont regroupés par longueur en tokens
+    (BucketedEncoder) avant d'être encodés ; sinon TokenCounter compte seulement les tokens.
+    """
+    if backend == "torch":
+        encoder = st_model
+    elif backend == "onnx":
+        encoder = OnnxEncoder(st_model, model_name, cache_dir, quantize=quantize, intra_op_threads=threads)
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    from embedding_batcher import BucketedEncoder, TokenCounter
+
+    if max_batch_tokens:
+        return BucketedEncoder(encoder, st_model.tokenizer, st_model.max_seq_length, max_batch_tokens)
+    return TokenCounter(encoder, st_model.tokenizer, st_model.max_seq_length)
+
+
+def throughput(encoder, texts, batch_size, repeats):
+    encoder.encode(texts[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        encoder.encode(texts, batch_size=batch_size)
+    return round(len(texts) * repeats / (time.perf_counter() - start), 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ONNX backend parity check and throughput comparison")
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--cache-dir", default="onnx_cache")
+    parser.add_argument("--texts", default=None, help="text file, one sentence per line")
+    parser.add_argument("--count", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args(argv)
+
+    from sentence_transformers import SentenceTransformer
+
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()][: args.count]
+    else:
+        base = "the customer asked about delivery delays and a refund for the damaged item"
+        texts = [" ".join(base.split()[: 3 + i % 12]) + f" #{i}" for i in range(args.count)]
+
+    st_model = SentenceTransformer(args.model)
+    reference = st_model.encode(texts, batch_size=args.batch_size, normalize_embeddings=True)
+    report = {"model": args.model, "texts": len(texts), "batch_size": args.batch_size,
+              "torch": {"items_per_sec": throughput(st_model, texts, args.batch_size, args.repeats)}}
+    ok = True
+    for name, quantize in (("onnx", False), ("onnx_int8", True)):
+        encoder = OnnxEncoder(st_model, args.model, args.cache_dir, quantize=quantize)
+        vectors = encoder.encode(texts, batch_size=args.batch_size, normalize_embeddings=True)
+        cosine = (vectors * reference).sum(axis=1)
+        report[name] = {
+            "min_cosine": round(float(cosine.min()), 5),
+            "mean_cosine": round(float(cosine.mean()), 5),
+            "items_per_sec": throughput(encoder, texts, args.batch_size, args.repeats),
+        }
+        ok = ok and cosine.min() >= args.min_cosine
+    report["parity_ok"] = bool(ok)
+    print(json.dumps(report, indent=2))
+    if not ok:
+        sys.exit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+# embedding_batcher.py
+"""
+Micro-batching des requêtes /embed unitaires.
+
+Les requêtes concurrentes sont placées dans une file ; une tâche de fond les
+regroupe (au plus max_batch_size éléments ou max_wait_ms millisecondes) et
+appelle une seule fois la fonction d'encodage (coroutine) pour tout le lot.
+
+BucketedEncoder enveloppe l'encodeur : il tokenise d'abord, trie les textes
+par nombre de tokens et lance une passe avant par groupe de longueurs
+voisines, pour ne pas payer le padding d'un document long sur des requêtes
+courtes ; les vecteurs sont remis dans l'ordre d'origine. Sans regroupement,
+TokenCounter compte seulement les tokens envoyés au modèle.
+
+SingleFlight évite d'encoder plusieurs fois le même texte : les doublons d'une
+requête sont encodés une fois, et une clé déjà en cours de calcul (pour une
+autre requête) est attendue plutôt que recalculée.
+"""
+
+import asyncio
+import threading
+import time
+from functools import partial
+
+import numpy as np
+
+from embedding_metrics import LATENCY_BUCKETS, SIZE_BUCKETS, Histogram
+
+
+class QueueFullError(Exception):
+    """Levée quand la file d'attente du micro-batcher est pleine."""
+
+
+class _Flight:
+    """Calcul partagé en cours : sa tâche et le nombre d'appelants qui l'attendent."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.task = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Calculs en cours par clé, partagés entre les appelants concurrents.
+
+    Le calcul tourne dans sa propre tâche : l'annulation de l'appelant qui
+    l'a lancé ne le coupe pas tant qu'un autre appelant attend le résultat ;
+    il n'est annulé que quand plus personne ne l'attend.
+    """
+
+    def __init__(self):
+        self._pending = {}  # clé -> (future, _Flight)
+        # Éléments non envoyés au modèle : doublons d'une même requête, ou
+        # clés déjà en cours de calcul pour une autre requête
+        self.in_batch = 0
+        self.in_flight = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    async def run(self, keys, items, compute):
+        """Résultats alignés sur keys ; compute(keys, items) ne reçoit que les clés à calculer.
+
+        compute est une coroutine qui renvoie un résultat par élément, dans l'ordre.
+        """
+        loop = asyncio.get_running_loop()
+        futures, own, flights = {}, {}, set()
+        for key, item in zip(keys, items):
+            if key in futures:
+                self.in_batch += 1
+                continue
+            entry = self._pending.get(key)
+            if entry is None:
+                future = loop.create_future()
+                # Résultat consommé même sans autre appelant (pas d'avertissement asyncio)
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                own[key] = item
+            else:
+                self.in_flight += 1
+                future, flight = entry
+                flights.add(flight)
+            futures[key] = future
+        if own:
+            flight = _Flight(list(own))
+            for key in own:
+                self._pending[key] = (futures[key], flight)
+            flight.task = loop.create_task(compute(list(own), list(own.values())))
+            flight.task.add_done_callback(partial(self._settle, flight, futures))
+            flights.add(flight)
+        for flight in flights:
+            flight.waiters += 1
+        try:
+            # shield : l'annulation d'un appelant ne doit pas annuler le résultat partagé
+            return [await asyncio.shield(futures[key]) for key in keys]
+        finally:
+            for flight in flights:
+                flight.waiters -= 1
+                if not flight.waiters and not flight.task.done():
+                    # Plus personne n'attend : les clés sont libérées tout de suite
+                    # (un nouvel appelant relance le calcul) et la tâche est annulée
+                    self._release(flight)
+                    flight.task.cancel()
+
+    def _release(self, flight):
+        for key in flight.keys:
+            entry = self._pending.get(key)
+            if entry is not None and entry[1] is flight:
+                del self._pending[key]
+
+    def _settle(self, flight, futures, task):
+        self._release(flight)
+        if task.cancelled():
+            error = RuntimeError("Shared embedding computation was cancelled")
+        else:
+            error = task.exception()
+        if error is None:
+            for key, result in zip(flight.keys, task.result()):
+                futures[key].set_result(result)
+        else:
+            # Les autres appelants reçoivent l'erreur du calcul partagé
+            for key in flight.keys:
+                if not futures[key].done():
+                    futures[key].set_exception(error)
+
+    def stats(self):
+        return {"pending": len(self._pending), "saved_in_batch": self.in_batch, "saved_in_flight": self.in_flight}
+
+
+class MicroBatcher:
+    """Regroupe les textes soumis concurremment en un seul appel d'encodage."""
+
+    def __init__(self, encode_fn, max_batch_size=64, max_wait_ms=5.0, max_queue_size=1024):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue_size = int(max_queue_size)
+        self._queue = None
+        self._task = None
+        # Compteurs simples, lus par les endpoints de supervision
+        self.batches = 0
+        self.items = 0
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        self.batch_sizes = Histogram(SIZE_BUCKETS)
+
+    async def start(self):
+        """Démarre la tâche de fond (à appeler dans la boucle asyncio du worker)."""
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Arrête la tâche de fond et fait échouer les requêtes encore en file."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped"))
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, text):
+        """Ajoute un texte à la file et attend sa ligne d'embedding."""
+        if self._task is None:
+            raise RuntimeError("Batcher not started")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((text, future, time.monotonic()))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Embedding queue is full ({self.max_queue_size} pending)")
+        return await future
+
+    async def _collect(self):
+        # Attend le premier élément, puis complète le lot jusqu'à la taille
+        # maximale ou l'expiration du délai
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Délai écoulé : on prend tout de même ce qui est déjà en file
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                continue
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            now = time.monotonic()
+            for _, _, enqueued in batch:
+                self.queue_wait.observe(now - enqueued)
+            # Les appelants qui ont abandonné (déconnexion) ne sont pas encodés
+            batch = [(text, future) for text, future, _ in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                vectors = await self.encode_fn([text for text, _ in batch])
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            self.batch_sizes.observe(len(batch))
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+
+class TokenCounter:
+    """Encodeur (interface encode) inchangé, qui compte les tokens réels envoyés au modèle."""
+
+    def __init__(self, encoder, tokenizer, max_seq_length):
+        self.encoder = encoder
+        self.tokenizer = tokenizer
+        self.max_seq_length = int(max_seq_length)
+        self._lock = threading.Lock()
+        self.tokens = 0
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    def token_lengths(self, texts):
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_seq_length)
+        return np.fromiter((len(ids) for ids in encoded["input_ids"]), dtype=np.int64, count=len(texts))
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        texts = [sentences] if isinstance(sentences, str) else list(sentences)
+        if texts:
+            real = int(self.token_lengths(texts).sum())
+            with self._lock:
+                self.tokens += real
+        return self.encoder.encode(sentences, batch_size=batch_size, **kwargs)
+
+
+class BucketedEncoder(TokenCounter):
+    """Encodeur (interface encode) avec regroupement des textes par longueur en tokens."""
+
+    def __init__(self, encoder, tokenizer, max_seq_length, max_batch_tokens=16384):
+        super().__init__(encoder, tokenizer, max_seq_length)
+        # Budget de tokens (padding compris) d'une passe avant
+        self.max_batch_tokens = int(max_batch_tokens)
+        self.forward_passes = 0
+        self.padded_tokens = 0
+        self.pass_sizes = Histogram(SIZE_BUCKETS)
+
+    def buckets(self, lengths, batch_size):
+        """Indices groupés : tri par longueur, puis coupe quand le lot atteint
+        batch_size éléments ou dépasse le budget de tokens."""
+        order = np.argsort(lengths, kind="stable")
+        bucket = []
+        for i in order:
+            # Trié par longueur croissante : le dernier élément fixe la longueur paddée
+            if bucket and (len(bucket) >= batch_size or (len(bucket) + 1) * lengths[i] > self.max_batch_tokens):
+                yield bucket
+                bucket = []
+            bucket.append(int(i))
+        if bucket:
+            yield bucket
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size, **kwargs)[0]
+        texts = list(sentences)
+        if not texts:
+            return self.encoder.encode(texts, batch_size=batch_size, **kwargs)
+        lengths = self.token_lengths(texts)
+        out = None
+        sizes = []
+        real = padded = 0
+        for bucket in self.buckets(lengths, batch_size):
+            vectors = self.encoder.encode([texts[i] for i in bucket], batch_size=len(bucket), **kwargs)
+            if out is None:
+                out = np.empty((len(texts), vectors.shape[1]), dtype=vectors.dtype)
+            out[bucket] = vectors
+            sizes.append(len(bucket))
+            real += int(lengths[bucket].sum())
+            padded += int(lengths[bucket].max()) * len(bucket)
+        with self._lock:
+            self.forward_passes += len(sizes)
+            self.tokens += real
+            self.padded_tokens += padded
+            for size in sizes:
+                self.pass_sizes.observe(size)
+        return out
+
+    def stats(self):
+        return {
+            "forward_passes": self.forward_passes,
+            "tokens": self.tokens,
+            "padded_tokens": self.padded_tokens,
+            # Part des tokens calculés qui ne sont que du padding
+            "padding_ratio": round(1 - self.tokens / self.padded_tokens, 4) if self.padded_tokens else 0.0,
+        }
@@ -0,0 +1,210 @@
+# embedding_cache.py
+"""
+Cache des embeddings déjà calculés.
+
+EmbeddingCache est un LRU en mémoire borné en octets ; les clés sont un hash
+de (nom du modèle, options de normalisation, texte). PgEmbeddingCache est un
+cache durable dans PostgreSQL, partagé entre workers et redémarrages.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import psycopg
+from psycopg import sql
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model_name, normalize, text):
+    """Clé de cache (16 octets) pour un texte encodé par un modèle donné."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(model_name.encode("utf-8"))
+    h.update(b"\0normalize=1\0" if normalize else b"\0normalize=0\0")
+    h.update(text.encode("utf-8"))
+    return h.digest()
+
+
+class EmbeddingCache:
+    """LRU borné par la taille totale (en octets) des vecteurs conservés."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # Simple test de présence : ni ordre LRU ni compteurs modifiés
+        return self.enabled and key in self._entries
+
+    @staticmethod
+    def _size(key, vector):
+        return len(key) + vector.nbytes
+
+    def get_many(self, keys):
+        """Renvoie la liste des vecteurs connus (None pour les absents)."""
+        if not self.enabled:
+            return [None] * len(keys)
+        found = []
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                found.append(vector)
+        return found
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, keys, vectors):
+        """Insère des vecteurs puis évince les moins récemment utilisés."""
+        if not self.enabled:
+            return
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                # Copie contiguë : une vue sur une ligne garderait tout le lot en mémoire
+                vector = np.array(vector, dtype=np.float32, copy=True)
+                size = self._size(key, vector)
+                if size > self.max_bytes:
+                    continue
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self.resident_bytes -= self._size(key, previous)
+                self._entries[key] = vector
+                self.resident_bytes += size
+            while self.resident_bytes > self.max_bytes and self._entries:
+                old_key, old_vector = self._entries.popitem(last=False)
+                self.resident_bytes -= self._size(old_key, old_vector)
+                self.evictions += 1
+
+    def put(self, key, vector):
+        self.put_many([key], [vector])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "resident_bytes": self.resident_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class PgEmbeddingCache:
+    """Cache durable : une table (model_id, content_hash) -> vecteur float32.
+
+    Une panne de la base ne doit pas faire échouer l'inférence : les erreurs
+    sont comptées et journalisées, puis traitées comme des absences du cache.
+    """
+
+    def __init__(self, connection_factory, model_id, table="embedding_cache"):
+        # connection_factory() doit renvoyer un context manager asynchrone
+        # fournissant une psycopg.AsyncConnection
+        self.connection_factory = connection_factory
+        self.model_id = model_id
+        self.table = sql.Identifier(table)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+
+    async def ensure_table(self):
+        async with self.connection_factory() as conn:
+            await conn.execute(
+                sql.SQL(
+                    """
+                    CREATE TABLE IF NOT EXISTS {} (
+                        model_id text NOT NULL,
+                        content_hash bytea NOT NULL,
+                        dims integer NOT NULL,
+                        embedding bytea NOT NULL,
+                        created_at timestamptz NOT NULL DEFAULT now(),
+                        PRIMARY KEY (model_id, content_hash)
+                    )
+                    """
+                ).format(self.table)
+            )
+
+    async def get_many(self, keys):
+        """Une seule requête = ANY(...) ; renvoie un dict clé -> vecteur."""
+        if not keys:
+            return {}
+        try:
+            async with self.connection_factory() as conn:
+                cur = await conn.execute(
+                    sql.SQL(
+                        "SELECT content_hash, embedding FROM {} "
+                        "WHERE model_id = %s AND content_hash = ANY(%s)"
+                    ).format(self.table),
+                    (self.model_id, list(keys)),
+                )
+                rows = await cur.fetchall()
+        except psycopg.Error as e:
+            self.errors += 1
+            self.misses += len(keys)
+            logger.warning("Embedding cache lookup failed: %s", e)
+            return {}
+        found = {bytes(key): np.frombuffer(blob, dtype="<f4") for key, blob in rows}
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    async def put_many(self, keys, vectors):
+        """Upsert groupé en une seule requête via unnest()."""
+        if not keys:
+            return
+        blobs = [np.asarray(vector, dtype="<f4").tobytes() for vector in vectors]
+        dims = int(np.asarray(vectors[0]).shape[-1])
+        try:
+            async with self.connection_factory() as conn:
+                await conn.execute(
+                    sql.SQL(
+                        "INSERT INTO {} (model_id, content_hash, dims, embedding) "
+                        "SELECT %s, k, %s, e FROM unnest(%s::bytea[], %s::bytea[]) AS t(k, e) "
+                        "ON CONFLICT (model_id, content_hash) DO NOTHING"
+                    ).format(self.table),
+                    (self.model_id, dims, list(keys), blobs),
+                )
+        except psycopg.Error as e:
+            self.errors += 1
+            logger.warning("Embedding cache write failed: %s", e)
+            return
+        self.writes += len(keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "errors": self.errors,
+        }
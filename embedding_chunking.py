@@ -0,0 +1,73 @@
+# embedding_chunking.py
+"""
+Découpage des documents longs en fenêtres de tokens.
+
+Le modèle tronque silencieusement au-delà de max_seq_length : un article de
+support n'est alors représenté que par son début. Un document est ici
+tokenisé une fois, découpé en fenêtres de `window` tokens dont les débuts
+sont espacés de `stride` tokens (stride < window : fenêtres chevauchantes),
+puis chaque fenêtre est ramenée au texte d'origine grâce aux offsets du
+tokenizer. Le vecteur du document est la moyenne des vecteurs des fenêtres,
+simple ou pondérée par leur nombre de tokens.
+"""
+
+import numpy as np
+
+POOLING_MODES = ("mean", "weighted")
+
+
+class DocumentChunker:
+    """Découpe des textes selon le tokenizer et la longueur maximale du modèle."""
+
+    def __init__(self, tokenizer, max_seq_length):
+        self.tokenizer = tokenizer
+        # Tokens utiles d'une passe : la limite du modèle moins les tokens spéciaux
+        self.max_window = int(max_seq_length) - tokenizer.num_special_tokens_to_add(pair=False)
+
+    def offsets(self, text):
+        """Positions (début, fin) en caractères de chaque token, sans tokens spéciaux."""
+        encoded = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+        return encoded["offset_mapping"]
+
+    def dropped_tokens(self, text):
+        """Nombre de tokens ignorés par le modèle si le texte est encodé tel quel."""
+        return max(0, len(self.offsets(text)) - self.max_window)
+
+    def window_params(self, window=None, stride=None):
+        window = min(int(window or self.max_window), self.max_window)
+        stride = int(stride or window)
+        if window < 1 or stride < 1:
+            raise ValueError("window and stride must be >= 1")
+        # Un décalage plus grand que la fenêtre laisserait des tokens de côté
+        return window, min(stride, window)
+
+    def split(self, text, window=None, stride=None):
+        """Fenêtres du texte : dicts {start, end, tokens, text} (start/end en caractères)."""
+        window, stride = self.window_params(window, stride)
+        offsets = self.offsets(text)
+        if not offsets:
+            return [{"start": 0, "end": len(text), "tokens": 0, "text": text}]
+        starts = list(range(0, max(len(offsets) - window, 0) + 1, stride))
+        # La dernière fenêtre couvre toujours la fin du document
+        if starts[-1] + window < len(offsets):
+            starts.append(len(offsets) - window)
+        chunks = []
+        for first in starts:
+            last = min(first + window, len(offsets)) - 1
+            start, end = offsets[first][0], offsets[last][1]
+            chunks.append({"start": start, "end": end, "tokens": last - first + 1, "text": text[start:end]})
+        return chunks
+
+
+def pool(vectors, tokens, mode="mean", normalize=False):
+    """Vecteur du document à partir des vecteurs (n, dim) de ses fenêtres."""
+    if mode not in POOLING_MODES:
+        raise ValueError(f"Unknown pooling mode: {mode}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    weights = np.asarray(tokens, dtype=np.float32) if mode == "weighted" else np.ones(len(vectors), np.float32)
+    if weights.sum() <= 0:
+        weights = np.ones(len(vectors), np.float32)
+    pooled = (vectors * weights[:, None]).sum(axis=0) / weights.sum()
+    if normalize:
+        pooled /= max(float(np.linalg.norm(pooled)), 1e-12)
+    return pooled
@@ -0,0 +1,263 @@
+# embedding_clustering.py
+"""
+Clustering des embeddings stockés, sans export.
+
+Un job "cluster" (même table et mêmes runners que les jobs d'embedding) lit
+la table pgvector par un curseur côté serveur, lot par lot et en binaire,
+ajuste un MiniBatchKMeans par partial_fit pendant `passes` passes, puis relit
+la table pour écrire l'affectation de chaque ligne (cluster, distance au
+centroïde) dans la table cible et les centroïdes dans <cible>_centroids.
+La mémoire est bornée par un tampon de quelques lots et les centroïdes.
+
+Reprise : les centroïdes sont écrits à la fin de chaque passe ; un job repris
+repart de la dernière passe terminée (initialisé sur ces centroïdes), puis
+l'affectation reprend après le dernier id écrit.
+"""
+
+import asyncio
+import logging
+
+import numpy as np
+from psycopg import sql
+
+from embedding_jobs import JobError
+from vector_store import decode_vectors, qualified, to_pgvector
+
+logger = logging.getLogger(__name__)
+
+# Lots gardés en mémoire et mélangés avant partial_fit : l'ordre physique de
+# la table (souvent l'ordre d'ingestion) biaiserait les mises à jour
+SHUFFLE_BATCHES = 4
+
+
+def validate_clustering(params):
+    if not params.get("table"):
+        raise JobError("clustering requires 'table'")
+    k, batch_size, passes = params.get("k"), params.get("batch_size"), params.get("passes", 1)
+    if not isinstance(k, int) or k < 2:
+        raise JobError("'k' must be an integer >= 2")
+    if not isinstance(batch_size, int) or batch_size < k:
+        raise JobError("'batch_size' must be an integer >= k")
+    if not isinstance(passes, int) or passes < 1:
+        raise JobError("'passes' must be an integer >= 1")
+    return params
+
+
+def centroids_table(target_table):
+    return f"{target_table}_centroids"
+
+
+async def scan_vectors(connection_factory, table, batch_size, after=None, ordered=False):
+    """Lots (ids, matrice) lus par un curseur côté serveur ; ordered pour reprendre après un id."""
+    query = sql.SQL("SELECT id, embedding FROM {}").format(qualified(table))
+    params = ()
+    if after is not None:
+        query = sql.SQL("{} WHERE id > %s").format(query)
+        params = (after,)
+    if ordered:
+        query = sql.SQL("{} ORDER BY id").format(query)
+    async with connection_factory() as conn:
+        # Un curseur nommé vit dans une transaction (la connexion est en autocommit)
+        async with conn.transaction():
+            async with conn.cursor(name="embedding_cluster_scan", binary=True) as cur:
+                cur.itersize = batch_size
+                await cur.execute(query, params)
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    yield [row[0] for row in rows], decode_vectors([row[1] for row in rows])
+
+
+async def vector_dims(connection_factory, table):
+    async with connection_factory() as conn:
+        cur = await conn.execute(sql.SQL("SELECT vector_dims(embedding) FROM {} LIMIT 1").format(qualified(table)))
+        row = await cur.fetchone()
+    if row is None:
+        raise JobError(f"No vectors in {table}")
+    return row[0]
+
+
+async def ensure_tables(connection_factory, target_table, dims):
+    async with connection_factory() as conn:
+        await conn.execute(
+            sql.SQL(
+                """
+                CREATE TABLE IF NOT EXISTS {} (
+                    id text PRIMARY KEY,
+                    cluster_id integer NOT NULL,
+                    distance real NOT NULL,
+                    job_id bigint NOT NULL,
+                    updated_at timestamptz NOT NULL DEFAULT now()
+                )
+                """
+            ).format(qualified(target_table))
+        )
+        await conn.execute(
+            sql.SQL(
+                """
+                CREATE TABLE IF NOT EXISTS {} (
+                    job_id bigint NOT NULL,
+                    cluster_id integer NOT NULL,
+                    size bigint,
+                    centroid vector({}) NOT NULL,
+                    updated_at timestamptz NOT NULL DEFAULT now(),
+                    PRIMARY KEY (job_id, cluster_id)
+                )
+                """
+            ).format(qualified(centroids_table(target_table)), sql.Literal(int(dims)))
+        )
+
+
+async def save_centroids(connection_factory, target_table, job_id, centroids, sizes=None):
+    rows = [
+        (job_id, i, None if sizes is None else int(sizes[i]), to_pgvector(centroid))
+        for i, centroid in enumerate(centroids)
+    ]
+    async with connection_factory() as conn:
+        async with conn.transaction():
+            async with conn.cursor() as cur:
+                await cur.executemany(
+                    sql.SQL(
+                        "INSERT INTO {} (job_id, cluster_id, size, centroid) VALUES (%s, %s, %s, %s::vector) "
+                        "ON CONFLICT (job_id, cluster_id) DO UPDATE SET size = EXCLUDED.size, "
+                        "centroid = EXCLUDED.centroid, updated_at = now()"
+                    ).format(qualified(centroids_table(target_table))),
+                    rows,
+                )
+
+
+async def load_centroids(connection_factory, target_table, job_id):
+    async with connection_factory() as conn:
+        async with conn.cursor(binary=True) as cur:
+            await cur.execute(
+                sql.SQL("SELECT centroid FROM {} WHERE job_id = %s ORDER BY cluster_id").format(
+                    qualified(centroids_table(target_table))
+                ),
+                (job_id,),
+            )
+            rows = await cur.fetchall()
+    return decode_vectors([row[0] for row in rows])
+
+
+async def write_assignments(conn, target_table, job_id, ids, labels, distances):
+    stage = sql.Identifier(f"{target_table.split('.')[-1]}_cluster_stage")
+    async with conn.transaction():
+        async with conn.cursor() as cur:
+            await cur.execute(
+                sql.SQL(
+                    "CREATE TEMP TABLE IF NOT EXISTS {} (id text, cluster_id integer, distance real) "
+                    "ON COMMIT DELETE ROWS"
+                ).format(stage)
+            )
+            async with cur.copy(sql.SQL("COPY {} (id, cluster_id, distance) FROM STDIN").format(stage)) as copy:
+                for row in zip(ids, labels.tolist(), distances.tolist()):
+                    await copy.write_row(row)
+            await cur.execute(
+                sql.SQL(
+                    "INSERT INTO {target} (id, cluster_id, distance, job_id) "
+                    "SELECT id, cluster_id, distance, %s FROM {stage} "
+                    "ON CONFLICT (id) DO UPDATE SET cluster_id = EXCLUDED.cluster_id, "
+                    "distance = EXCLUDED.distance, job_id = EXCLUDED.job_id, updated_at = now()"
+                ).format(target=qualified(target_table), stage=stage),
+                (job_id,),
+            )
+
+
+async def cluster_sizes(connection_factory, target_table, job_id, k):
+    async with connection_factory() as conn:
+        cur = await conn.execute(
+            sql.SQL("SELECT cluster_id, count(*) FROM {} WHERE job_id = %s GROUP BY cluster_id").format(
+                qualified(target_table)
+            ),
+            (job_id,),
+        )
+        sizes = np.zeros(k, dtype=np.int64)
+        for cluster_id, size in await cur.fetchall():
+            sizes[cluster_id] = size
+    return sizes
+
+
+async def run_clustering(runner, job):
+    """Exécute un job "cluster" pour un JobRunner (handler de kind "cluster")."""
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.metrics.pairwise import euclidean_distances
+
+    params, job_id, owner = job["source"], job["id"], runner.owner
+    table, target, k, batch_size = params["table"], job["target_table"], params["k"], params["batch_size"]
+    passes = params.get("passes", 1)
+    factory, store = runner.connection_factory, runner.store
+    checkpoint = job["checkpoint"] or {"phase": "fit", "pass": 0, "pass_start_rows": 0}
+    logger.info("Clustering job %s started (%s)", job_id, checkpoint)
+
+    async def turn():
+        if runner.wait_turn is not None:
+            await runner.wait_turn()
+
+    await ensure_tables(factory, target, await vector_dims(factory, table))
+    kmeans = None
+    if checkpoint["phase"] == "fit":
+        start_pass, rows_done = checkpoint["pass"], checkpoint["pass_start_rows"]
+        kmeans = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=params.get("seed", 0), n_init=3)
+        if start_pass > 0:
+            kmeans.set_params(init=await load_centroids(factory, target, job_id), n_init=1)
+        rng = np.random.default_rng(params.get("seed", 0) + start_pass)
+        for current in range(start_pass, passes):
+            pass_start = rows_done
+            buffer = []
+
+            async def fit_buffer():
+                matrix = np.concatenate(buffer)
+                buffer.clear()
+                matrix = matrix[rng.permutation(len(matrix))]
+                for start in range(0, len(matrix), batch_size):
+                    part = matrix[start:start + batch_size]
+                    # partial_fit initialise les centroïdes sur le premier lot : il doit en contenir au moins k
+                    if len(part) < k and not hasattr(kmeans, "cluster_centers_"):
+                        continue
+                    await turn()
+                    await asyncio.to_thread(kmeans.partial_fit, part)
+
+            async for _, matrix in scan_vectors(factory, table, batch_size):
+                buffer.append(matrix)
+                rows_done += len(matrix)
+                if len(buffer) >= SHUFFLE_BATCHES:
+                    await fit_buffer()
+                state = {"phase": "fit", "pass": current, "pass_start_rows": pass_start}
+                if not await store.checkpoint(job_id, owner, rows_done, state):
+                    logger.info("Clustering job %s stopped (cancelled or taken over)", job_id)
+                    return
+            if buffer:
+                await fit_buffer()
+            if not hasattr(kmeans, "cluster_centers_"):
+                raise JobError(f"Not enough vectors in {table} for k={k}")
+            await save_centroids(factory, target, job_id, kmeans.cluster_centers_)
+            checkpoint = {"phase": "fit", "pass": current + 1, "pass_start_rows": rows_done}
+            if not await store.checkpoint(job_id, owner, rows_done, checkpoint):
+                return
+        checkpoint = {"phase": "assign", "after": None}
+        if not await store.checkpoint(job_id, owner, rows_done, checkpoint):
+            return
+    else:
+        rows_done = job["rows_done"]
+
+    # Centroïdes de la dernière passe ; relus en base si le job reprend en
+    # affectation, ou après la dernière passe (aucun partial_fit dans ce processus)
+    centroids = getattr(kmeans, "cluster_centers_", None)
+    if centroids is None:
+        centroids = await load_centroids(factory, target, job_id)
+    # Affectation au centroïde le plus proche, centroïdes figés
+    async with factory() as conn:
+        async for ids, matrix in scan_vectors(factory, table, batch_size, checkpoint["after"], ordered=True):
+            await turn()
+            distances = await asyncio.to_thread(euclidean_distances, matrix, centroids)
+            labels = distances.argmin(axis=1)
+            await write_assignments(conn, target, job_id, ids, labels, distances[np.arange(len(ids)), labels])
+            rows_done += len(ids)
+            if not await store.checkpoint(job_id, owner, rows_done, {"phase": "assign", "after": ids[-1]}):
+                logger.info("Clustering job %s stopped (cancelled or taken over)", job_id)
+                return
+    sizes = await cluster_sizes(factory, target, job_id, k)
+    await save_centroids(factory, target, job_id, centroids, sizes)
+    await store.release(job_id, owner, "succeeded")
+    logger.info("Clustering job %s finished: %s clusters over %s rows", job_id, k, int(sizes.sum()))
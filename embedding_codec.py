@@ -0,0 +1,83 @@
+# embedding_codec.py
+"""
+Formats de réponse des embeddings.
+
+Le format est choisi par le paramètre `format` ou, à défaut, par l'en-tête
+Accept :
+  - json    : listes de flottants (format historique)
+  - base64  : JSON, chaque vecteur en octets little-endian encodés en base64
+  - raw     : application/octet-stream, matrice contiguë little-endian
+  - npy     : application/x-npy, fichier .npy (np.load)
+La forme et le dtype sont renvoyés dans les en-têtes X-Embedding-Shape et
+X-Embedding-Dtype, pour que le client puisse faire np.frombuffer directement.
+Pour les sorties quantifiées, X-Embedding-Quantization donne le type demandé
+et, en int8, X-Embedding-Scale / X-Embedding-Offset les paramètres de
+décodage (float32 little-endian en base64).
+"""
+
+import base64
+import io
+
+import numpy as np
+
+FORMATS = ("json", "base64", "raw", "npy")
+MEDIA_TYPES = {
+    "raw": "application/octet-stream",
+    "npy": "application/x-npy",
+}
+_ACCEPT_FORMATS = {
+    "application/octet-stream": "raw",
+    "application/x-npy": "npy",
+    "application/npy": "npy",
+}
+
+
+def negotiate(accept, requested=None):
+    """Format de réponse : paramètre explicite, sinon premier type Accept connu."""
+    if requested:
+        return requested
+    for part in (accept or "").split(","):
+        media = part.split(";")[0].strip().lower()
+        if media in _ACCEPT_FORMATS:
+            return _ACCEPT_FORMATS[media]
+        if media in ("application/json", "*/*"):
+            return "json"
+    return "json"
+
+
+def little_endian(array):
+    """Matrice contiguë en ordre little-endian (no-op sur x86/ARM)."""
+    array = np.ascontiguousarray(array)
+    return array.astype(array.dtype.newbyteorder("<"), copy=False)
+
+
+def array_headers(array, model_name=None, output_dtype=None, quantization=None):
+    array = little_endian(array)
+    headers = {
+        "X-Embedding-Shape": ",".join(str(n) for n in array.shape),
+        "X-Embedding-Dtype": array.dtype.str,
+    }
+    if model_name:
+        headers["X-Embedding-Model"] = model_name
+    if output_dtype:
+        headers["X-Embedding-Quantization"] = output_dtype
+    if quantization and "scale" in quantization:
+        headers["X-Embedding-Scale"] = to_base64(np.asarray(quantization["scale"], dtype=np.float32))
+        headers["X-Embedding-Offset"] = to_base64(np.asarray(quantization["offset"], dtype=np.float32))
+    if quantization and "bits" in quantization:
+        headers["X-Embedding-Bits"] = str(quantization["bits"])
+    return headers
+
+
+def to_bytes(array, fmt):
+    """Corps binaire (raw ou npy) d'une matrice d'embeddings."""
+    array = little_endian(array)
+    if fmt == "npy":
+        buf = io.BytesIO()
+        np.save(buf, array, allow_pickle=False)
+        return buf.getvalue()
+    return array.tobytes()
+
+
+def to_base64(vector):
+    return base64.b64encode(little_endian(vector).tobytes()).decode("ascii")
@@ -0,0 +1,626 @@
+# embedding_index.py
+"""
+Index vectoriel en mémoire du processus, sur une matrice float32 mappée.
+
+Pour les recherches où l'aller-retour vers pgvector coûte trop cher, le
+corpus (quelques millions x 384 en float32) tient en RAM. Il est stocké dans
+un instantané : vectors.npy, ouvert avec np.load(mmap_mode="r"), de sorte
+que les workers gunicorn partagent les mêmes pages du cache disque.
+
+Répertoire d'un modèle :
+
+    CURRENT                 nom de l'instantané en service
+    LOCK                    verrou (flock) des ajouts et des bascules
+    snap-<horodatage>/
+        manifest.json       nombre de lignes, dimension, IVF ou non
+        vectors.npy         vecteurs normalisés (L2), rangés par liste IVF
+        ids.bin             identifiants UTF-8 concaténés...
+        ids_offsets.npy     ...et leurs bornes (N + 1 entiers)
+        ids_order.npy       lignes triées par identifiant (recherche d'un id)
+        centroids.npy       centroïdes IVF (nlist, dim)          [IVF]
+        lists.npy           bornes des listes dans vectors.npy   [IVF]
+        delta.f32           vecteurs ajoutés depuis l'instantané
+        delta.ids           leurs identifiants, un par ligne
+
+Recherche (produit scalaire = cosinus, les vecteurs étant normalisés) :
+exacte par blocs de lignes, ou IVF — les vecteurs d'une liste étant
+contigus, une liste sondée est une simple tranche de la matrice. Les ajouts
+(delta) sont toujours parcourus exactement ; un id ajouté remplace celui de
+l'instantané, dont la ligne est masquée (score -inf) avant la sélection des k
+meilleurs. Un nouvel instantané fusionne instantané et delta, réentraîne
+éventuellement les centroïdes (KMeans de scikit-learn) et bascule CURRENT ;
+les ajouts faits pendant la reconstruction passent dans le nouveau delta.
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import numpy as np
+
+SEARCH_BLOCK_ROWS = 65536
+
+
+class IndexMismatchError(Exception):
+    """Levée quand l'instantané sur disque a été construit pour un autre modèle."""
+
+
+class IndexBusyError(Exception):
+    """Levée quand un autre processus reconstruit déjà l'instantané."""
+
+
+def index_dir(directory, model_name):
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name).strip("_")
+    return os.path.join(directory, slug)
+
+
+def snapshot_name():
+    return f"snap-{time.strftime('%Y%m%dT%H%M%S')}-{time.time_ns() % 10**9:09d}"
+
+
+def write_snapshot(path, model_name, dims, count, fill_vectors=None, ids=(), centroids=None, lists=None, extra=None):
+    """Écrit les fichiers d'un instantané ; fill_vectors(out) remplit vectors.npy (mmap)."""
+    os.makedirs(path)
+    if count:
+        out = np.lib.format.open_memmap(os.path.join(path, "vectors.npy"), mode="w+", dtype="<f4", shape=(count, dims))
+        fill_vectors(out)
+        out.flush()
+        del out
+        encoded = [i.encode("utf-8") for i in ids]
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        with open(os.path.join(path, "ids.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(path, "ids_offsets.npy"), offsets)
+        np.save(os.path.join(path, "ids_order.npy"), id_order(encoded))
+    if centroids is not None:
+        np.save(os.path.join(path, "centroids.npy"), centroids)
+        np.save(os.path.join(path, "lists.npy"), lists)
+    manifest = {
+        "model": model_name,
+        "count": count,
+        "dims": dims,
+        "ivf": centroids is not None,
+        "nlist": None if centroids is None else len(centroids),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        **(extra or {}),
+    }
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    for name in ("delta.f32", "delta.ids"):
+        open(os.path.join(path, name), "ab").close()
+
+
+def id_order(encoded):
+    """Lignes triées par identifiant (octets UTF-8, même ordre que les chaînes)."""
+    return np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), np.float32(1e-12))
+
+
+def top_k(scores, k):
+    """Indices des k meilleurs scores d'un vecteur, triés (argpartition puis tri des k)."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    part = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def top_k_rows(scores, k):
+    """top_k ligne par ligne d'une matrice (requêtes x candidats) : argpartition (O(n)) puis tri des k seuls."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+class Snapshot:
+    """Fichiers d'un instantané, ouverts en lecture seule (mmap)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.count = self.manifest["count"]
+        self.dims = self.manifest["dims"]
+        if self.count:
+            self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+            self.id_offsets = np.load(os.path.join(path, "ids_offsets.npy"), mmap_mode="r")
+            self.id_blob = np.memmap(os.path.join(path, "ids.bin"), dtype=np.uint8, mode="r")
+        else:
+            self.vectors = np.empty((0, self.dims), dtype=np.float32)
+            self.id_offsets = np.zeros(1, dtype=np.int64)
+            self.id_blob = np.empty(0, dtype=np.uint8)
+        self.centroids = self.lists = None
+        if self.manifest.get("ivf"):
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.lists = np.load(os.path.join(path, "lists.npy"))
+        self.created = os.path.getmtime(os.path.join(path, "manifest.json"))
+        self._order = None
+
+    def _id_bytes(self, row):
+        return self.id_blob[int(self.id_offsets[row]):int(self.id_offsets[row + 1])].tobytes()
+
+    def id(self, row):
+        return self._id_bytes(row).decode("utf-8")
+
+    def row_of(self, id):
+        """Ligne d'un identifiant (recherche dichotomique dans ids_order), ou None."""
+        if self._order is None:
+            order_path = os.path.join(self.path, "ids_order.npy")
+            if os.path.exists(order_path):
+                self._order = np.load(order_path, mmap_mode="r")
+            else:
+                # Instantané écrit sans ids_order.npy : tri fait une fois, en mémoire
+                self._order = id_order([self._id_bytes(r) for r in range(self.count)])
+        key, order = id.encode("utf-8"), self._order
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_bytes(order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._id_bytes(order[lo]) == key:
+            return int(order[lo])
+        return None
+
+    def ids(self, start=0, end=None):
+        end = self.count if end is None else end
+        blob = self.id_blob[int(self.id_offsets[start]):int(self.id_offsets[end])].tobytes()
+        base = int(self.id_offsets[start])
+        offsets = self.id_offsets[start:end + 1] - base
+        return [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(end - start)]
+
+
+class DeltaState:
+    """Contenu du delta à un instant donné ; jamais modifié, remplacé en bloc par Delta.refresh."""
+
+    def __init__(self, ids, rows, vectors, shadowed):
+        self.ids = ids
+        # id -> dernière ligne (un id ajouté deux fois garde son dernier vecteur)
+        self.rows = rows
+        self.vectors = vectors
+        # Lignes en vigueur (dernière occurrence de chaque id), dans l'ordre d'ajout
+        self.live = np.array(sorted(rows.values()), dtype=np.int64)
+        # Lignes de l'instantané remplacées par un ajout (triées)
+        self.shadowed = shadowed
+
+
+class Delta:
+    """Ajouts depuis l'instantané, relus par incréments depuis les fichiers partagés.
+
+    Les recherches lisent delta.state une fois : refresh construit un nouvel
+    état et le publie en une affectation, sans verrou côté lecteurs.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.vectors_path = os.path.join(snapshot.path, "delta.f32")
+        self.ids_path = os.path.join(snapshot.path, "delta.ids")
+        self.dims = snapshot.dims
+        self.state = DeltaState((), {}, np.empty((0, self.dims), dtype=np.float32), np.empty(0, dtype=np.int64))
+        self._vector_bytes = 0
+        self._id_bytes = 0
+
+    def refresh(self):
+        """Charge les lignes écrites depuis le dernier appel (à faire sous verrou partagé)."""
+        state = self.state
+        row_bytes = 4 * self.dims
+        new = os.path.getsize(self.vectors_path) // row_bytes - len(state.ids)
+        if new <= 0:
+            return state
+        with open(self.ids_path, "rb") as f:
+            f.seek(self._id_bytes)
+            lines = f.read().split(b"\n")[:new]
+        with open(self.vectors_path, "rb") as f:
+            f.seek(self._vector_bytes)
+            fresh = np.frombuffer(f.read(new * row_bytes), dtype="<f4").reshape(new, self.dims)
+        self._id_bytes += sum(len(line) + 1 for line in lines)
+        self._vector_bytes += new * row_bytes
+        fresh_ids = tuple(line.decode("utf-8") for line in lines)
+        rows = dict(state.rows)
+        shadowed = []
+        for n, i in enumerate(fresh_ids):
+            if i not in rows:
+                row = self.snapshot.row_of(i)
+                if row is not None:
+                    shadowed.append(row)
+            rows[i] = len(state.ids) + n
+        self.state = DeltaState(
+            state.ids + fresh_ids,
+            rows,
+            np.concatenate([state.vectors, fresh.astype(np.float32)]),
+            np.union1d(state.shadowed, np.array(shadowed, dtype=np.int64)),
+        )
+        return self.state
+
+
+class MmapIndex:
+    """Index d'un modèle : instantané mappé + delta, rechargés quand CURRENT change."""
+
+    def __init__(self, directory, model_name, dims, nprobe=8):
+        self.directory = directory
+        self.model_name = model_name
+        self.dims = int(dims)
+        self.nprobe = int(nprobe)
+        self.snapshot = None
+        self.delta = None
+        self._current_mtime = None
+        self._lock = threading.Lock()
+        self.building = False
+        self.last_build = None
+        os.makedirs(directory, exist_ok=True)
+        with self._file_lock(fcntl.LOCK_EX):
+            if not os.path.exists(os.path.join(directory, "CURRENT")):
+                name = snapshot_name()
+                write_snapshot(os.path.join(directory, name), model_name, self.dims, 0)
+                self._switch(name)
+
+    # --- fichiers partagés -------------------------------------------------
+
+    @contextmanager
+    def _file_lock(self, mode, name="LOCK"):
+        with open(os.path.join(self.directory, name), "a") as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _switch(self, name, keep=2):
+        # Appelé sous verrou exclusif : remplacement atomique de CURRENT. Les
+        # instantanés plus anciens que le précédent sont supprimés (un worker
+        # qui les a encore mappés garde ses pages jusqu'à son rechargement)
+        tmp = os.path.join(self.directory, "CURRENT.tmp")
+        with open(tmp, "w") as f:
+            f.write(name)
+        os.replace(tmp, os.path.join(self.directory, "CURRENT"))
+        snapshots = sorted(d for d in os.listdir(self.directory) if d.startswith("snap-"))
+        for old in snapshots[:-keep]:
+            if old != name:
+                shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+
+    def _current_name(self):
+        with open(os.path.join(self.directory, "CURRENT")) as f:
+            return f.read().strip()
+
+    def refresh(self):
+        """Recharge l'instantané si CURRENT a changé, puis lit les nouveaux ajouts."""
+        mtime = os.stat(os.path.join(self.directory, "CURRENT")).st_mtime_ns
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            if mtime != self._current_mtime or self.snapshot is None:
+                snapshot = Snapshot(os.path.join(self.directory, self._current_name()))
+                if snapshot.dims != self.dims or snapshot.manifest.get("model") != self.model_name:
+                    raise IndexMismatchError(f"Index in {self.directory} was built for another model or dimension")
+                self.snapshot, self.delta = snapshot, Delta(snapshot)
+                self._current_mtime = mtime
+            self.delta.refresh()
+        return self.snapshot, self.delta
+
+    # --- ajouts ------------------------------------------------------------
+
+    def append(self, ids, vectors):
+        """Ajoute (ou remplace) des vecteurs ; visibles par tous les workers à leur prochaine recherche."""
+        vectors = normalize(vectors)
+        if vectors.shape[1] != self.dims:
+            raise ValueError(f"Expected {self.dims}-dim vectors, got {vectors.shape[1]}")
+        if any("\n" in i or not i for i in ids):
+            raise ValueError("ids must be non-empty and must not contain newlines")
+        payload_ids = "".join(i + "\n" for i in ids).encode("utf-8")
+        payload = np.ascontiguousarray(vectors, dtype="<f4").tobytes()
+        with self._file_lock(fcntl.LOCK_EX):
+            path = os.path.join(self.directory, self._current_name())
+            # Identifiants d'abord : un lecteur ne compte que les lignes dont le vecteur est écrit
+            with open(os.path.join(path, "delta.ids"), "ab") as f:
+                f.write(payload_ids)
+            with open(os.path.join(path, "delta.f32"), "ab") as f:
+                f.write(payload)
+        return len(ids)
+
+    # --- recherche ---------------------------------------------------------
+
+    @staticmethod
+    def _scan(matrix, queries, k, offset=0, shadowed=None):
+        """(scores, lignes) des k meilleurs pour chaque requête, matrices (requêtes, <= k).
+
+        La matrice est lue une fois, par blocs de lignes, pour toutes les requêtes ;
+        les lignes shadowed (numérotées depuis offset) reçoivent un score -inf.
+        """
+        best_scores, best_rows = [], []
+        for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + SEARCH_BLOCK_ROWS])
+            scores = queries @ block.T
+            if shadowed is not None and len(shadowed):
+                lo, hi = np.searchsorted(shadowed, [offset + start, offset + start + len(block)])
+                scores[:, shadowed[lo:hi] - offset - start] = -np.inf
+            rows = top_k_rows(scores, k)
+            best_scores.append(np.take_along_axis(scores, rows, axis=1))
+            best_rows.append(rows + start + offset)
+        if not best_scores:
+            return np.empty((len(queries), 0), np.float32), np.empty((len(queries), 0), np.int64)
+        scores, rows = np.concatenate(best_scores, axis=1), np.concatenate(best_rows, axis=1)
+        keep = top_k_rows(scores, k)
+        return np.take_along_axis(scores, keep, axis=1), np.take_along_axis(rows, keep, axis=1)
+
+    def search(self, queries, k=10, mode="auto", nprobe=None):
+        """Pour chaque requête, liste de (id, score) triée ; mode "exact", "ivf" ou "auto"."""
+        snapshot, delta = self.refresh()
+        # Un seul état du delta pour toute la recherche, même si un ajout arrive entre-temps
+        state = delta.state
+        queries = normalize(np.atleast_2d(queries))
+        if mode == "auto":
+            mode = "ivf" if snapshot.centroids is not None else "exact"
+        if mode == "ivf" and snapshot.centroids is None:
+            raise ValueError("The current snapshot has no IVF lists (rebuild it with ivf=true)")
+        nprobe = min(int(nprobe or self.nprobe), len(snapshot.centroids)) if mode == "ivf" else None
+        if mode == "exact":
+            all_scores, all_rows = self._scan(snapshot.vectors, queries, k, shadowed=state.shadowed)
+        delta_scores = state.vectors[state.live] @ queries.T if len(state.live) else None
+        results = []
+        for n, query in enumerate(queries):
+            if mode == "ivf":
+                # Listes sondées : tranches contiguës de la matrice
+                parts = [
+                    self._scan(snapshot.vectors[snapshot.lists[p]:snapshot.lists[p + 1]], query[None], k,
+                               snapshot.lists[p], state.shadowed)
+                    for p in top_k(snapshot.centroids @ query, nprobe)
+                ]
+                scores = np.concatenate([s[0] for s, _ in parts])
+                rows = np.concatenate([r[0] for _, r in parts])
+                keep = top_k(scores, k)
+                scores, rows = scores[keep], rows[keep]
+            else:
+                scores, rows = all_scores[n], all_rows[n]
+            # Lignes masquées retenues faute de candidats (moins de k lignes sondées)
+            finite = np.isfinite(scores)
+            scores, rows = scores[finite], rows[finite]
+            if delta_scores is not None:
+                # Fusion avec les k meilleurs ajouts ; seuls les k gagnants sont décodés
+                best_delta = top_k(delta_scores[:, n], k)
+                scores = np.concatenate([scores, delta_scores[best_delta, n]])
+                winners = top_k(scores, k)
+                matches = [
+                    (snapshot.id(rows[j]) if j < len(rows) else state.ids[state.live[best_delta[j - len(rows)]]],
+                     float(scores[j]))
+                    for j in winners
+                ]
+            else:
+                matches = [(snapshot.id(row), float(score)) for score, row in zip(scores, rows)]
+            results.append(matches)
+        return results, {"mode": mode, "nprobe": nprobe}
+
+    def rebuild_due(self, max_delta_rows=0, max_age=0):
+        """Motif d'une reconstruction ("delta_rows" ou "age"), ou None.
+
+        max_delta_rows : ajouts en attente ; max_age : âge (secondes) de
+        l'instantané quand des ajouts attendent. 0 désactive le critère.
+        """
+        snapshot, delta = self.refresh()
+        pending = len(delta.state.rows)
+        if max_delta_rows and pending >= max_delta_rows:
+            return "delta_rows"
+        if max_age and pending and time.time() - snapshot.created >= max_age:
+            return "age"
+        return None
+
+    # --- instantanés -------------------------------------------------------
+
+    def builder(self):
+        return SnapshotBuilder(self)
+
+    def stats(self):
+        snapshot, delta = self.refresh()
+        state = delta.state
+        return {
+            "snapshot": snapshot.name,
+            "rows": snapshot.count,
+            "delta_rows": len(state.rows),
+            "shadowed_rows": len(state.shadowed),
+            "dims": self.dims,
+            "ivf": snapshot.centroids is not None,
+            "nlist": None if snapshot.centroids is None else len(snapshot.centroids),
+            "nprobe": self.nprobe,
+            "mapped_bytes": int(snapshot.vectors.nbytes),
+            "created_at": snapshot.manifest.get("created_at"),
+            "building": self.building,
+            "last_build": self.last_build,
+        }
+
+
+class SnapshotBuilder:
+    """Construit un nouvel instantané : lignes de base (instantané courant ou
+    table), puis ajouts du delta, normalisation, listes IVF, bascule."""
+
+    def __init__(self, index):
+        self.index = index
+        self.dims = index.dims
+        # Une seule reconstruction à la fois, tous processus confondus
+        self._build_lock = open(os.path.join(index.directory, "BUILD"), "a")
+        try:
+            fcntl.flock(self._build_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._build_lock.close()
+            raise IndexBusyError("A snapshot rebuild is already running")
+        self.staging = os.path.join(index.directory, f"staging-{os.getpid()}")
+        shutil.rmtree(self.staging, ignore_errors=True)
+        os.makedirs(self.staging)
+        self._vectors = open(os.path.join(self.staging, "vectors.f32"), "wb")
+        self.ids = []
+        snapshot, _ = index.refresh()
+        self.source = snapshot
+        # Ajouts pris en compte : ceux présents maintenant ; les suivants iront au nouveau delta
+        with index._file_lock(fcntl.LOCK_SH):
+            self.delta = Delta(snapshot).refresh()
+        self.delta_count = len(self.delta.ids)
+
+    def add(self, ids, vectors):
+        """Lignes de base ; celles dont l'id a été ajouté depuis (delta) sont ignorées."""
+        keep = [n for n, i in enumerate(ids) if i not in self.delta.rows]
+        if not keep:
+            return
+        vectors = normalize(np.asarray(vectors)[keep])
+        self._vectors.write(np.ascontiguousarray(vectors, dtype="<f4").tobytes())
+        self.ids.extend(ids[n] for n in keep)
+
+    def add_current(self):
+        """Reprend les lignes de l'instantané courant."""
+        snapshot = self.source
+        for start in range(0, snapshot.count, SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, snapshot.count)
+            self.add(snapshot.ids(start, end), snapshot.vectors[start:end])
+
+    def finish(self, ivf=False, nlist=None, train_size=None, seed=0):
+        index = self.index
+        started = time.monotonic()
+        live = self.delta.live
+        if len(live):
+            self._vectors.write(np.ascontiguousarray(self.delta.vectors[live], dtype="<f4").tobytes())
+            self.ids.extend(self.delta.ids[r] for r in live)
+        self._vectors.close()
+        count = len(self.ids)
+        raw = np.memmap(os.path.join(self.staging, "vectors.f32"), dtype="<f4", mode="r", shape=(count, self.dims)) \
+            if count else np.empty((0, self.dims), np.float32)
+        centroids = lists = None
+        order = np.arange(count)
+        if ivf and count:
+            centroids, labels = train_ivf(raw, nlist or default_nlist(count), train_size, seed)
+            order = np.argsort(labels, kind="stable")
+            lists = np.searchsorted(labels[order], np.arange(len(centroids) + 1)).astype(np.int64)
+        name = self._write(raw, order, centroids, lists, count, started)
+        self.close()
+        index.last_build = {"snapshot": name, "rows": count, "ivf": centroids is not None,
+                            "seconds": round(time.monotonic() - started, 3)}
+        return index.last_build
+
+    def _write(self, raw, order, centroids, lists, count, started):
+        index = self.index
+        name = snapshot_name()
+        path = os.path.join(index.directory, name)
+
+        def fill(out):
+            for start in range(0, count, SEARCH_BLOCK_ROWS):
+                out[start:start + SEARCH_BLOCK_ROWS] = raw[order[start:start + SEARCH_BLOCK_ROWS]]
+
+        write_snapshot(path, index.model_name, self.dims, count, fill, [self.ids[r] for r in order],
+                       centroids, lists, {"build_seconds": round(time.monotonic() - started, 3)})
+        with index._file_lock(fcntl.LOCK_EX):
+            # Ajouts arrivés pendant la reconstruction : recopiés dans le nouveau delta
+            old = os.path.join(index.directory, index._current_name())
+            row_bytes = 4 * self.dims
+            with open(os.path.join(old, "delta.ids"), "rb") as f:
+                pending_ids = f.read().split(b"\n")[self.delta_count:-1]
+            with open(os.path.join(old, "delta.f32"), "rb") as f:
+                f.seek(self.delta_count * row_bytes)
+                pending = f.read(len(pending_ids) * row_bytes)
+            with open(os.path.join(path, "delta.ids"), "wb") as f:
+                f.write(b"".join(i + b"\n" for i in pending_ids))
+            with open(os.path.join(path, "delta.f32"), "wb") as f:
+                f.write(pending)
+            index._switch(name)
+        return name
+
+    def close(self):
+        """Libère le verrou de reconstruction et supprime les fichiers temporaires."""
+        if self._build_lock.closed:
+            return
+        if not self._vectors.closed:
+            self._vectors.close()
+        shutil.rmtree(self.staging, ignore_errors=True)
+        fcntl.flock(self._build_lock, fcntl.LOCK_UN)
+        self._build_lock.close()
+
+
+def default_nlist(count):
+    return max(1, min(65536, int(4 * np.sqrt(count))))
+
+
+def train_ivf(vectors, nlist, train_size=None, seed=0):
+    """Centroïdes (KMeans sur un échantillon, normalisés) et liste de chaque ligne."""
+    from sklearn.cluster import KMeans
+
+    nlist = min(int(nlist), len(vectors))
+    train_size = min(len(vectors), int(train_size or max(256 * nlist, 10000)))
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), train_size, replace=False))])
+    kmeans = KMeans(n_clusters=nlist, n_init=1, max_iter=25, random_state=seed).fit(sample)
+    centroids = normalize(kmeans.cluster_centers_)
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+        labels[start:start + SEARCH_BLOCK_ROWS] = np.argmax(
+            np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS]) @ centroids.T, axis=1
+        )
+    return centroids.astype(np.float32), labels
+
+
+async def build_from_table(index, database_url, table, batch_size=4096, **options):
+    """Instantané reconstruit depuis une table pgvector (hors serveur)."""
+    import psycopg
+
+    from embedding_clustering import scan_vectors
+
+    @asynccontextmanager
+    async def connection():
+        async with await psycopg.AsyncConnection.connect(database_url, autocommit=True) as conn:
+            yield conn
+
+    builder = index.builder()
+    try:
+        async for ids, vectors in scan_vectors(connection, table, batch_size):
+            builder.add(ids, vectors)
+        return builder.finish(**options)
+    finally:
+        builder.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and inspect the in-process mmap vector index")
+    parser.add_argument("--dir", default=os.getenv("LOCAL_INDEX_DIR", "local_index"))
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+                        help="model id; suffix @onnx or @onnx-int8 for artifacts of the onnx backend")
+    parser.add_argument("--dims", type=int, required=True)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("info", help="print the current snapshot")
+    build = sub.add_parser("build", help="rebuild the snapshot from the current one (+ appends) or a table")
+    build.add_argument("--from-table", help="pgvector table to load instead of the current snapshot")
+    build.add_argument("--ivf", action="store_true", help="train IVF lists (scikit-learn KMeans)")
+    build.add_argument("--nlist", type=int, default=None, help="number of IVF lists (default 4 * sqrt(rows))")
+    build.add_argument("--train-size", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    index = MmapIndex(index_dir(args.dir, args.model), args.model, args.dims)
+    if args.command == "build":
+        options = {"ivf": args.ivf, "nlist": args.nlist, "train_size": args.train_size}
+        if args.from_table:
+            asyncio.run(build_from_table(index, os.environ["DATABASE_URL"], args.from_table, **options))
+        else:
+            builder = index.builder()
+            try:
+                builder.add_current()
+                builder.finish(**options)
+            finally:
+                builder.close()
+    report = index.stats()
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+# embedding_ipc.py
+"""
+Topologie "un seul processus d'inférence" (INFERENCE_MODE=shared).
+
+Un processus dédié possède le SentenceTransformer et la file de
+micro-batching ; les workers HTTP ne chargent pas le modèle. Chaque worker
+crée un segment de mémoire partagée découpé en slots (zone texte + zone
+vecteur) et ouvre une socket Unix vers le processus d'inférence :
+
+  1. le worker écrit le texte UTF-8 dans un slot libre ;
+  2. il envoie l'en-tête (slot, longueur) sur la socket ;
+  3. le processus d'inférence ajoute le texte à son micro-batcher, qui
+     regroupe les requêtes de tous les workers en une seule passe avant ;
+  4. il écrit le vecteur float32 dans le slot et renvoie (slot, statut).
+
+Seuls quelques octets d'en-tête transitent par la socket ; textes et
+vecteurs passent par la mémoire partagée.
+
+Lancement (fait automatiquement par gunicorn.conf.py en mode shared) :
+
+    python embedding_ipc.py serve
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from embedding_batcher import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+REQUEST = struct.Struct("<II")  # slot, longueur du texte
+RESPONSE = struct.Struct("<III")  # slot, statut, longueur du message d'erreur
+STATUS_OK, STATUS_ERROR, STATUS_QUEUE_FULL = 0, 1, 2
+# Slot réservé : demande des statistiques du processus d'inférence (réponse JSON)
+STATS_SLOT = 0xFFFFFFFF
+
+
+class InferenceError(Exception):
+    """Erreur renvoyée par le processus d'inférence pour une requête."""
+
+
+class InferenceUnavailableError(InferenceError):
+    """Processus d'inférence injoignable (arrêté, en redémarrage) ou muet au-delà du délai."""
+
+
+class SlotLayout:
+    """Découpage du segment partagé : slots de text_bytes octets puis dim float32."""
+
+    def __init__(self, slots, text_bytes, dim):
+        self.slots = int(slots)
+        self.text_bytes = int(text_bytes)
+        self.dim = int(dim)
+        self.slot_bytes = self.text_bytes + 4 * self.dim
+
+    @property
+    def size(self):
+        return self.slots * self.slot_bytes
+
+    def text_view(self, buf, slot):
+        start = slot * self.slot_bytes
+        return buf[start:start + self.text_bytes]
+
+    def vector_view(self, buf, slot):
+        start = slot * self.slot_bytes + self.text_bytes
+        return np.ndarray((self.dim,), dtype="<f4", buffer=buf, offset=start)
+
+
+def truncate_utf8(encoded, limit):
+    """Coupe à limit octets sans laisser de caractère UTF-8 tronqué."""
+    if len(encoded) <= limit:
+        return encoded
+    return encoded[:limit].decode("utf-8", errors="ignore").encode("utf-8")
+
+
+class _Connection:
+    """Une connexion au processus d'inférence et son segment partagé."""
+
+    def __init__(self, reader, writer, shm, layout):
+        self.reader = reader
+        self.writer = writer
+        self.shm = shm
+        self.layout = layout
+        self.free = asyncio.Queue()
+        for slot in range(layout.slots):
+            self.free.put_nowait(slot)
+        self.pending = {}
+        self.stats_waiters = []
+        self.task = None
+        self.closed = False
+
+    def close(self, error):
+        """Échoue les attentes en cours ; le segment est libéré après la lecture."""
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        for future in list(self.pending.values()) + self.stats_waiters:
+            if not future.done():
+                future.set_exception(error)
+        # Réveille les appelants en attente d'un slot : ils voient closed et abandonnent
+        for slot in self.pending:
+            self.free.put_nowait(slot)
+        self.pending.clear()
+        self.stats_waiters.clear()
+
+
+class InferenceClient:
+    """Côté worker HTTP : même interface que MicroBatcher (start/stop/submit).
+
+    Si la connexion tombe (processus d'inférence arrêté ou redémarré), les
+    requêtes en cours échouent avec InferenceUnavailableError et la requête
+    suivante tente de se reconnecter ; chaque requête est bornée par
+    request_timeout.
+    """
+
+    def __init__(self, socket_path, slots=256, text_bytes=32768, connect_timeout=120.0, request_timeout=60.0):
+        self.socket_path = socket_path
+        self.slots = int(slots)
+        self.text_bytes = int(text_bytes)
+        self.connect_timeout = float(connect_timeout)
+        self.request_timeout = float(request_timeout) if request_timeout else None
+        self.dim = None
+        self.model_name = None
+        self.max_seq_length = None
+        self.reconnects = 0
+        self._conn = None
+        self._lock = None
+        self._started = False
+
+    @property
+    def connected(self):
+        return self._conn is not None and not self._conn.closed
+
+    async def _open(self, timeout):
+        # Le processus d'inférence peut encore être en train de charger le modèle
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
+
+    async def _connect(self, timeout):
+        reader, writer = await self._open(timeout)
+        shm = None
+        try:
+            hello = json.loads(await reader.readline())
+            if self.dim is not None and hello["dim"] != self.dim:
+                raise InferenceError(f"Inference process dimension changed: {self.dim} -> {hello['dim']}")
+            self.dim, self.model_name = hello["dim"], hello["model"]
+            self.max_seq_length = hello.get("max_seq_length")
+            # Segment neuf à chaque connexion : une réponse tardive destinée à
+            # l'ancienne connexion ne peut pas écraser un slot réattribué
+            layout = SlotLayout(self.slots, self.text_bytes, self.dim)
+            shm = shared_memory.SharedMemory(create=True, size=layout.size)
+            writer.write(
+                (json.dumps({"shm": shm.name, "slots": self.slots, "text_bytes": self.text_bytes}) + "\n").encode()
+            )
+            await writer.drain()
+            ack = json.loads(await reader.readline())
+            if not ack.get("ok"):
+                raise InferenceError(ack.get("error", "handshake failed"))
+        except BaseException:
+            writer.close()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            raise
+        conn = _Connection(reader, writer, shm, layout)
+        conn.task = asyncio.create_task(self._read_responses(conn))
+        self._conn = conn
+
+    async def start(self):
+        if self._started:
+            return
+        self._lock = asyncio.Lock()
+        await self._connect(self.connect_timeout)
+        self._started = True
+
+    async def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close(InferenceUnavailableError("Inference client stopped"))
+            conn.task.cancel()
+            await asyncio.gather(conn.task, return_exceptions=True)
+
+    async def _connection(self):
+        """Connexion active, rétablie au besoin (un seul essai, sans attendre le modèle)."""
+        if not self._started:
+            raise RuntimeError("Inference client not started")
+        if self.connected:
+            return self._conn
+        async with self._lock:
+            if not self.connected:
+                try:
+                    await asyncio.wait_for(self._connect(0), self.connect_timeout)
+                except (OSError, ValueError, KeyError, asyncio.TimeoutError) as e:
+                    raise InferenceUnavailableError(f"Inference process unavailable: {e!r}") from e
+                self.reconnects += 1
+                logger.info("Reconnected to the inference process on %s", self.socket_path)
+        return self._conn
+
+    def qsize(self):
+        return len(self._conn.pending) if self._conn is not None else 0
+
+    async def _read_responses(self, conn):
+        error = InferenceUnavailableError("Inference process disconnected")
+        try:
+            while True:
+                slot, status, length = RESPONSE.unpack(await conn.reader.readexactly(RESPONSE.size))
+                message = (await conn.reader.readexactly(length)).decode() if length else ""
+                if slot == STATS_SLOT:
+                    if conn.stats_waiters:
+                        future = conn.stats_waiters.pop(0)
+                        if not future.done():
+                            future.set_result(json.loads(message))
+                    continue
+                future = conn.pending.pop(slot, None)
+                if future is None:
+                    continue
+                if not future.done():
+                    if status == STATUS_QUEUE_FULL:
+                        future.set_exception(QueueFullError(message))
+                    elif status:
+                        future.set_exception(InferenceError(message))
+                    else:
+                        # Copie : le slot est réutilisé dès qu'il est libéré
+                        future.set_result(conn.layout.vector_view(conn.shm.buf, slot).copy())
+                # Le slot n'est libéré qu'à réception de la réponse, même si
+                # l'appelant a abandonné : le processus d'inférence peut encore y écrire
+                conn.free.put_nowait(slot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Fin de flux, connexion réinitialisée, réponse illisible : la
+            # connexion est perdue, le prochain appel en ouvrira une autre
+            if not isinstance(e, asyncio.IncompleteReadError):
+                error = InferenceUnavailableError(f"Inference process connection lost: {e!r}")
+            logger.warning("Inference process connection lost (%d requests pending): %r", len(conn.pending), e)
+        finally:
+            conn.close(error)
+            conn.shm.close()
+            conn.shm.unlink()
+
+    async def _submit(self, text):
+        conn = await self._connection()
+        encoded = truncate_utf8(text.encode("utf-8"), self.text_bytes)
+        slot = await conn.free.get()
+        try:
+            if conn.closed:
+                raise InferenceUnavailableError("Inference process disconnected")
+            conn.layout.text_view(conn.shm.buf, slot)[:len(encoded)] = encoded
+            future = asyncio.get_running_loop().create_future()
+            conn.pending[slot] = future
+            conn.writer.write(REQUEST.pack(slot, len(encoded)))
+        except BaseException:
+            conn.pending.pop(slot, None)
+            conn.free.put_nowait(slot)
+            raise
+        return await future
+
+    async def submit(self, text):
+        try:
+            return await asyncio.wait_for(self._submit(text), self.request_timeout)
+        except asyncio.TimeoutError:
+            raise InferenceUnavailableError(f"No answer from the inference process within {self.request_timeout}s")
+
+    async def stats(self):
+        """Statistiques du processus d'inférence (regroupement par longueur)."""
+        conn = await self._connection()
+        future = asyncio.get_running_loop().create_future()
+        conn.stats_waiters.append(future)
+        conn.writer.write(REQUEST.pack(STATS_SLOT, 0))
+        try:
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            raise InferenceUnavailableError(f"No answer from the inference process within {self.request_timeout}s")
+
+    async def encode_many(self, texts):
+        """Tous les textes partent en parallèle ; le processus d'inférence les regroupe."""
+        vectors = await asyncio.gather(*(self.submit(text) for text in texts))
+        if not vectors:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.stack(vectors)
+
+
+class InferenceServer:
+    """Côté processus d'inférence : une connexion par worker HTTP."""
+
+    def __init__(self, batcher, dim, model_name, stats_fn=None, max_seq_length=None):
+        self.batcher = batcher
+        self.dim = int(dim)
+        self.model_name = model_name
+        self.max_seq_length = max_seq_length
+        self.stats_fn = stats_fn
+
+    async def handle(self, reader, writer):
+        shm = None
+        tasks = set()
+        try:
+            hello = {"dim": self.dim, "model": self.model_name, "max_seq_length": self.max_seq_length}
+            writer.write((json.dumps(hello) + "\n").encode())
+            await writer.drain()
+            hello = json.loads(await reader.readline())
+            shm = shared_memory.SharedMemory(name=hello["shm"])
+            # Segment possédé par le worker : ne pas le laisser au resource_tracker local
+            resource_tracker.unregister(shm._name, "shared_memory")
+            layout = SlotLayout(hello["slots"], hello["text_bytes"], self.dim)
+            writer.write(b'{"ok": true}\n')
+            await writer.drain()
+            while True:
+                slot, length = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                if slot == STATS_SLOT:
+                    stats = self.stats_fn() if self.stats_fn is not None else {"enabled": False}
+                    message = json.dumps(stats).encode()
+                    writer.write(RESPONSE.pack(STATS_SLOT, 0, len(message)) + message)
+                    continue
+                text = bytes(layout.text_view(shm.buf, slot)[:length]).decode("utf-8")
+                task = asyncio.create_task(self._embed(writer, layout, shm, slot, text))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            if shm is not None:
+                shm.close()
+
+    async def _embed(self, writer, layout, shm, slot, text):
+        try:
+            vector = await self.batcher.submit(text)
+        except Exception as e:
+            # File pleine : statut distinct, le worker répond 429 et non 500
+            status = STATUS_QUEUE_FULL if isinstance(e, QueueFullError) else STATUS_ERROR
+            message = str(e).encode("utf-8")
+            writer.write(RESPONSE.pack(slot, status, len(message)) + message)
+            return
+        layout.vector_view(shm.buf, slot)[:] = vector
+        writer.write(RESPONSE.pack(slot, STATUS_OK, 0))
+
+
+async def serve(socket_path):
+    """Charge le modèle, démarre le micro-batcher et sert les workers HTTP."""
+    from sentence_transformers import SentenceTransformer
+
+    from cpu_budget import available_cores, configure_torch, thread_plan
+    from embedding_backends import create_encoder
+    from embedding_batcher import MicroBatcher
+
+    def flag(name, default="0"):
+        return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+    model_name = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+    normalize = flag("NORMALIZE_EMBEDDINGS")
+    max_size = int(os.getenv("MICROBATCH_MAX_SIZE", 64))
+    budget = int(os.getenv("CPU_BUDGET", 0)) or available_cores()
+    workers, threads = thread_plan(budget, os.getenv("INFERENCE_WORKERS"))
+    configure_torch(threads)
+
+    model = SentenceTransformer(model_name)
+    encoder = create_encoder(
+        model,
+        model_name,
+        os.getenv("EMBEDDING_BACKEND", "torch"),
+        cache_dir=os.getenv("ONNX_CACHE_DIR", "onnx_cache"),
+        quantize=flag("ONNX_QUANTIZE", "1"),
+        max_batch_tokens=int(os.getenv("BUCKET_MAX_TOKENS", 16384)) if flag("LENGTH_BUCKETING", "1") else None,
+        threads=threads,
+    )
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="inference")
+
+    async def encode(texts):
+        loop = asyncio.get_running_loop()
+        fn = partial(encoder.encode, texts, batch_size=max_size, normalize_embeddings=normalize)
+        return await loop.run_in_executor(executor, fn)
+
+    batcher = MicroBatcher(
+        encode,
+        max_batch_size=max_size,
+        max_wait_ms=float(os.getenv("MICROBATCH_MAX_WAIT_MS", 5)),
+        max_queue_size=int(os.getenv("MICROBATCH_MAX_QUEUE", 1024)),
+    )
+    await batcher.start()
+    def stats():
+        # Lues par /inference/stats et /metrics des workers HTTP
+        result = {
+            "pid": os.getpid(),
+            "microbatch": {
+                "batches": batcher.batches,
+                "items": batcher.items,
+                "queued": batcher.qsize(),
+                "queue_wait": batcher.queue_wait.snapshot(),
+                "batch_sizes": batcher.batch_sizes.snapshot(),
+            }
+        }
+        result["tokens"] = encoder.tokens
+        if hasattr(encoder, "stats"):
+            result["bucketing"] = encoder.stats()
+            result["pass_sizes"] = encoder.pass_sizes.snapshot()
+        return result
+
+    server = InferenceServer(
+        batcher,
+        model.get_sentence_embedding_dimension(),
+        model_name,
+        stats_fn=stats,
+        max_seq_length=model.max_seq_length,
+    )
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    unix_server = await asyncio.start_unix_server(server.handle, path=socket_path)
+    logger.info("Inference process serving %s on %s (%d passes x %d threads)", model_name, socket_path, workers, threads)
+    try:
+        async with unix_server:
+            await unix_server.serve_forever()
+    finally:
+        await batcher.stop()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dedicated inference process for INFERENCE_MODE=shared")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("serve")
+    run.add_argument("--socket", default=os.getenv("INFERENCE_SOCKET", "/tmp/sawem-inference.sock"))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+# embedding_jobs.py
+"""
+Jobs d'embedding asynchrones pour les gros corpus.
+
+Un job lit une source — table PostgreSQL (pagination par clé), requête SQL
+(si JOBS_ALLOW_SQL) ou fichier NDJSON/CSV déposé sur le serveur — encode
+les textes par lots et écrit les vecteurs par COPY binaire dans une table
+pgvector (id, embedding, metadata), en upsert.
+
+L'état vit dans la table embedding_jobs : chaque worker HTTP fait tourner un
+JobRunner qui réclame un job (FOR UPDATE SKIP LOCKED), enregistre après
+chaque lot le nombre de lignes faites et un point de reprise (dernière clé
+lue, ou nombre d'enregistrements du fichier), et entretient un heartbeat.
+Un job dont le worker a disparu (heartbeat trop ancien) est repris par un
+autre worker à partir de son point de reprise ; l'upsert rend sans effet la
+réécriture éventuelle du dernier lot.
+
+Le trafic interactif reste prioritaire : avant chaque sous-lot, le runner
+attend (au plus max_defer secondes) que wait_turn() lui rende la main.
+
+D'autres sortes de jobs (colonne kind, ex. "cluster") partagent la table et
+les runners : JobRunner les confie au handler enregistré pour leur kind.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+import numpy as np
+import psycopg
+from psycopg import sql
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+
+from ingest import PgVectorCopyWriter, iter_records
+from vector_store import qualified
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+
+
+class JobError(ValueError):
+    """Définition de job invalide."""
+
+
+def json_key(value):
+    # Point de reprise stocké en jsonb : entiers et textes tels quels, le reste en texte
+    return value if isinstance(value, (int, str)) else str(value)
+
+
+def validate_source(source, allow_sql=False):
+    kind = source.get("type")
+    if kind == "table":
+        if not source.get("table"):
+            raise JobError("table source requires 'table'")
+        for key in ("id_column", "text_column"):
+            if not isinstance(source.get(key, "x"), str):
+                raise JobError(f"'{key}' must be a column name")
+        if not all(isinstance(c, str) for c in source.get("metadata_columns") or []):
+            raise JobError("'metadata_columns' must be a list of column names")
+    elif kind == "query":
+        if not allow_sql:
+            raise JobError("SQL query sources are disabled (JOBS_ALLOW_SQL)")
+        if not source.get("sql"):
+            raise JobError("query source requires 'sql' returning id, text[, metadata]")
+    elif kind == "file":
+        if source.get("format") not in ("ndjson", "csv") or not source.get("path"):
+            raise JobError("file source requires 'path' and 'format'")
+    else:
+        raise JobError(f"Unknown source type: {kind}")
+    return source
+
+
+async def iter_query_rows(connection_factory, source, after, page_size):
+    """Lignes (id, text, metadata) par pages ordonnées sur l'id, à partir de after."""
+    if source["type"] == "table":
+        columns = [sql.Identifier(source.get("id_column", "id")), sql.Identifier(source.get("text_column", "text"))]
+        extra = source.get("metadata_columns") or []
+        relation = qualified(source["table"])
+        select = sql.SQL("SELECT {} FROM {}").format(
+            sql.SQL(", ").join(columns + [sql.Identifier(c) for c in extra]), relation
+        )
+        id_column = columns[0]
+    else:
+        extra = None
+        # La requête est insérée telle quelle : ses % ne sont pas des paramètres
+        subquery = sql.SQL(source["sql"].replace("%", "%%"))
+        # Colonnes de la requête (LIMIT 0) : metadata est facultative
+        async with connection_factory() as conn:
+            cur = await conn.execute(sql.SQL("SELECT * FROM ({}) AS q LIMIT 0").format(subquery))
+            names = {column.name for column in cur.description}
+        if not {"id", "text"} <= names:
+            raise JobError("query source must return 'id' and 'text' columns")
+        metadata = sql.SQL("q.metadata") if "metadata" in names else sql.SQL("NULL")
+        select = sql.SQL("SELECT q.id, q.text, {} FROM ({}) AS q").format(metadata, subquery)
+        id_column = sql.SQL("q.id")
+    while True:
+        if after is None:
+            query = sql.SQL("{} ORDER BY {} LIMIT %s").format(select, id_column)
+            params = (page_size,)
+        else:
+            query = sql.SQL("{} WHERE {} > %s ORDER BY {} LIMIT %s").format(select, id_column, id_column)
+            params = (after, page_size)
+        async with connection_factory() as conn:
+            cur = await conn.execute(query, params)
+            rows = await cur.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            after = json_key(row[0])
+            if extra is None:
+                metadata = row[2]
+            else:
+                metadata = {name: value for name, value in zip(extra, row[2:])} or None
+            yield after, (str(row[0]), row[1] or "", metadata)
+
+
+async def iter_file_rows(path, fmt, skip, chunk_size=1 << 20):
+    """Enregistrements du fichier déposé ; les skip premiers sont déjà traités."""
+
+    async def chunks():
+        with open(path, "rb") as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    position = 0
+    async for record in iter_records(chunks(), fmt):
+        position += 1
+        if position > skip:
+            yield position, record
+
+
+def remove_upload(job):
+    """Supprime le fichier déposé d'un job terminé (succès, échec ou annulation)."""
+    source = job["source"]
+    if source.get("type") != "file":
+        return
+    try:
+        os.remove(source["path"])
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove upload of job %s: %s", job["id"], e)
+
+
+async def estimate_rows(connection_factory, source):
+    """Nombre de lignes estimé d'une table source (statistiques du planificateur)."""
+    if source["type"] != "table":
+        return None
+    async with connection_factory() as conn:
+        cur = await conn.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", (source["table"],))
+        row = await cur.fetchone()
+    return row[0] if row and row[0] > 0 else None
+
+
+class JobStore:
+    """Table des jobs : création, lecture, réclamation, points de reprise."""
+
+    def __init__(self, connection_factory, table="embedding_jobs"):
+        self.connection_factory = connection_factory
+        self.table = sql.Identifier(table)
+
+    async def ensure_table(self):
+        async with self.connection_factory() as conn:
+            await conn.execute(
+                sql.SQL(
+                    """
+                    CREATE TABLE IF NOT EXISTS {} (
+                        id bigserial PRIMARY KEY,
+                        kind text NOT NULL DEFAULT 'embed',
+                        status text NOT NULL DEFAULT 'queued',
+                        source jsonb NOT NULL,
+                        target_table text NOT NULL,
+                        model_id text NOT NULL,
+                        batch_size integer NOT NULL,
+                        rows_done bigint NOT NULL DEFAULT 0,
+                        total_rows bigint,
+                        checkpoint jsonb,
+                        error text,
+                        attempts integer NOT NULL DEFAULT 0,
+                        owner text,
+                        rows_at_start bigint NOT NULL DEFAULT 0,
+                        created_at timestamptz NOT NULL DEFAULT now(),
+                        started_at timestamptz,
+                        heartbeat_at timestamptz,
+                        finished_at timestamptz
+                    )
+                    """
+                ).format(self.table)
+            )
+            # Tables créées avant l'ajout des jobs de clustering
+            await conn.execute(
+                sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS kind text NOT NULL DEFAULT 'embed'").format(self.table)
+            )
+
+    async def _one(self, query, params):
+        async with self.connection_factory() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, params)
+                return await cur.fetchone()
+
+    async def create(self, source, target_table, model_id, batch_size, total_rows=None, kind="embed"):
+        return await self._one(
+            sql.SQL(
+                "INSERT INTO {} (kind, source, target_table, model_id, batch_size, total_rows) "
+                "VALUES (%s, %s, %s, %s, %s, %s) RETURNING *"
+            ).format(self.table),
+            (kind, Jsonb(source), target_table, model_id, batch_size, total_rows),
+        )
+
+    async def get(self, job_id):
+        return await self._one(sql.SQL("SELECT * FROM {} WHERE id = %s").format(self.table), (job_id,))
+
+    async def list(self, limit=50, status=None):
+        async with self.connection_factory() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(
+                    sql.SQL("SELECT * FROM {} WHERE %s::text IS NULL OR status = %s ORDER BY id DESC LIMIT %s").format(
+                        self.table
+                    ),
+                    (status, status, limit),
+                )
+                return await cur.fetchall()
+
+    async def cancel(self, job_id):
+        return await self._one(
+            sql.SQL(
+                "UPDATE {} SET status = 'cancelled', finished_at = now() "
+                "WHERE id = %s AND status IN ('queued', 'running') RETURNING *"
+            ).format(self.table),
+            (job_id,),
+        )
+
+    async def claim(self, owner, model_id, stale_after):
+        """Prend le plus ancien job en attente, ou en cours mais abandonné."""
+        return await self._one(
+            sql.SQL(
+                """
+                UPDATE {t} SET status = 'running', owner = %(owner)s, attempts = attempts + 1,
+                    started_at = now(), heartbeat_at = now(), rows_at_start = rows_done
+                WHERE id = (
+                    SELECT id FROM {t}
+                    WHERE model_id = %(model)s AND (
+                        status = 'queued'
+                        OR (status = 'running' AND heartbeat_at < now() - make_interval(secs => %(stale)s))
+                    )
+                    ORDER BY id FOR UPDATE SKIP LOCKED LIMIT 1
+                )
+                RETURNING *
+                """
+            ).format(t=self.table),
+            {"owner": owner, "model": model_id, "stale": float(stale_after)},
+        )
+
+    async def checkpoint(self, job_id, owner, rows_done, checkpoint):
+        """Enregistre l'avancement ; False si le job a été annulé ou repris ailleurs."""
+        row = await self._one(
+            sql.SQL(
+                "UPDATE {} SET rows_done = %s, checkpoint = %s, heartbeat_at = now() "
+                "WHERE id = %s AND owner = %s AND status = 'running' RETURNING id"
+            ).format(self.table),
+            (rows_done, Jsonb(checkpoint), job_id, owner),
+        )
+        return row is not None
+
+    async def release(self, job_id, owner, status, error=None):
+        """Fin du traitement par ce worker : terminé, en échec, ou remis en file.
+
+        False si le job n'était plus à ce worker (annulé ou repris ailleurs).
+        """
+        finished = status != "queued"
+        row = await self._one(
+            sql.SQL(
+                "UPDATE {} SET status = %s, error = %s, finished_at = CASE WHEN %s THEN now() END, "
+                "owner = CASE WHEN %s THEN owner END "
+                "WHERE id = %s AND owner = %s AND status = 'running' RETURNING id"
+            ).format(self.table),
+            (status, error, finished, finished, job_id, owner),
+        )
+        return row is not None
+
+
+def describe(job):
+    """Vue JSON d'un job, avec débit de l'exécution en cours et progression."""
+    out = {key: value.isoformat() if hasattr(value, "isoformat") else value for key, value in job.items()}
+    source = dict(job["source"])
+    if source.get("type") == "query":
+        source["sql"] = source["sql"][:200]
+    out["source"] = source
+    start, beat = job.get("started_at"), job.get("finished_at") or job.get("heartbeat_at")
+    rows = job["rows_done"] - job["rows_at_start"]
+    elapsed = (beat - start).total_seconds() if start and beat else 0
+    out["rows_per_sec"] = round(rows / elapsed, 1) if elapsed > 0 else None
+    if job.get("total_rows"):
+        out["progress"] = round(min(1.0, job["rows_done"] / job["total_rows"]), 4)
+    return out
+
+
+class JobRunner:
+    """Boucle de fond d'un worker : réclame et exécute les jobs un par un."""
+
+    def __init__(self, store, encode_fn, connection_factory, prepare_target, model_id,
+                 encode_batch_size=32, wait_turn=None, poll_interval=5.0, stale_after=120.0, handlers=None):
+        self.store = store
+        # encode_fn : coroutine (liste de textes -> matrice) ; prepare_target : coroutine(table)
+        self.encode_fn = encode_fn
+        self.connection_factory = connection_factory
+        self.prepare_target = prepare_target
+        self.model_id = model_id
+        self.encode_batch_size = int(encode_batch_size)
+        self.wait_turn = wait_turn
+        self.poll_interval = float(poll_interval)
+        self.stale_after = float(stale_after)
+        # kind -> coroutine(runner, job) pour les jobs autres que "embed"
+        self.handlers = dict(handlers or {})
+        # Fixé par start(), dans le worker : avec preload_app, __init__ s'exécute
+        # dans le maître et tous les workers hériteraient du même pid
+        self.owner = None
+        self.current = None
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                job = await self.store.claim(self.owner, self.model_id, self.stale_after)
+            except psycopg.Error as e:
+                logger.warning("Could not poll embedding jobs: %s", e)
+                job = None
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            self.current = job["id"]
+            handler = self.handlers.get(job["kind"])
+            try:
+                await (handler(self, job) if handler is not None else self.run(job))
+            except asyncio.CancelledError:
+                # Arrêt du worker : le job repart en file avec son point de reprise
+                await asyncio.shield(self.store.release(job["id"], self.owner, "queued"))
+                raise
+            except Exception as e:
+                logger.exception("%s job %s failed", job["kind"], job["id"])
+                try:
+                    if await self.store.release(job["id"], self.owner, "failed", str(e)):
+                        remove_upload(job)
+                except psycopg.Error:
+                    pass
+            finally:
+                self.current = None
+
+    def _rows(self, job):
+        source, checkpoint = job["source"], job["checkpoint"] or {}
+        if source["type"] == "file":
+            return iter_file_rows(source["path"], source["format"], checkpoint.get("records", 0))
+        return iter_query_rows(self.connection_factory, source, checkpoint.get("after"), job["batch_size"])
+
+    async def _encode(self, texts):
+        # Sous-lots de la taille d'une passe, en cédant la place au trafic interactif
+        parts = []
+        for start in range(0, len(texts), self.encode_batch_size):
+            if self.wait_turn is not None:
+                await self.wait_turn()
+            parts.append(await self.encode_fn(texts[start:start + self.encode_batch_size]))
+        return np.concatenate(parts)
+
+    async def run(self, job):
+        logger.info("Embedding job %s started at row %s", job["id"], job["rows_done"])
+        await self.prepare_target(job["target_table"])
+        rows_done, kind = job["rows_done"], job["source"]["type"]
+        async with self.connection_factory() as conn:
+            writer = PgVectorCopyWriter(conn, job["target_table"], upsert=True)
+            await writer.prepare()
+            batch, position = [], None
+
+            async def flush():
+                ids, texts, metadata = zip(*batch)
+                vectors = await self._encode(list(texts))
+                await writer.write(ids, vectors, metadata)
+                checkpoint = {"records": position} if kind == "file" else {"after": position}
+                batch.clear()
+                return await self.store.checkpoint(job["id"], self.owner, rows_done, checkpoint)
+
+            async for position, record in self._rows(job):
+                batch.append(record)
+                if len(batch) >= job["batch_size"]:
+                    rows_done += len(batch)
+                    if not await flush():
+                        logger.info("Embedding job %s stopped (cancelled or taken over)", job["id"])
+                        return
+            if batch:
+                rows_done += len(batch)
+                if not await flush():
+                    return
+        if await self.store.release(job["id"], self.owner, "succeeded"):
+            remove_upload(job)
+        logger.info("Embedding job %s finished: %s rows", job["id"], rows_done)
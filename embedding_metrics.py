@@ -0,0 +1,175 @@
+# embedding_metrics.py
+"""
+Métriques au format texte Prometheus, sans dépendance.
+
+Le chemin chaud ne fait qu'incrémenter des entiers : un histogramme est un
+tuple de bornes et une liste de compteurs, observe() cherche le seau par
+bisection et ajoute 1. Les objets sont créés une fois (au démarrage, ou à la
+première requête d'un endpoint) ; tout le reste — statistiques des caches,
+du pool de connexions, RSS — est lu au moment du scrape.
+
+Débits (tokens/s, textes/s) : rate() sur les compteurs *_total.
+
+Les compteurs sont mis à jour depuis la boucle asyncio du worker, sauf ceux
+de BucketedEncoder (pool d'inférence) qui ont leur propre verrou. Chaque
+worker gunicorn a ses propres valeurs, étiquetées par pid.
+"""
+
+import os
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """Histogramme cumulatif à la Prometheus (seaux <= borne, puis +Inf)."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    @classmethod
+    def from_snapshot(cls, data):
+        histogram = cls(data["buckets"])
+        histogram.counts = list(data["counts"])
+        histogram.sum, histogram.count = data["sum"], data["count"]
+        return histogram
+
+
+def format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Exposition:
+    """Construit la réponse texte d'un scrape."""
+
+    def __init__(self, base_labels=None):
+        self.base_labels = dict(base_labels or {})
+        self.lines = []
+        self._declared = set()
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._declared:
+            self._declared.add(name)
+            self.lines.append(f"# HELP {name} {help_text}")
+            self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name, kind, help_text, value, **labels):
+        if value is None:
+            return
+        self._declare(name, kind, help_text)
+        self.lines.append(f"{name}{format_labels({**self.base_labels, **labels})} {format_value(value)}")
+
+    def counter(self, name, help_text, value, **labels):
+        self.sample(name, "counter", help_text, value, **labels)
+
+    def gauge(self, name, help_text, value, **labels):
+        self.sample(name, "gauge", help_text, value, **labels)
+
+    def histogram(self, name, help_text, histogram, **labels):
+        self._declare(name, "histogram", help_text)
+        labels = {**self.base_labels, **labels}
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.lines.append(f"{name}_bucket{format_labels({**labels, 'le': f'{bound:g}'})} {cumulative}")
+        self.lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+        self.lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}")
+        self.lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def process_rss_bytes():
+    """RSS courant du processus (Linux), sinon pic de RSS via getrusage."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RouteLatency:
+    """Histogramme de latence par route (chemin déclaré, pas l'URL)."""
+
+    def __init__(self):
+        # endpoint -> Histogram ; None regroupe les requêtes sans route (404)
+        self.histograms = {}
+        self._routes = {}
+
+    def observe(self, scope, seconds):
+        # Le routeur a renseigné scope["endpoint"] pendant l'appel
+        endpoint = scope.get("endpoint")
+        histogram = self.histograms.get(endpoint)
+        if histogram is None:
+            histogram = self.histograms[endpoint] = Histogram(LATENCY_BUCKETS)
+            self._routes[endpoint] = self._describe(scope, endpoint)
+        histogram.observe(seconds)
+
+    @staticmethod
+    def _describe(scope, endpoint):
+        for route in scope["app"].router.routes:
+            if endpoint is not None and getattr(route, "endpoint", None) is endpoint:
+                return ",".join(sorted(m for m in route.methods or () if m != "HEAD")), route.path
+        return scope["method"], "other"
+
+    def export(self, exposition):
+        for endpoint, histogram in list(self.histograms.items()):
+            method, path = self._routes[endpoint]
+            exposition.histogram(
+                "embedding_request_duration_seconds",
+                "HTTP request latency per route",
+                histogram,
+                method=method,
+                endpoint=path,
+            )
+
+
+class RequestMetricsMiddleware:
+    """Middleware ASGI pur (pas de BaseHTTPMiddleware) : une mesure par requête."""
+
+    def __init__(self, app, latency):
+        self.app = app
+        self.latency = latency
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.latency.observe(scope, time.perf_counter() - start)
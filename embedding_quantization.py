@@ -0,0 +1,94 @@
+# embedding_quantization.py
+"""
+Types de sortie quantifiés des embeddings.
+
+  - float32 : vecteurs du modèle, inchangés
+  - float16 : demi-précision (2 octets par dimension)
+  - int8    : quantification affine par dimension, x ~= q * scale + offset,
+              avec des bornes calibrées sur un échantillon et persistées
+  - ubinary : 1 bit par dimension (signe), empaqueté avec np.packbits
+"""
+
+import os
+import re
+
+import numpy as np
+
+OUTPUT_DTYPES = ("float32", "float16", "int8", "ubinary")
+
+
+class CalibrationMissingError(Exception):
+    """Levée quand int8 est demandé sans calibration disponible."""
+
+
+class Int8Calibration:
+    """Bornes par dimension pour la quantification int8."""
+
+    def __init__(self, mins, maxs, model_name="", samples=0):
+        self.mins = np.asarray(mins, dtype=np.float32)
+        self.maxs = np.asarray(maxs, dtype=np.float32)
+        self.model_name = model_name
+        self.samples = int(samples)
+        # 256 niveaux entre min et max ; une dimension constante garde un pas non nul
+        self.scale = np.maximum((self.maxs - self.mins) / 255.0, np.float32(1e-12)).astype(np.float32)
+        self.offset = (self.mins + 128.0 * self.scale).astype(np.float32)
+
+    @classmethod
+    def fit(cls, vectors, model_name="", percentile=None):
+        """Calcule les bornes sur un échantillon (min/max ou percentiles symétriques)."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if percentile:
+            mins = np.percentile(vectors, percentile, axis=0)
+            maxs = np.percentile(vectors, 100.0 - percentile, axis=0)
+        else:
+            mins, maxs = vectors.min(axis=0), vectors.max(axis=0)
+        return cls(mins, maxs, model_name, len(vectors))
+
+    def quantize(self, vectors):
+        q = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(q, -128, 127).astype(np.int8)
+
+    def dequantize(self, codes):
+        return codes.astype(np.float32) * self.scale + self.offset
+
+    def params(self):
+        return {
+            "scheme": "x = q * scale + offset",
+            "scale": self.scale.tolist(),
+            "offset": self.offset.tolist(),
+            "samples": self.samples,
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, mins=self.mins, maxs=self.maxs, model_name=self.model_name, samples=self.samples)
+        # Remplacement atomique : les autres workers ne lisent jamais un fichier partiel
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["mins"], data["maxs"], str(data["model_name"]), int(data["samples"]))
+
+
+def calibration_path(directory, model_name):
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name).strip("_")
+    return os.path.join(directory, f"{slug}.int8.npz")
+
+
+def quantize(vectors, output_dtype, calibration=None):
+    """Convertit des embeddings float32 ; renvoie (tableau, paramètres de décodage)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if output_dtype == "float32":
+        return vectors, None
+    if output_dtype == "float16":
+        return vectors.astype(np.float16), None
+    if output_dtype == "int8":
+        if calibration is None:
+            raise CalibrationMissingError("int8 output requires a calibration (POST /quantization/calibrate)")
+        return calibration.quantize(vectors), calibration.params()
+    if output_dtype == "ubinary":
+        return np.packbits(vectors > 0, axis=-1), {"scheme": "sign bit, np.packbits", "bits": vectors.shape[-1]}
+    raise ValueError(f"Unknown output dtype: {output_dtype}")
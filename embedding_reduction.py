@@ -0,0 +1,227 @@
+# embedding_reduction.py
+"""
+Réduction de dimension des embeddings par PCA.
+
+Une projection est ajustée une fois sur un échantillon des vecteurs stockés
+(jusqu'à max(REDUCED_DIMS) composantes) puis persistée à côté du nom du
+modèle ; les composantes étant ordonnées, ses k premières lignes donnent la
+projection en k dimensions. Les vecteurs projetés sont re-normalisés (L2) :
+la similarité cosinus reste la métrique de recherche.
+
+Ajustement et évaluation (variance conservée, recall@k par dimension) :
+
+    python embedding_reduction.py fit --sample-size 50000
+    python embedding_reduction.py evaluate --k 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+from contextlib import asynccontextmanager
+
+import numpy as np
+
+REDUCED_DIMS = (64, 128, 192)
+FIT_METHODS = ("pca", "randomized")
+
+
+class ProjectionMissingError(Exception):
+    """Levée quand une dimension réduite est demandée sans projection disponible."""
+
+
+class PcaProjection:
+    """Moyenne et composantes principales (lignes, par variance décroissante)."""
+
+    def __init__(self, mean, components, explained_variance_ratio, model_name="", samples=0, method="pca"):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.explained_variance_ratio = np.asarray(explained_variance_ratio, dtype=np.float64)
+        self.model_name = model_name
+        self.samples = int(samples)
+        self.method = method
+
+    @classmethod
+    def fit(cls, vectors, model_name="", max_dims=max(REDUCED_DIMS), method="pca", seed=0):
+        """PCA exacte (SVD complète) ou randomisée, plus rapide sur de gros échantillons."""
+        from sklearn.decomposition import PCA
+
+        if method not in FIT_METHODS:
+            raise ValueError(f"Unknown fit method: {method}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n_components = min(int(max_dims), vectors.shape[1], len(vectors))
+        pca = PCA(n_components, svd_solver="full" if method == "pca" else "randomized", random_state=seed)
+        pca.fit(vectors)
+        return cls(pca.mean_, pca.components_, pca.explained_variance_ratio_, model_name, len(vectors), method)
+
+    @property
+    def input_dims(self):
+        return self.components.shape[1]
+
+    @property
+    def max_dims(self):
+        return self.components.shape[0]
+
+    def check_dims(self, dims):
+        if not 1 <= int(dims) <= self.max_dims:
+            raise ValueError(f"dims must be between 1 and {self.max_dims} for this projection")
+
+    def transform(self, vectors, dims, normalize=True):
+        self.check_dims(dims)
+        projected = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components[:dims].T
+        if normalize:
+            projected /= np.maximum(np.linalg.norm(projected, axis=-1, keepdims=True), np.float32(1e-12))
+        return projected.astype(np.float32, copy=False)
+
+    def retained_variance(self, dims):
+        return float(self.explained_variance_ratio[:dims].sum())
+
+    def params(self):
+        return {
+            "method": self.method,
+            "samples": self.samples,
+            "input_dims": self.input_dims,
+            "dims": [d for d in REDUCED_DIMS if d <= self.max_dims],
+            "retained_variance": {d: round(self.retained_variance(d), 4) for d in REDUCED_DIMS if d <= self.max_dims},
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                mean=self.mean,
+                components=self.components,
+                explained_variance_ratio=self.explained_variance_ratio,
+                model_name=self.model_name,
+                samples=self.samples,
+                method=self.method,
+            )
+        # Remplacement atomique : les autres workers ne lisent jamais un fichier partiel
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["mean"],
+                data["components"],
+                data["explained_variance_ratio"],
+                str(data["model_name"]),
+                int(data["samples"]),
+                str(data["method"]),
+            )
+
+
+def projection_path(directory, model_name):
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name).strip("_")
+    return os.path.join(directory, f"{slug}.pca.npz")
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def nearest(scores, k, self_columns=None):
+    """k meilleurs candidats (non triés) par ligne de scores (requêtes x base).
+
+    self_columns donne, pour chaque requête, sa propre colonne dans la base :
+    elle est exclue, sinon chaque requête se trouverait elle-même et le
+    recall@k serait gonflé d'environ 1/k.
+    """
+    if self_columns is not None:
+        scores = np.array(scores, dtype=np.float32)
+        scores[np.arange(len(scores)), self_columns] = -np.inf
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def _top_k(queries, base, k, exclude_self):
+    # Les requêtes sont les premières lignes de la base
+    return nearest(queries @ base.T, k, np.arange(len(queries)) if exclude_self else None)
+
+
+def evaluate(projection, vectors, k=10, queries=500, dims=REDUCED_DIMS, seed=0):
+    """Variance conservée et recall@k cosinus (voisins exacts en dimension complète)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(int(k), len(vectors) - 1)
+    if k < 1:
+        raise ValueError("Need at least 2 vectors to evaluate")
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    base = vectors[order]
+    n_queries = min(int(queries), len(base))
+    truth = _top_k(_normalize(base[:n_queries]), _normalize(base), k, True)
+    report = {"k": k, "queries": n_queries, "base": len(base), "dims": {}}
+    for d in dims:
+        if d > projection.max_dims:
+            continue
+        reduced = projection.transform(base, d)
+        found = _top_k(reduced[:n_queries], reduced, k, True)
+        hits = sum(len(np.intersect1d(t, f, assume_unique=True)) for t, f in zip(truth, found))
+        report["dims"][d] = {
+            "retained_variance": round(projection.retained_variance(d), 4),
+            "recall_at_k": round(hits / (n_queries * k), 4),
+            "bytes_per_vector": d * 4,
+        }
+    report["dims"][projection.input_dims] = {"retained_variance": 1.0, "recall_at_k": 1.0,
+                                             "bytes_per_vector": projection.input_dims * 4}
+    return report
+
+
+async def _sample_from_db(database_url, table, limit):
+    import psycopg
+
+    from vector_store import PgVectorStore
+
+    @asynccontextmanager
+    async def connection():
+        async with await psycopg.AsyncConnection.connect(database_url, autocommit=True) as conn:
+            yield conn
+
+    return await PgVectorStore(connection, table, None).sample_vectors(limit)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit and evaluate the PCA projection used for reduced dims")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("fit", "fit and persist the projection, then evaluate it"),
+                            ("evaluate", "evaluate the persisted projection")):
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+                            help="model id; suffix @onnx or @onnx-int8 for artifacts of the onnx backend")
+        cmd.add_argument("--dir", default=os.getenv("REDUCTION_DIR", "reduction"))
+        cmd.add_argument("--input", help=".npy matrix of vectors (default: sample the pgvector table)")
+        cmd.add_argument("--table", default=os.getenv("VECTOR_TABLE", "embeddings"))
+        cmd.add_argument("--sample-size", type=int, default=50000)
+        cmd.add_argument("--k", type=int, default=10)
+        cmd.add_argument("--queries", type=int, default=500)
+        if name == "fit":
+            cmd.add_argument("--method", choices=FIT_METHODS, default="pca")
+            cmd.add_argument("--holdout", type=float, default=0.2, help="fraction kept out of the fit for evaluation")
+    args = parser.parse_args(argv)
+
+    if args.input:
+        vectors = np.load(args.input, mmap_mode="r")[: args.sample_size]
+    else:
+        vectors = asyncio.run(_sample_from_db(os.environ["DATABASE_URL"], args.table, args.sample_size))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    path = projection_path(args.dir, args.model)
+
+    if args.command == "fit":
+        held = int(len(vectors) * args.holdout)
+        fit_on, eval_on = (vectors[held:], vectors[:held]) if held >= 2 else (vectors, vectors)
+        projection = PcaProjection.fit(fit_on, args.model, method=args.method)
+        projection.save(path)
+    else:
+        projection = PcaProjection.load(path)
+        eval_on = vectors
+    report = {"model": args.model, "path": path, **projection.params(),
+              "evaluation": evaluate(projection, eval_on, args.k, args.queries)}
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
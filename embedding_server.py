@@ -1,25 +1,573 @@
 # embedding_server.py
+import asyncio
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from typing import Any, Dict, List, Literal, Optional, Union
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
+import numpy as np
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 from sentence_transformers import SentenceTransformer
+from embedding_admission import AdmissionController
+from cpu_budget import available_cores, configure_torch, thread_plan
+from embedding_backends import create_encoder, encoder_id
+from embedding_batcher import MicroBatcher, QueueFullError, SingleFlight
+from embedding_ipc import InferenceClient, InferenceUnavailableError
+from embedding_metrics import Counter, Exposition, Histogram, RequestMetricsMiddleware, RouteLatency, process_rss_bytes
+from embedding_chunking import DocumentChunker, pool
+from embedding_cache import EmbeddingCache, PgEmbeddingCache, cache_key
+import embedding_codec
+from embedding_quantization import CalibrationMissingError, Int8Calibration, calibration_path, quantize
+from embedding_reduction import PcaProjection, ProjectionMissingError, evaluate, projection_path
+from embedding_clustering import run_clustering, scan_vectors, validate_clustering
+from embedding_index import IndexBusyError, IndexMismatchError, MmapIndex, index_dir, top_k_rows
+from embedding_jobs import JOB_STATUSES, JobError, JobRunner, JobStore, describe, estimate_rows, remove_upload, validate_source
+from ingest import IngestError, ingest_records, iter_records
+from vector_store import PgVectorStore
+
+logger = logging.getLogger("embedding_server")
+
+def env_flag(name, default="0"):
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
 
 # Charger l'URL de la base depuis la variable d'environnement
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL environment variable not set")
 
-# Initialiser FastAPI
-app = FastAPI(title="Sawem Embedding API")
+# Pool de connexions PostgreSQL (un par worker, ouvert au démarrage)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 300))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_CHECK = env_flag("DB_POOL_CHECK", "1")
+
+# Paramètres d'inférence (surchargeables par variables d'environnement)
+MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+EMBED_MAX_BATCH_ITEMS = int(os.getenv("EMBED_MAX_BATCH_ITEMS", 2048))
+NORMALIZE_EMBEDDINGS = env_flag("NORMALIZE_EMBEDDINGS")
+
+# Cache LRU en mémoire (taille max en octets, 0 pour le désactiver)
+EMBED_CACHE_MAX_BYTES = int(os.getenv("EMBED_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Cache durable dans PostgreSQL, partagé par les workers (désactivé par défaut)
+PG_CACHE_ENABLED = env_flag("PG_CACHE_ENABLED")
+PG_CACHE_TABLE = os.getenv("PG_CACHE_TABLE", "embedding_cache")
+
+# Recherche k-NN pgvector : table, création du schéma / d'un index au démarrage
+VECTOR_TABLE = os.getenv("VECTOR_TABLE", "embeddings")
+VECTOR_SCHEMA_ON_STARTUP = env_flag("VECTOR_SCHEMA_ON_STARTUP")
+VECTOR_INDEX_ON_STARTUP = os.getenv("VECTOR_INDEX_ON_STARTUP", "")  # "", "hnsw" ou "ivfflat"
+VECTOR_INDEX_METRIC = os.getenv("VECTOR_INDEX_METRIC", "cosine")
+
+# Ingestion en masse : nombre de documents encodés puis écrits par COPY à la fois
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 256))
+
+# Jobs asynchrones : table d'état, répertoire des fichiers déposés, lignes par
+# lot écrit (et point de reprise), heartbeat au-delà duquel un job est repris,
+# attente max (ms) laissée au trafic interactif avant chaque passe d'un job
+JOBS_ENABLED = env_flag("JOBS_ENABLED", "1")
+JOBS_TABLE = os.getenv("JOBS_TABLE", "embedding_jobs")
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+JOBS_BATCH_SIZE = int(os.getenv("JOBS_BATCH_SIZE", INGEST_BATCH_SIZE))
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", 5))
+JOBS_STALE_AFTER = float(os.getenv("JOBS_STALE_AFTER", 120))
+JOBS_MAX_DEFER_MS = float(os.getenv("JOBS_MAX_DEFER_MS", 2000))
+JOBS_ALLOW_SQL = env_flag("JOBS_ALLOW_SQL")
+# Taille maximale (octets) d'un fichier déposé par /jobs/upload
+JOBS_MAX_UPLOAD_BYTES = int(os.getenv("JOBS_MAX_UPLOAD_BYTES", 1 << 30))
+# Jobs de clustering : vecteurs lus (et passés à partial_fit) par lot
+CLUSTER_BATCH_SIZE = int(os.getenv("CLUSTER_BATCH_SIZE", 4096))
+
+# Index vectoriel en mémoire : instantané .npy mappé (pages partagées entre
+# workers) dans LOCAL_INDEX_DIR, recherche exacte ou IVF (LOCAL_INDEX_NPROBE listes)
+LOCAL_INDEX_ENABLED = env_flag("LOCAL_INDEX_ENABLED")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_index")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", 8))
+# Reconstruction automatique de l'instantané (fusion des ajouts) : dès
+# LOCAL_INDEX_REBUILD_DELTA_ROWS ajouts en attente, ou quand l'instantané a plus
+# de LOCAL_INDEX_REBUILD_INTERVAL secondes et que des ajouts attendent (0 = jamais)
+LOCAL_INDEX_REBUILD_DELTA_ROWS = int(os.getenv("LOCAL_INDEX_REBUILD_DELTA_ROWS", 100000))
+LOCAL_INDEX_REBUILD_INTERVAL = float(os.getenv("LOCAL_INDEX_REBUILD_INTERVAL", 3600))
+
+# Répertoire des calibrations int8 (un fichier .npz par modèle, partagé par les workers)
+QUANT_CALIBRATION_DIR = os.getenv("QUANT_CALIBRATION_DIR", "calibration")
+
+# Répertoire des projections PCA (dims réduites de /embed), un fichier par modèle
+REDUCTION_DIR = os.getenv("REDUCTION_DIR", "reduction")
+
+# Micro-batching de /embed : attente max (ms), taille max d'un lot, profondeur max de la file
+MICROBATCH_MAX_WAIT_MS = float(os.getenv("MICROBATCH_MAX_WAIT_MS", 5))
+MICROBATCH_MAX_SIZE = int(os.getenv("MICROBATCH_MAX_SIZE", 64))
+MICROBATCH_MAX_QUEUE = int(os.getenv("MICROBATCH_MAX_QUEUE", 1024))
+
+# Backend d'inférence : "torch" (SentenceTransformer) ou "onnx" (onnxruntime,
+# modèle exporté une fois dans ONNX_CACHE_DIR, quantifié en int8 si ONNX_QUANTIZE)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", "onnx_cache")
+ONNX_QUANTIZE = env_flag("ONNX_QUANTIZE", "1")
+# Identité des vecteurs (modèle + backend + quantification) : clés de cache et artefacts
+ENCODER_ID = encoder_id(MODEL_NAME, EMBEDDING_BACKEND, ONNX_QUANTIZE)
+
+# Regroupement par longueur en tokens avant les passes avant ; budget de
+# tokens (padding compris) d'une passe
+LENGTH_BUCKETING = env_flag("LENGTH_BUCKETING", "1")
+BUCKET_MAX_TOKENS = int(os.getenv("BUCKET_MAX_TOKENS", 16384))
+
+# Topologie : "local" (chaque worker charge le modèle) ou "shared" (un seul
+# processus d'inférence, lancé par gunicorn.conf.py, joint par mémoire partagée)
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "local")
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "/tmp/sawem-inference.sock")
+INFERENCE_SLOTS = int(os.getenv("INFERENCE_SLOTS", 256))
+INFERENCE_MAX_TEXT_BYTES = int(os.getenv("INFERENCE_MAX_TEXT_BYTES", 32768))
+# Délai maximal (secondes) d'une requête au processus d'inférence, au-delà : 503
+INFERENCE_REQUEST_TIMEOUT = float(os.getenv("INFERENCE_REQUEST_TIMEOUT", 60))
+
+# Mode document : fenêtre en tokens (0 = limite du modèle) et décalage entre
+# deux fenêtres (0 = fenêtre, sans chevauchement)
+DOC_CHUNK_WINDOW = int(os.getenv("DOC_CHUNK_WINDOW", 0))
+DOC_CHUNK_STRIDE = int(os.getenv("DOC_CHUNK_STRIDE", 0))
+
+# Contrôle d'admission : tokens estimés (en file + en calcul) au-delà desquels
+# les endpoints d'encodage répondent 429 + Retry-After (0 = désactivé) ;
+# estimation à ADMISSION_CHARS_PER_TOKEN caractères par token
+ADMISSION_MAX_TOKENS = int(os.getenv("ADMISSION_MAX_TOKENS", 131072))
+ADMISSION_CHARS_PER_TOKEN = float(os.getenv("ADMISSION_CHARS_PER_TOKEN", 4))
+
+# Cœurs de ce worker (fixé par gunicorn.conf.py, sinon tous les cœurs
+# disponibles), partagés entre les passes avant simultanées du pool
+# d'inférence (INFERENCE_WORKERS, 1 par défaut) et les threads intra-op
+CPU_BUDGET = int(os.getenv("CPU_BUDGET", 0)) or available_cores()
+INFERENCE_WORKERS, INTRA_OP_THREADS = thread_plan(CPU_BUDGET, os.getenv("INFERENCE_WORKERS"))
+if INFERENCE_MODE != "shared":
+    configure_torch(INTRA_OP_THREADS)
+
+# Initialiser le modèle de embeddings (en mode shared, seul le processus d'inférence le charge)
+if INFERENCE_MODE == "shared":
+    model = encoder = None
+    inference_client = InferenceClient(
+        INFERENCE_SOCKET, INFERENCE_SLOTS, INFERENCE_MAX_TEXT_BYTES, request_timeout=INFERENCE_REQUEST_TIMEOUT
+    )
+    EMBEDDING_DIM = None  # connue à la connexion au processus d'inférence
+    document_chunker = None  # idem pour max_seq_length
+else:
+    model = SentenceTransformer(MODEL_NAME)
+    encoder = create_encoder(
+        model,
+        MODEL_NAME,
+        EMBEDDING_BACKEND,
+        cache_dir=ONNX_CACHE_DIR,
+        quantize=ONNX_QUANTIZE,
+        max_batch_tokens=BUCKET_MAX_TOKENS if LENGTH_BUCKETING else None,
+        threads=INTRA_OP_THREADS,
+    )
+    inference_client = None
+    EMBEDDING_DIM = model.get_sentence_embedding_dimension()
+    document_chunker = DocumentChunker(model.tokenizer, model.max_seq_length)
+
+# Contrôle d'admission (plafond par worker) ; en mode shared, max_seq_length
+# n'est connue qu'à la connexion au processus d'inférence
+admission = AdmissionController(
+    ADMISSION_MAX_TOKENS,
+    ADMISSION_CHARS_PER_TOKEN,
+    max_tokens_per_text=model.max_seq_length if model is not None else None,
+)
+
+# Pool dédié aux passes avant : la boucle asyncio reste libre pour les
+# connexions, les health checks et /db-test pendant l'inférence
+inference_executor = ThreadPoolExecutor(max_workers=max(1, INFERENCE_WORKERS), thread_name_prefix="inference")
+
+async def run_inference(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, partial(fn, *args, **kwargs))
+
+# Passe avant du modèle sur une liste de textes (appelée dans le pool d'inférence)
+def encode_batch(texts, batch_size=EMBED_BATCH_SIZE):
+    return encoder.encode(texts, batch_size=batch_size, normalize_embeddings=NORMALIZE_EMBEDDINGS)
+
+# Textes envoyés au modèle (hors caches), exposé par /metrics
+items_encoded = Counter()
+
+# Passe avant sur les textes : localement, ou via le processus d'inférence partagé
+async def compute_embeddings(texts, batch_size=EMBED_BATCH_SIZE):
+    items_encoded.inc(len(texts))
+    if inference_client is not None:
+        return await inference_client.encode_many(texts)
+    return await run_inference(encode_batch, texts, batch_size=batch_size)
+
+def text_key(text):
+    return cache_key(ENCODER_ID, NORMALIZE_EMBEDDINGS, text)
+
+# Pool de connexions asynchrones : chaque accès à la base emprunte une connexion
+db_pool = AsyncConnectionPool(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    max_idle=DB_POOL_MAX_IDLE,
+    timeout=DB_POOL_TIMEOUT,
+    # Vérifie qu'une connexion est vivante avant de la prêter
+    check=AsyncConnectionPool.check_connection if DB_POOL_CHECK else None,
+    kwargs={"autocommit": True},
+    open=False,
+)
+
+def db_connection():
+    return db_pool.connection()
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_MAX_BYTES)
+pg_cache = PgEmbeddingCache(db_connection, ENCODER_ID, PG_CACHE_TABLE) if PG_CACHE_ENABLED else None
+vector_store = PgVectorStore(db_connection, VECTOR_TABLE, EMBEDDING_DIM)
+
+# Encodages interactifs en cours : les jobs de fond leur laissent la priorité
+interactive_inflight = 0
+
+# Encodage des textes absents du cache mémoire : une requête groupée au cache
+# PostgreSQL, le modèle pour le reste, puis réécriture groupée en base
+async def encode_uncached(texts, batch_size=EMBED_BATCH_SIZE, keys=None):
+    global interactive_inflight
+    interactive_inflight += 1
+    try:
+        return await _encode_uncached(texts, batch_size, keys)
+    finally:
+        interactive_inflight -= 1
+
+async def _encode_uncached(texts, batch_size, keys):
+    if pg_cache is None:
+        return await compute_embeddings(texts, batch_size)
+    keys = keys or [text_key(text) for text in texts]
+    found = await pg_cache.get_many(keys)
+    vectors = [found.get(key) for key in keys]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        fresh = await compute_embeddings([texts[i] for i in missing], batch_size)
+        await pg_cache.put_many([keys[i] for i in missing], fresh)
+        for i, vector in zip(missing, fresh):
+            vectors[i] = vector
+    return np.stack(vectors)
+
+# File de micro-batching partagée par les appels concurrents à /embed. En mode
+# shared, l'attente a lieu dans le processus d'inférence : ici on groupe
+# seulement ce qui est déjà en file (pour les lectures du cache PostgreSQL)
+batcher = MicroBatcher(
+    partial(encode_uncached, batch_size=MICROBATCH_MAX_SIZE),
+    max_batch_size=MICROBATCH_MAX_SIZE,
+    max_wait_ms=0 if inference_client is not None else MICROBATCH_MAX_WAIT_MS,
+    max_queue_size=MICROBATCH_MAX_QUEUE,
+)
+
+# Textes en cours d'encodage : un texte demandé par plusieurs requêtes
+# concurrentes (ou plusieurs fois dans un lot) n'est encodé qu'une fois
+single_flight = SingleFlight()
 
-# Initialiser le modèle de embeddings
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+# Embedding d'un texte seul : cache, calcul en cours, puis micro-batcher
+async def embed_one(text):
+    key = text_key(text)
+    vector = embedding_cache.get(key)
+    if vector is None:
+        async def compute(keys, texts):
+            fresh = await batcher.submit(texts[0])
+            embedding_cache.put(keys[0], fresh)
+            return [fresh]
+
+        (vector,) = await single_flight.run([key], [text], compute)
+    return vector
+
+# Embeddings d'une liste de textes : seuls les absents du cache passent par le modèle
+async def embed_many(texts, batch_size=EMBED_BATCH_SIZE):
+    keys = [text_key(text) for text in texts]
+    vectors = embedding_cache.get_many(keys)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        missing_keys = [keys[i] for i in missing]
+
+        async def compute(unique_keys, unique_texts):
+            fresh = await encode_uncached(unique_texts, batch_size, unique_keys)
+            # Mis en cache avant de libérer les clés : pas de fenêtre où un
+            # nouvel appelant ne trouverait ni l'un ni l'autre
+            embedding_cache.put_many(unique_keys, fresh)
+            return list(fresh)
+
+        fresh = await single_flight.run(missing_keys, [texts[i] for i in missing], compute)
+        for i, vector in zip(missing, fresh):
+            vectors[i] = vector
+    if not vectors:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.stack(vectors)
+
+# Les jobs attendent que la file interactive soit vide, au plus JOBS_MAX_DEFER_MS
+async def job_turn():
+    deadline = time.monotonic() + JOBS_MAX_DEFER_MS / 1000.0
+    while (batcher.qsize() or interactive_inflight) and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+
+async def prepare_job_target(table):
+    await PgVectorStore(db_connection, table, EMBEDDING_DIM).ensure_schema()
+
+job_store = JobStore(db_connection, JOBS_TABLE)
+job_runner = JobRunner(
+    job_store,
+    partial(compute_embeddings, batch_size=EMBED_BATCH_SIZE),
+    db_connection,
+    prepare_job_target,
+    MODEL_NAME,
+    encode_batch_size=EMBED_BATCH_SIZE,
+    wait_turn=job_turn,
+    poll_interval=JOBS_POLL_INTERVAL,
+    stale_after=JOBS_STALE_AFTER,
+    handlers={"cluster": run_clustering},
+)
+
+# Calibration int8 : rechargée quand le fichier a été recalculé par un autre worker
+int8_calibration_file = calibration_path(QUANT_CALIBRATION_DIR, ENCODER_ID)
+int8_calibration = None
+int8_calibration_mtime = None
+
+def get_int8_calibration():
+    global int8_calibration, int8_calibration_mtime
+    try:
+        mtime = os.stat(int8_calibration_file).st_mtime
+    except FileNotFoundError:
+        return int8_calibration
+    if mtime != int8_calibration_mtime:
+        int8_calibration = Int8Calibration.load(int8_calibration_file)
+        int8_calibration_mtime = mtime
+    return int8_calibration
+
+# Projection PCA : rechargée de la même façon
+projection_file = projection_path(REDUCTION_DIR, ENCODER_ID)
+projection = None
+projection_mtime = None
+
+def get_projection():
+    global projection, projection_mtime
+    try:
+        mtime = os.stat(projection_file).st_mtime
+    except FileNotFoundError:
+        return projection
+    if mtime != projection_mtime:
+        projection = PcaProjection.load(projection_file)
+        projection_mtime = mtime
+    return projection
+
+# Index en mémoire (créé au démarrage, la dimension pouvant venir du processus d'inférence)
+local_index = None
+# Reconstruction d'instantané en cours dans ce worker
+local_index_builds = set()
+
+# Démarrage / arrêt des ressources du worker
+@asynccontextmanager
+async def lifespan(app):
+    global EMBEDDING_DIM, document_chunker, local_index
+    if inference_client is not None:
+        await inference_client.start()
+        EMBEDDING_DIM = vector_store.dims = inference_client.dim
+        # Le tokenizer seul suffit au découpage : le modèle reste dans le processus d'inférence
+        from transformers import AutoTokenizer
+        document_chunker = DocumentChunker(AutoTokenizer.from_pretrained(MODEL_NAME), inference_client.max_seq_length)
+        admission.max_tokens_per_text = inference_client.max_seq_length
+    # wait=False : le worker démarre même si la base est momentanément injoignable
+    await db_pool.open(wait=False)
+    if pg_cache is not None:
+        try:
+            await pg_cache.ensure_table()
+        except psycopg.Error as e:
+            logger.warning("Could not create embedding cache table: %s", e)
+    try:
+        if VECTOR_SCHEMA_ON_STARTUP or VECTOR_INDEX_ON_STARTUP:
+            await vector_store.ensure_schema()
+        if VECTOR_INDEX_ON_STARTUP:
+            await vector_store.create_index(VECTOR_INDEX_ON_STARTUP, VECTOR_INDEX_METRIC)
+    except psycopg.Error as e:
+        logger.warning("Could not prepare vector table %s: %s", VECTOR_TABLE, e)
+    if LOCAL_INDEX_ENABLED:
+        try:
+            local_index = MmapIndex(index_dir(LOCAL_INDEX_DIR, ENCODER_ID), ENCODER_ID, EMBEDDING_DIM, LOCAL_INDEX_NPROBE)
+            await asyncio.to_thread(local_index.refresh)
+        except (OSError, IndexMismatchError) as e:
+            logger.warning("Could not open local index, disabled: %s", e)
+            local_index = None
+    maintenance = None
+    if local_index is not None and (LOCAL_INDEX_REBUILD_DELTA_ROWS or LOCAL_INDEX_REBUILD_INTERVAL):
+        maintenance = asyncio.create_task(local_index_maintenance())
+    await batcher.start()
+    if JOBS_ENABLED:
+        try:
+            await job_store.ensure_table()
+            await job_runner.start()
+        except psycopg.Error as e:
+            logger.warning("Could not create embedding jobs table, jobs disabled: %s", e)
+    try:
+        yield
+    finally:
+        if maintenance is not None:
+            maintenance.cancel()
+        # Le job en cours repart en file avec son point de reprise
+        await job_runner.stop()
+        await batcher.stop()
+        if inference_client is not None:
+            await inference_client.stop()
+        inference_executor.shutdown(wait=False, cancel_futures=True)
+        await db_pool.close()
+
+# Initialiser FastAPI
+app = FastAPI(title="Sawem Embedding API", lifespan=lifespan)
+request_latency = RouteLatency()
+app.add_middleware(RequestMetricsMiddleware, latency=request_latency)
 
 # Modèle Pydantic pour requête JSON
+OutputDtype = Literal["float32", "float16", "int8", "ubinary"]
+
+# Dimensions réduites (projection PCA) proposées par /embed
+ReducedDims = Literal[64, 128, 192]
+
 class TextInput(BaseModel):
     text: str
+    output_dtype: OutputDtype = "float32"
+    dims: Optional[ReducedDims] = None
+
+# Élément d'un lot : l'id est renvoyé tel quel avec son embedding
+class BatchItem(BaseModel):
+    id: Union[int, str]
+    text: str
+
+class BatchInput(BaseModel):
+    items: List[BatchItem]
+    batch_size: Optional[int] = None
+    output_dtype: OutputDtype = "float32"
+    dims: Optional[ReducedDims] = None
+
+# Mode document : fenêtres de tokens puis vecteur du document par pooling
+class DocumentItem(BaseModel):
+    id: Union[int, str]
+    text: str
+
+class DocumentInput(BaseModel):
+    documents: List[DocumentItem]
+    chunking: bool = True
+    window: Optional[int] = None
+    stride: Optional[int] = None
+    pooling: Literal["mean", "weighted"] = "mean"
+    include_chunks: bool = True
+    batch_size: Optional[int] = None
+
+# Recherche k-NN : ef_search (HNSW) et probes (IVFFlat) ne valent que pour la requête
+class SearchInput(BaseModel):
+    query: str
+    k: int = 10
+    metric: Literal["cosine", "l2", "ip"] = "cosine"
+    ef_search: Optional[int] = None
+    probes: Optional[int] = None
+    include_metadata: bool = True
+
+# Calibration int8 : textes fournis, sinon échantillon de la table pgvector
+class CalibrationInput(BaseModel):
+    texts: Optional[List[str]] = None
+    sample_size: int = 10000
+    percentile: Optional[float] = None
+
+# Projection PCA : textes fournis, sinon échantillon de la table pgvector ;
+# une fraction (holdout) est gardée hors ajustement pour l'évaluation
+class ReductionInput(BaseModel):
+    texts: Optional[List[str]] = None
+    sample_size: int = 50000
+    method: Literal["pca", "randomized"] = "pca"
+    holdout: float = 0.2
+    k: int = 10
+    queries: int = 500
+
+# Similarité requête(s) / candidats : top-k en JSON, matrice de scores en binaire
+class SimilarityInput(BaseModel):
+    query: Optional[str] = None
+    queries: Optional[List[str]] = None
+    candidates: List[str]
+    top_k: int = 10
+    include_text: bool = False
+    output_dtype: Literal["float32", "float16"] = "float32"
+
+# Index en mémoire : recherche, ajouts, reconstruction d'instantané
+class LocalSearchInput(BaseModel):
+    query: Optional[str] = None
+    queries: Optional[List[str]] = None
+    k: int = 10
+    mode: Literal["auto", "exact", "ivf"] = "auto"
+    nprobe: Optional[int] = None
+
+class LocalAddInput(BaseModel):
+    items: List[BatchItem]
+
+class LocalSnapshotInput(BaseModel):
+    ivf: bool = False
+    nlist: Optional[int] = None
+    train_size: Optional[int] = None
+    from_table: Optional[str] = None
+
+class IndexInput(BaseModel):
+    kind: Literal["hnsw", "ivfflat"] = "hnsw"
+    metric: Literal["cosine", "l2", "ip"] = "cosine"
+    m: int = 16
+    ef_construction: int = 64
+    lists: Optional[int] = None
+    concurrently: bool = False
+
+ResponseFormat = Literal["json", "base64", "raw", "npy"]
+
+# Réponse binaire (raw / npy) : forme, dtype et quantification passent dans les en-têtes
+def binary_response(array, fmt, output_dtype="float32", quantization=None):
+    return Response(
+        content=embedding_codec.to_bytes(array, fmt),
+        media_type=embedding_codec.MEDIA_TYPES[fmt],
+        headers=embedding_codec.array_headers(array, MODEL_NAME, output_dtype, quantization),
+    )
+
+def quantize_output(vectors, output_dtype):
+    return quantize(vectors, output_dtype, get_int8_calibration() if output_dtype == "int8" else None)
+
+# Projection en dims dimensions (vecteurs re-normalisés), inchangés si dims est None
+def reduce_output(vectors, dims, output_dtype):
+    if dims is None:
+        return vectors
+    if output_dtype == "int8":
+        # La calibration int8 porte sur les dimensions du modèle
+        raise ValueError("int8 output is not available with reduced dims")
+    current = get_projection()
+    if current is None:
+        raise ProjectionMissingError("Reduced dims require a PCA projection (POST /reduction/fit)")
+    return current.transform(vectors, dims)
+
+# Réponse 429 : Retry-After estimé d'après le débit d'écoulement observé
+def too_busy(detail):
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(admission.retry_after())})
+
+# Textes qui passeront vraiment par le modèle : absents du cache mémoire et
+# pas déjà en cours de calcul pour une autre requête (doublons comptés une fois)
+def model_bound(texts):
+    pending = {}
+    for text in texts:
+        key = text_key(text)
+        if key not in pending and key not in embedding_cache and key not in single_flight:
+            pending[key] = text
+    return list(pending.values())
+
+# Réserve la part de travail d'une requête le temps de la traiter ; seuls les
+# textes à encoder comptent. Les documents découpés (truncated=False) comptent
+# en entier : leurs fenêtres ne sont connues qu'après découpage
+@contextmanager
+def admitted(texts, truncated=True):
+    tokens = admission.estimate(model_bound(texts) if truncated else texts, truncated)
+    if not admission.try_acquire(tokens):
+        raise too_busy(f"Server busy: {admission.queued_tokens} tokens in flight, limit {admission.max_tokens}")
+    try:
+        yield
+    finally:
+        admission.release(tokens)
 
 # Endpoint racine
 @app.get("/")
@@ -28,25 +576,762 @@ async def root():
 
 # Endpoint pour générer embeddings
 @app.post("/embed")
-async def embed_text(input: TextInput):
+async def embed_text(input: TextInput, request: Request, format: Optional[ResponseFormat] = None):
+    fmt = embedding_codec.negotiate(request.headers.get("accept"), format)
+    with admitted([input.text]):
+        try:
+            vector = reduce_output(await embed_one(input.text), input.dims, input.output_dtype)
+            vector, quantization = quantize_output(vector, input.output_dtype)
+            if fmt in embedding_codec.MEDIA_TYPES:
+                return binary_response(vector, fmt, input.output_dtype, quantization)
+            if fmt == "base64":
+                body = {
+                    "text": input.text,
+                    "embedding": embedding_codec.to_base64(vector),
+                    "dtype": embedding_codec.little_endian(vector).dtype.str,
+                    "shape": list(vector.shape),
+                }
+            else:
+                body = {"text": input.text, "embedding": vector.tolist()}
+            if input.output_dtype != "float32":
+                body["output_dtype"] = input.output_dtype
+                body["quantization"] = quantization
+            return body
+        except (CalibrationMissingError, ProjectionMissingError) as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+# Endpoint pour générer les embeddings d'un lot de textes en un seul appel au modèle
+@app.post("/embed/batch")
+async def embed_batch(input: BatchInput, request: Request, format: Optional[ResponseFormat] = None):
+    fmt = embedding_codec.negotiate(request.headers.get("accept"), format)
+    if len(input.items) > EMBED_MAX_BATCH_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many items: {len(input.items)} > {EMBED_MAX_BATCH_ITEMS}",
+        )
+    batch_size = input.batch_size or EMBED_BATCH_SIZE
+    if batch_size < 1:
+        raise HTTPException(status_code=422, detail="batch_size must be >= 1")
+    with admitted([item.text for item in input.items]):
+        try:
+            # Les vecteurs reviennent dans l'ordre d'entrée (cache + encode() des absents)
+            vectors = await embed_many([item.text for item in input.items], batch_size=batch_size)
+            vectors = reduce_output(vectors, input.dims, input.output_dtype)
+            vectors, quantization = quantize_output(vectors, input.output_dtype)
+            # Formats binaires : une matrice (n, dim) dont les lignes suivent l'ordre des items
+            if fmt in embedding_codec.MEDIA_TYPES:
+                return binary_response(vectors, fmt, input.output_dtype, quantization)
+            if fmt == "base64":
+                body = {
+                    "model": MODEL_NAME,
+                    "count": len(input.items),
+                    "dtype": embedding_codec.little_endian(vectors).dtype.str,
+                    "dim": vectors.shape[1],
+                    "embeddings": [
+                        {"id": item.id, "embedding": embedding_codec.to_base64(vector)}
+                        for item, vector in zip(input.items, vectors)
+                    ],
+                }
+            else:
+                body = {
+                    "model": MODEL_NAME,
+                    "count": len(input.items),
+                    "embeddings": [
+                        {"id": item.id, "embedding": vector.tolist()}
+                        for item, vector in zip(input.items, vectors)
+                    ],
+                }
+            if input.output_dtype != "float32":
+                body["output_dtype"] = input.output_dtype
+                body["quantization"] = quantization
+            return body
+        except (CalibrationMissingError, ProjectionMissingError) as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+# Découpage (CPU) des documents : fenêtres, ou texte entier et tokens perdus
+def split_documents(documents, chunking, window, stride):
+    if chunking:
+        return [document_chunker.split(doc.text, window, stride) for doc in documents], None
+    dropped = [document_chunker.dropped_tokens(doc.text) for doc in documents]
+    return [[{"start": 0, "end": len(doc.text), "text": doc.text}] for doc in documents], dropped
+
+# Endpoint des documents longs : toutes les fenêtres de tous les documents
+# sont encodées ensemble, puis regroupées par document
+@app.post("/embed/document")
+async def embed_document(input: DocumentInput):
+    batch_size = input.batch_size or EMBED_BATCH_SIZE
+    if batch_size < 1:
+        raise HTTPException(status_code=422, detail="batch_size must be >= 1")
+    try:
+        window, stride = document_chunker.window_params(input.window or DOC_CHUNK_WINDOW, input.stride or DOC_CHUNK_STRIDE)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    # Découpés en fenêtres, les documents sont encodés en entier : pas de troncature
+    with admitted([doc.text for doc in input.documents], truncated=not input.chunking):
+        chunks, dropped = await run_inference(split_documents, input.documents, input.chunking, window, stride)
+        total = sum(len(doc_chunks) for doc_chunks in chunks)
+        if total > EMBED_MAX_BATCH_ITEMS:
+            raise HTTPException(status_code=413, detail=f"Too many chunks: {total} > {EMBED_MAX_BATCH_ITEMS}")
+        try:
+            vectors = await embed_many([chunk["text"] for doc_chunks in chunks for chunk in doc_chunks], batch_size)
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    results = []
+    offset = 0
+    for i, (doc, doc_chunks) in enumerate(zip(input.documents, chunks)):
+        doc_vectors = vectors[offset:offset + len(doc_chunks)]
+        offset += len(doc_chunks)
+        result = {"id": doc.id}
+        if input.chunking:
+            tokens = [chunk["tokens"] for chunk in doc_chunks]
+            result["embedding"] = pool(doc_vectors, tokens, input.pooling, NORMALIZE_EMBEDDINGS).tolist()
+            result["tokens"] = sum(tokens)
+            if input.include_chunks:
+                result["chunks"] = [
+                    {"start": chunk["start"], "end": chunk["end"], "tokens": chunk["tokens"], "embedding": vector.tolist()}
+                    for chunk, vector in zip(doc_chunks, doc_vectors)
+                ]
+        else:
+            result["embedding"] = doc_vectors[0].tolist()
+            result["dropped_tokens"] = dropped[i]
+        results.append(result)
+    body = {"model": MODEL_NAME, "count": len(results), "documents": results}
+    if input.chunking:
+        body.update({"window": window, "stride": stride, "pooling": input.pooling})
+    return body
+
+# Scores cosinus (n_requêtes, n_candidats) : une multiplication de matrices normalisées
+def similarity_scores(query_vectors, candidate_vectors):
+    def unit(vectors):
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), np.float32(1e-12))
+    return unit(query_vectors) @ unit(candidate_vectors).T
+
+# Endpoint de reranking : requête(s) et candidats encodés en un seul appel
+@app.post("/similarity")
+async def similarity(input: SimilarityInput, request: Request, format: Optional[ResponseFormat] = None):
+    fmt = embedding_codec.negotiate(request.headers.get("accept"), format)
+    queries = ([input.query] if input.query is not None else []) + (input.queries or [])
+    if not queries or not input.candidates:
+        raise HTTPException(status_code=422, detail="query (or queries) and candidates are required")
+    if len(queries) + len(input.candidates) > EMBED_MAX_BATCH_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many texts: {len(queries) + len(input.candidates)} > {EMBED_MAX_BATCH_ITEMS}",
+        )
+    if input.top_k < 1:
+        raise HTTPException(status_code=422, detail="top_k must be >= 1")
+    texts = queries + input.candidates
+    with admitted(texts):
+        try:
+            vectors = await embed_many(texts)
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    scores = await run_inference(similarity_scores, vectors[:len(queries)], vectors[len(queries):])
+    if fmt in embedding_codec.MEDIA_TYPES:
+        return binary_response(scores.astype(input.output_dtype), fmt, input.output_dtype)
+    if fmt == "base64":
+        matrix = embedding_codec.little_endian(scores.astype(input.output_dtype))
+        return {
+            "model": MODEL_NAME,
+            "scores": embedding_codec.to_base64(matrix),
+            "dtype": matrix.dtype.str,
+            "shape": list(matrix.shape),
+        }
+    k = min(input.top_k, len(input.candidates))
+    best = await run_inference(top_k_rows, scores, k)
+    results = []
+    for i, (row, indices) in enumerate(zip(scores, best)):
+        matches = [{"index": int(j), "score": float(row[j])} for j in indices]
+        if input.include_text:
+            for match in matches:
+                match["text"] = input.candidates[match["index"]]
+        results.append({"query": i, "matches": matches})
+    return {"model": MODEL_NAME, "top_k": k, "candidates": len(input.candidates), "results": results}
+
+# Endpoint de recherche des k plus proches voisins dans la table pgvector
+@app.post("/search")
+async def search(input: SearchInput):
+    if not 1 <= input.k <= 1000:
+        raise HTTPException(status_code=422, detail="k must be between 1 and 1000")
+    with admitted([input.query]):
+        try:
+            vector = await embed_one(input.query)
+            results = await vector_store.search(
+                vector,
+                k=input.k,
+                metric=input.metric,
+                ef_search=input.ef_search,
+                probes=input.probes,
+                include_metadata=input.include_metadata,
+            )
+            return {"model": MODEL_NAME, "k": input.k, "metric": input.metric, "results": results}
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except psycopg.Error as e:
+            raise HTTPException(status_code=500, detail=f"Vector search failed: {e}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+def require_local_index():
+    if local_index is None:
+        raise HTTPException(status_code=503, detail="Local index is disabled (LOCAL_INDEX_ENABLED)")
+    return local_index
+
+# État de l'index en mémoire : instantané, ajouts en attente, reconstruction
+@app.get("/local-index")
+async def local_index_stats():
+    index = require_local_index()
+    return dict(await asyncio.to_thread(index.stats), model=MODEL_NAME)
+
+# Recherche dans l'index en mémoire, sans aller-retour vers PostgreSQL
+@app.post("/local-index/search")
+async def local_index_search(input: LocalSearchInput):
+    index = require_local_index()
+    queries = ([input.query] if input.query is not None else []) + (input.queries or [])
+    if not queries:
+        raise HTTPException(status_code=422, detail="query (or queries) is required")
+    if not 1 <= input.k <= 1000:
+        raise HTTPException(status_code=422, detail="k must be between 1 and 1000")
+    with admitted(queries):
+        try:
+            vectors = await embed_many(queries)
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
     try:
-        embeddings = model.encode(input.text).tolist()
-        return {"text": input.text, "embedding": embeddings}
+        results, params = await run_inference(index.search, vectors, input.k, input.mode, input.nprobe)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except IndexMismatchError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {
+        "model": MODEL_NAME,
+        "k": input.k,
+        **params,
+        "results": [[{"id": i, "score": score} for i, score in matches] for matches in results],
+    }
+
+# Ajout (ou remplacement) de textes : visibles par tous les workers sans reconstruction
+@app.post("/local-index/add")
+async def local_index_add(input: LocalAddInput):
+    index = require_local_index()
+    if len(input.items) > EMBED_MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many items: {len(input.items)} > {EMBED_MAX_BATCH_ITEMS}")
+    texts = [item.text for item in input.items]
+    with admitted(texts):
+        try:
+            vectors = await embed_many(texts)
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        added = await asyncio.to_thread(index.append, [str(item.id) for item in input.items], vectors)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"model": MODEL_NAME, "added": added}
+
+async def build_local_snapshot(builder, ivf=False, nlist=None, train_size=None, from_table=None):
+    local_index.building = True
+    try:
+        if from_table:
+            async for ids, vectors in scan_vectors(db_connection, from_table, CLUSTER_BATCH_SIZE):
+                await asyncio.to_thread(builder.add, ids, vectors)
+        else:
+            await asyncio.to_thread(builder.add_current)
+        result = await asyncio.to_thread(builder.finish, ivf, nlist, train_size)
+        logger.info("Local index snapshot rebuilt: %s", result)
     except Exception as e:
+        logger.exception("Local index rebuild failed")
+        local_index.last_build = {"error": str(e)}
+    finally:
+        builder.close()
+        local_index.building = False
+
+def start_local_build(coro):
+    task = asyncio.create_task(coro)
+    local_index_builds.add(task)
+    task.add_done_callback(local_index_builds.discard)
+
+# Reconstruction périodique : chaque worker vérifie les seuils, le verrou de
+# reconstruction (non bloquant) n'en laisse passer qu'un à la fois
+async def local_index_maintenance(check_every=30.0):
+    while True:
+        await asyncio.sleep(check_every)
+        try:
+            reason = await asyncio.to_thread(
+                local_index.rebuild_due, LOCAL_INDEX_REBUILD_DELTA_ROWS, LOCAL_INDEX_REBUILD_INTERVAL
+            )
+            if reason is None or local_index.building:
+                continue
+            builder = await asyncio.to_thread(local_index.builder)
+        except IndexBusyError:
+            continue
+        except (OSError, IndexMismatchError) as e:
+            logger.warning("Local index maintenance check failed: %s", e)
+            continue
+        # Même organisation que l'instantané courant (exact, ou IVF à nlist listes)
+        manifest = builder.source.manifest
+        logger.info("Rebuilding local index snapshot (%s)", reason)
+        start_local_build(build_local_snapshot(builder, manifest.get("ivf", False), manifest.get("nlist")))
+
+# Nouvel instantané (fusion des ajouts, listes IVF réentraînées) en tâche de
+# fond ; depuis une table pgvector si from_table
+@app.post("/local-index/snapshot", status_code=202)
+async def local_index_snapshot(input: LocalSnapshotInput):
+    index = require_local_index()
+    try:
+        builder = await asyncio.to_thread(index.builder)
+    except IndexBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    start_local_build(build_local_snapshot(builder, input.ivf, input.nlist, input.train_size, input.from_table))
+    return {"model": MODEL_NAME, "building": True, "from": input.from_table or "current snapshot"}
+
+# Gestion des index ANN de la table pgvector
+@app.get("/index")
+async def list_indexes():
+    try:
+        return {"table": VECTOR_TABLE, "indexes": await vector_store.list_indexes()}
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/index")
+async def create_index(input: IndexInput):
+    try:
+        await vector_store.ensure_schema()
+        return await vector_store.create_index(
+            input.kind,
+            input.metric,
+            m=input.m,
+            ef_construction=input.ef_construction,
+            lists=input.lists,
+            concurrently=input.concurrently,
+        )
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Index creation failed: {e}")
+
+@app.delete("/index/{kind}/{metric}")
+async def drop_index(kind: Literal["hnsw", "ivfflat"], metric: Literal["cosine", "l2", "ip"]):
+    try:
+        await vector_store.drop_index(kind, metric)
+        return {"dropped": vector_store.index_name(kind, metric)}
+    except psycopg.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Ingestion en masse d'un flux NDJSON/CSV (id, text, metadata) dans la table pgvector
+@app.post("/ingest")
+async def ingest(
+    request: Request,
+    format: Optional[Literal["ndjson", "csv"]] = None,
+    on_conflict: Literal["update", "error"] = "update",
+):
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    try:
+        await vector_store.ensure_schema()
+        return await ingest_records(
+            iter_records(request.stream(), fmt),
+            partial(compute_embeddings, batch_size=EMBED_BATCH_SIZE),
+            db_connection,
+            VECTOR_TABLE,
+            batch_size=INGEST_BATCH_SIZE,
+            upsert=on_conflict == "update",
+        )
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e), "committed": e.stats})
+    except psycopg.errors.UniqueViolation as e:
+        raise HTTPException(status_code=409, detail=f"Duplicate id: {e}")
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Ingestion failed: {e}")
+
+# Job asynchrone : source table / requête (fichiers : /jobs/upload)
+class JobInput(BaseModel):
+    source: Dict[str, Any]
+    target_table: Optional[str] = None
+    batch_size: Optional[int] = None
+
+async def create_job(source, target_table, batch_size, total_rows=None):
+    if not JOBS_ENABLED:
+        raise HTTPException(status_code=503, detail="Embedding jobs are disabled (JOBS_ENABLED)")
+    batch_size = batch_size or JOBS_BATCH_SIZE
+    if batch_size < 1:
+        raise HTTPException(status_code=422, detail="batch_size must be >= 1")
+    try:
+        validate_source(source, JOBS_ALLOW_SQL)
+        if total_rows is None:
+            total_rows = await estimate_rows(db_connection, source)
+        job = await job_store.create(source, target_table or VECTOR_TABLE, MODEL_NAME, batch_size, total_rows)
+    except JobError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not create job: {e}")
+    return describe(job)
+
+# Soumission d'un job lisant une table ou une requête PostgreSQL
+@app.post("/jobs", status_code=202)
+async def submit_job(input: JobInput):
+    if input.source.get("type") == "file":
+        raise HTTPException(status_code=422, detail="Upload files with POST /jobs/upload")
+    return await create_job(input.source, input.target_table, input.batch_size)
+
+# Soumission d'un job sur un fichier NDJSON/CSV envoyé dans le corps (chunked accepté)
+@app.post("/jobs/upload", status_code=202)
+async def upload_job(
+    request: Request,
+    format: Optional[Literal["ndjson", "csv"]] = None,
+    target_table: Optional[str] = None,
+    batch_size: Optional[int] = None,
+):
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    too_large = HTTPException(status_code=413, detail=f"Upload larger than {JOBS_MAX_UPLOAD_BYTES} bytes")
+    if int(request.headers.get("content-length") or 0) > JOBS_MAX_UPLOAD_BYTES:
+        raise too_large
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = os.path.abspath(os.path.join(JOBS_DIR, f"{uuid.uuid4().hex}.{fmt}"))
+    lines = size = 0
+    try:
+        with open(path + ".part", "wb") as f:
+            # Corps chunked : la taille n'est connue qu'en lisant
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > JOBS_MAX_UPLOAD_BYTES:
+                    raise too_large
+                lines += chunk.count(b"\n")
+                await asyncio.to_thread(f.write, chunk)
+        os.replace(path + ".part", path)
+    except (OSError, HTTPException) as e:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=500, detail=f"Could not store upload: {e}")
+    # Estimation : une ligne par enregistrement (moins l'en-tête CSV)
+    estimate = max(0, lines - 1) if fmt == "csv" else lines
+    return await create_job({"type": "file", "path": path, "format": fmt}, target_table, batch_size, estimate or None)
+
+# Clustering MiniBatchKMeans des vecteurs d'une table pgvector
+class ClusterJobInput(BaseModel):
+    k: int
+    table: Optional[str] = None
+    target_table: Optional[str] = None
+    passes: int = 1
+    batch_size: Optional[int] = None
+    seed: int = 0
+
+# Soumission d'un job de clustering : affectations dans target_table
+# (<table>_clusters par défaut), centroïdes dans <target_table>_centroids
+@app.post("/jobs/cluster", status_code=202)
+async def submit_cluster_job(input: ClusterJobInput):
+    if not JOBS_ENABLED:
+        raise HTTPException(status_code=503, detail="Embedding jobs are disabled (JOBS_ENABLED)")
+    table = input.table or VECTOR_TABLE
+    params = {
+        "table": table,
+        "k": input.k,
+        "passes": input.passes,
+        "batch_size": input.batch_size or max(CLUSTER_BATCH_SIZE, input.k),
+        "seed": input.seed,
+    }
+    try:
+        validate_clustering(params)
+        rows = await estimate_rows(db_connection, {"type": "table", "table": table})
+        # Progression : passes d'ajustement puis passe d'affectation
+        total_rows = rows * (input.passes + 1) if rows else None
+        job = await job_store.create(
+            params, input.target_table or f"{table}_clusters", MODEL_NAME, params["batch_size"], total_rows, kind="cluster"
+        )
+    except JobError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not create job: {e}")
+    return describe(job)
+
+@app.get("/jobs")
+async def list_jobs(status: Optional[str] = None, limit: int = 50):
+    if status is not None and status not in JOB_STATUSES:
+        raise HTTPException(status_code=422, detail=f"status must be one of {', '.join(JOB_STATUSES)}")
+    try:
+        jobs = await job_store.list(max(1, min(limit, 500)), status)
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not list jobs: {e}")
+    return {"jobs": [describe(job) for job in jobs]}
+
+# État, progression et débit d'un job
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: int):
+    try:
+        job = await job_store.get(job_id)
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not read job: {e}")
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    return describe(job)
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: int):
+    try:
+        job = await job_store.cancel(job_id)
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not cancel job: {e}")
+    if job is None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is not queued or running")
+    # Le runner qui lisait le fichier s'arrête à son prochain point de reprise
+    remove_upload(job)
+    return describe(job)
+
+# Vecteurs d'ajustement (calibration int8, projection PCA) : textes fournis,
+# bornés et admis comme un lot, sinon échantillon de la table pgvector
+async def sample_embeddings(texts, sample_size):
+    if not texts:
+        return await vector_store.sample_vectors(sample_size)
+    if len(texts) > EMBED_MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Too many texts: {len(texts)} > {EMBED_MAX_BATCH_ITEMS}")
+    with admitted(texts):
+        try:
+            return await embed_many(texts)
+        except QueueFullError as e:
+            admission.reject("queue_full")
+            raise too_busy(str(e))
+        except InferenceUnavailableError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+# Paramètres de quantification int8 en vigueur
+@app.get("/quantization/int8")
+async def int8_params():
+    calibration = get_int8_calibration()
+    if calibration is None:
+        raise HTTPException(status_code=404, detail="No int8 calibration for this model")
+    return dict(calibration.params(), model=MODEL_NAME)
+
+# Calcule et persiste les bornes int8 par dimension
+@app.post("/quantization/calibrate")
+async def calibrate_int8(input: CalibrationInput):
+    global int8_calibration, int8_calibration_mtime
+    try:
+        sample = await sample_embeddings(input.texts, input.sample_size)
+        if len(sample) == 0:
+            raise HTTPException(status_code=422, detail="No vectors to calibrate on")
+        calibration = Int8Calibration.fit(sample, ENCODER_ID, input.percentile)
+        await asyncio.to_thread(calibration.save, int8_calibration_file)
+        int8_calibration = calibration
+        int8_calibration_mtime = os.stat(int8_calibration_file).st_mtime
+        return {"model": MODEL_NAME, "samples": calibration.samples, "path": int8_calibration_file}
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not sample stored vectors: {e}")
+
+# Projection PCA en vigueur : variance conservée par dimension
+@app.get("/reduction")
+async def reduction_params():
+    current = get_projection()
+    if current is None:
+        raise HTTPException(status_code=404, detail="No PCA projection for this model")
+    return dict(current.params(), model=MODEL_NAME)
+
+# Ajuste, persiste et évalue (recall@k par dimension) la projection PCA
+@app.post("/reduction/fit")
+async def fit_reduction(input: ReductionInput):
+    global projection, projection_mtime
+    if not 0 <= input.holdout < 1:
+        raise HTTPException(status_code=422, detail="holdout must be in [0, 1)")
+    try:
+        sample = await sample_embeddings(input.texts, input.sample_size)
+    except psycopg.Error as e:
+        raise HTTPException(status_code=500, detail=f"Could not sample stored vectors: {e}")
+    held = int(len(sample) * input.holdout)
+    fit_on, eval_on = (sample[held:], sample[:held]) if held >= 2 else (sample, sample)
+    if len(fit_on) < 2:
+        raise HTTPException(status_code=422, detail="Need at least 2 vectors to fit a projection")
+    fitted = await run_inference(PcaProjection.fit, fit_on, ENCODER_ID, method=input.method)
+    await asyncio.to_thread(fitted.save, projection_file)
+    projection = fitted
+    projection_mtime = os.stat(projection_file).st_mtime
+    report = await run_inference(evaluate, fitted, eval_on, input.k, input.queries)
+    return dict(fitted.params(), model=MODEL_NAME, path=projection_file, evaluation=report)
+
+# Statistiques du cache d'embeddings
+@app.get("/cache/stats")
+async def cache_stats():
+    stats = embedding_cache.stats()
+    stats["postgres"] = pg_cache.stats() if pg_cache is not None else {"enabled": False}
+    stats["single_flight"] = single_flight.stats()
+    return stats
+
+# Statistiques du processus d'inférence partagé, None en mode local
+async def remote_inference_stats():
+    if inference_client is None:
+        return None
+    return await inference_client.stats()
+
+# Statistiques d'inférence : micro-batching et padding des passes avant
+@app.get("/inference/stats")
+async def inference_stats():
+    stats = {
+        "mode": INFERENCE_MODE,
+        "backend": EMBEDDING_BACKEND,
+        "microbatch": {"batches": batcher.batches, "items": batcher.items, "queued": batcher.qsize()},
+        "admission": admission.stats(),
+    }
+    try:
+        remote = await remote_inference_stats()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Inference process unavailable: {e}")
+    if remote is not None:
+        remote_batcher = remote["microbatch"]
+        stats["inference_microbatch"] = {key: remote_batcher[key] for key in ("batches", "items", "queued")}
+        stats["bucketing"] = remote.get("bucketing", {"enabled": False})
+    else:
+        stats["threads"] = {"cpu_budget": CPU_BUDGET, "concurrent_passes": INFERENCE_WORKERS, "intra_op": INTRA_OP_THREADS}
+        stats["bucketing"] = encoder.stats() if hasattr(encoder, "stats") else {"enabled": False}
+    return stats
+
+# Métriques Prometheus du worker (et du processus d'inférence en mode shared)
+@app.get("/metrics")
+async def metrics():
+    out = Exposition({"pid": os.getpid()})
+    request_latency.export(out)
+
+    # Files de micro-batching : celle du worker, et celle du processus
+    # d'inférence en mode shared (valeurs globales à ce processus : même série
+    # quel que soit le worker scrapé)
+    queues = [({"stage": "worker"}, batcher.queue_wait, batcher.batch_sizes, batcher.qsize())]
+    bucketing = pass_sizes = None
+    tokens = getattr(encoder, "tokens", None)
+    labels = {}
+    if hasattr(encoder, "stats"):
+        bucketing, pass_sizes = encoder.stats(), encoder.pass_sizes
+    if inference_client is not None:
+        try:
+            remote = await remote_inference_stats()
+        except Exception as e:
+            logger.warning("Could not read inference process stats: %s", e)
+            remote = None
+        out.gauge("embedding_inference_up", "Shared inference process reachable", int(remote is not None))
+        out.counter("embedding_inference_reconnects_total", "Reconnections to the shared inference process",
+                    inference_client.reconnects)
+        if remote is not None:
+            labels = {"pid": remote["pid"]}
+            remote_batcher = remote["microbatch"]
+            queues.append((
+                {"stage": "inference", **labels},
+                Histogram.from_snapshot(remote_batcher["queue_wait"]),
+                Histogram.from_snapshot(remote_batcher["batch_sizes"]),
+                remote_batcher["queued"],
+            ))
+            tokens = remote.get("tokens")
+            bucketing = remote.get("bucketing")
+            if bucketing is not None:
+                pass_sizes = Histogram.from_snapshot(remote["pass_sizes"])
+    for queue_labels, queue_wait, _, _ in queues:
+        out.histogram("embedding_queue_wait_seconds", "Time spent in the micro-batching queue", queue_wait, **queue_labels)
+    for queue_labels, _, batch_sizes, _ in queues:
+        out.histogram("embedding_microbatch_size", "Items per micro-batch", batch_sizes, **queue_labels)
+    for queue_labels, _, _, depth in queues:
+        out.gauge("embedding_queue_depth", "Items waiting in the micro-batching queue", depth, **queue_labels)
+
+    out.gauge("embedding_admission_inflight_tokens", "Estimated tokens admitted and not yet answered", admission.queued_tokens)
+    out.gauge("embedding_admission_limit_tokens", "In-flight token limit (0 = disabled)", admission.max_tokens)
+    out.gauge("embedding_admission_drain_tokens_per_second", "Observed drain rate of admitted tokens", admission.drain_rate)
+    for reason, count in admission.rejected.items():
+        out.counter("embedding_admission_rejected_total", "Requests rejected with 429", count, reason=reason)
+
+    out.counter("embedding_items_total", "Texts sent to the model (cache misses)", items_encoded.value)
+    out.counter("embedding_dedup_saved_items_total", "Texts not sent to the model thanks to deduplication", single_flight.in_batch, scope="request")
+    out.counter("embedding_dedup_saved_items_total", "Texts not sent to the model thanks to deduplication", single_flight.in_flight, scope="in_flight")
+    out.gauge("embedding_dedup_pending_keys", "Distinct texts currently being encoded", len(single_flight))
+    if tokens is not None:
+        out.counter("embedding_tokens_total", "Real tokens run through the model", tokens, **labels)
+    if bucketing is not None:
+        out.counter("embedding_forward_passes_total", "Model forward passes", bucketing["forward_passes"], **labels)
+        out.counter("embedding_padded_tokens_total", "Tokens computed including padding", bucketing["padded_tokens"], **labels)
+        out.histogram("embedding_forward_batch_size", "Texts per forward pass", pass_sizes, **labels)
+
+    caches = {"memory": embedding_cache.stats()}
+    if pg_cache is not None:
+        caches["postgres"] = pg_cache.stats()
+    # Une famille de métriques = un bloc contigu dans l'exposition
+    for name, stats in caches.items():
+        out.counter("embedding_cache_hits_total", "Embedding cache hits", stats["hits"], cache=name)
+    for name, stats in caches.items():
+        out.counter("embedding_cache_misses_total", "Embedding cache misses", stats["misses"], cache=name)
+    for name, stats in caches.items():
+        out.gauge("embedding_cache_hit_ratio", "Embedding cache hit ratio since start", stats["hit_ratio"], cache=name)
+    out.gauge("embedding_cache_resident_bytes", "Bytes held by the in-memory cache", caches["memory"]["resident_bytes"])
+
+    pool = db_pool.get_stats()
+    out.gauge("embedding_db_pool_size", "Open connections in the pool", pool.get("pool_size", 0))
+    out.gauge("embedding_db_pool_available", "Idle connections in the pool", pool.get("pool_available", 0))
+    out.gauge("embedding_db_pool_waiting", "Requests waiting for a connection", pool.get("requests_waiting", 0))
+    out.counter("embedding_db_pool_requests_total", "Connections requested from the pool", pool.get("requests_num", 0))
+    out.counter("embedding_db_pool_errors_total", "Failed connection attempts", pool.get("connections_errors", 0))
+
+    out.gauge("process_resident_memory_bytes", "Resident set size of the worker", process_rss_bytes())
+    return Response(out.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Endpoint pour tester la connexion PostgreSQL
 @app.get("/db-test")
 async def db_test():
     try:
-        with psycopg.connect(DATABASE_URL, row_factory=dict_row) as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1 AS result;")
-                row = cur.fetchone()
+        async with db_connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute("SELECT 1 AS result;")
+                row = await cur.fetchone()
                 return {"db_test": row["result"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database connection failed: {e}")
 
+# Statistiques du pool de connexions
+@app.get("/db/pool/stats")
+async def db_pool_stats():
+    stats = db_pool.get_stats()
+    return {
+        "min_size": stats.get("pool_min", DB_POOL_MIN_SIZE),
+        "max_size": stats.get("pool_max", DB_POOL_MAX_SIZE),
+        "size": stats.get("pool_size", 0),
+        "available": stats.get("pool_available", 0),
+        "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+        "waiting": stats.get("requests_waiting", 0),
+        "requests": stats.get("requests_num", 0),
+        "connection_errors": stats.get("connections_errors", 0),
+        "raw": stats,
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("embedding_server:app", host="0.0.0.0", port=int(os.getenv("PORT", 10000)), reload=False)
@@ -0,0 +1,109 @@
+# gunicorn.conf.py
+"""
+Configuration gunicorn du service d'embeddings.
+
+Avec preload_app, embedding_server est importé une seule fois dans le
+processus maître : les poids du SentenceTransformer sont chargés avant le
+fork et les workers partagent leurs pages mémoire en copy-on-write. Le
+modèle n'est jamais exécuté dans le maître (aucun pool de threads torch ou
+onnxruntime n'y démarre), et gc.freeze() évite que le ramasse-miettes des
+workers ne réécrive les pages des objets hérités.
+
+Avec INFERENCE_MODE=shared, le maître lance en plus un processus
+d'inférence unique (embedding_ipc.py serve) que les workers joignent par
+mémoire partagée. Un thread du maître le surveille et le relance s'il
+s'arrête (délai croissant s'il meurt dès le démarrage) ; les workers s'y
+reconnectent d'eux-mêmes. Il est arrêté avec gunicorn.
+
+Les cœurs disponibles (quota cgroup compris, voir cpu_budget.py) sont
+partagés entre les workers : chacun reçoit CPU_BUDGET = cœurs / workers
+pour ses threads torch. En mode shared, seul le processus d'inférence
+calcule et reçoit tous les cœurs.
+
+Mesurer l'effet (RSS unique par worker) :
+
+    GUNICORN_PRELOAD=0 gunicorn -c gunicorn.conf.py embedding_server:app &
+    python mem_report.py --pid <pid du maître>
+"""
+
+import gc
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cpu_budget import available_cores, default_workers
+
+cores = available_cores()
+shared_inference = os.getenv("INFERENCE_MODE", "local") == "shared"
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 0)) or default_workers(cores)
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("GUNICORN_PRELOAD", "1").lower() in ("1", "true", "yes")
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+
+inference_process = None
+inference_stopping = threading.Event()
+# Un processus d'inférence qui meurt avant ce délai est relancé avec un délai croissant
+INFERENCE_RESTART_MIN_UPTIME = 30.0
+INFERENCE_RESTART_MAX_DELAY = 60.0
+
+# Lu par embedding_server à l'import (dans le maître avec preload_app)
+if not shared_inference:
+    os.environ.setdefault("CPU_BUDGET", str(max(1, cores // workers)))
+
+
+def spawn_inference():
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, CPU_BUDGET=os.getenv("CPU_BUDGET", str(cores)))
+    return subprocess.Popen([sys.executable, os.path.join(here, "embedding_ipc.py"), "serve"], cwd=here, env=env)
+
+
+def supervise_inference(server):
+    # poll() plutôt que wait() : l'arbitre de gunicorn récolte aussi ses enfants
+    # (waitpid(-1)) ; poll() voit alors ECHILD et considère le processus terminé
+    global inference_process
+    delay = 1.0
+    started = time.monotonic()
+    while not inference_stopping.wait(1.0):
+        if inference_process.poll() is None:
+            continue
+        uptime = time.monotonic() - started
+        delay = 1.0 if uptime >= INFERENCE_RESTART_MIN_UPTIME else min(delay * 2, INFERENCE_RESTART_MAX_DELAY)
+        server.log.error("Inference process (pid %s) exited after %.0fs, restarting in %.0fs",
+                         inference_process.pid, uptime, delay)
+        if inference_stopping.wait(delay):
+            return
+        inference_process = spawn_inference()
+        started = time.monotonic()
+        server.log.info("Restarted inference process (pid %s)", inference_process.pid)
+
+
+def on_starting(server):
+    global inference_process
+    if shared_inference:
+        inference_process = spawn_inference()
+        server.log.info("Started inference process (pid %s)", inference_process.pid)
+        threading.Thread(target=supervise_inference, args=(server,), name="inference-supervisor", daemon=True).start()
+
+
+def when_ready(server):
+    # Application chargée dans le maître : on fige les objets existants pour
+    # que les collectes des workers ne touchent plus à leurs en-têtes
+    if preload_app:
+        gc.collect()
+        gc.freeze()
+
+
+def on_exit(server):
+    inference_stopping.set()
+    if inference_process is not None and inference_process.poll() is None:
+        inference_process.terminate()
+        try:
+            inference_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            inference_process.kill()
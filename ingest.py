@@ -0,0 +1,288 @@
+# ingest.py
+"""
+Ingestion en masse : flux NDJSON/CSV de (id, text, metadata) -> embeddings
+-> COPY binaire dans la table pgvector.
+
+Côté serveur, ingest_records() lit les enregistrements au fil de l'eau, les
+encode par lots de taille fixe et écrit chaque lot avec un seul COPY (FORMAT
+BINARY) ; la mémoire reste bornée par la taille d'un lot quelle que soit la
+taille du flux.
+
+En ligne de commande, le script envoie un fichier (ou stdin) à POST /ingest
+en transfert chunked :
+
+    python ingest.py corpus.ndjson --url http://127.0.0.1:10000
+    python ingest.py corpus.csv --format csv
+"""
+
+import argparse
+import csv
+import json
+import logging
+import struct
+import sys
+import time
+import urllib.request
+
+import numpy as np
+from psycopg import sql
+
+from vector_store import qualified
+
+logger = logging.getLogger(__name__)
+
+# En-tête et fin de flux du format COPY binaire de PostgreSQL
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+
+
+class IngestError(ValueError):
+    """Enregistrement invalide dans le flux ; stats décrit ce qui a déjà été écrit."""
+
+    def __init__(self, message, stats=None):
+        super().__init__(message)
+        self.stats = stats or {}
+
+
+async def iter_lines(chunks):
+    """Découpe un flux asynchrone d'octets en lignes (sans le saut de ligne)."""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8")
+    if pending:
+        yield pending.rstrip(b"\r").decode("utf-8")
+
+
+def make_record(raw, position):
+    if not isinstance(raw, dict):
+        raise IngestError(f"Record {position}: expected an object")
+    if raw.get("id") in (None, ""):
+        raise IngestError(f"Record {position}: missing id")
+    text = raw.get("text")
+    if not isinstance(text, str):
+        raise IngestError(f"Record {position}: missing text")
+    metadata = raw.get("metadata")
+    if isinstance(metadata, str):
+        # Colonne CSV : métadonnées encodées en JSON
+        try:
+            metadata = json.loads(metadata) if metadata.strip() else None
+        except json.JSONDecodeError as e:
+            raise IngestError(f"Record {position}: invalid metadata JSON: {e}")
+    return str(raw["id"]), text, metadata
+
+
+async def iter_ndjson(chunks):
+    position = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        position += 1
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise IngestError(f"Record {position}: invalid JSON: {e}")
+        yield make_record(raw, position)
+
+
+async def iter_csv(chunks):
+    """CSV avec en-tête (id, text[, metadata]) ; les champs entre guillemets
+    peuvent contenir des sauts de ligne."""
+    header = None
+    position = 0
+    record = []
+    async for line in iter_lines(chunks):
+        record.append(line)
+        joined = "\n".join(record)
+        # Nombre impair de guillemets : le champ se poursuit sur la ligne suivante
+        if joined.count('"') % 2:
+            continue
+        record = []
+        if not joined.strip():
+            continue
+        row = next(csv.reader([joined]))
+        if header is None:
+            header = [name.strip() for name in row]
+            if "id" not in header or "text" not in header:
+                raise IngestError("CSV header must contain id and text columns")
+            continue
+        position += 1
+        yield make_record(dict(zip(header, row)), position)
+    if record:
+        raise IngestError(f"Record {position + 1}: unterminated quoted field")
+
+
+def iter_records(chunks, fmt):
+    if fmt == "csv":
+        return iter_csv(chunks)
+    if fmt == "ndjson":
+        return iter_ndjson(chunks)
+    raise IngestError(f"Unknown format: {fmt}")
+
+
+def encode_copy_binary(ids, vectors, metadata):
+    """Construit le flux COPY binaire (id text, embedding vector, metadata jsonb)."""
+    vectors = np.ascontiguousarray(vectors, dtype=">f4")
+    dims = vectors.shape[1]
+    # Champ vector (format de réception pgvector) : int16 dim, int16 inutilisé, float4[]
+    vector_prefix = struct.pack(">ihh", 4 + 4 * dims, dims, 0)
+    out = bytearray(PGCOPY_SIGNATURE)
+    for row_id, vector, meta in zip(ids, vectors, metadata):
+        encoded_id = row_id.encode("utf-8")
+        out += struct.pack(">hi", 3, len(encoded_id))
+        out += encoded_id
+        out += vector_prefix
+        out += vector.tobytes()
+        if meta is None:
+            out += struct.pack(">i", -1)
+        else:
+            # jsonb binaire : octet de version (1) suivi du texte JSON
+            encoded_meta = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+            out += struct.pack(">ib", len(encoded_meta) + 1, 1)
+            out += encoded_meta
+    out += PGCOPY_TRAILER
+    return bytes(out)
+
+
+class PgVectorCopyWriter:
+    """Écrit des lots d'embeddings par COPY binaire, directement ou via une
+    table temporaire fusionnée par INSERT ... ON CONFLICT (upsert)."""
+
+    def __init__(self, conn, table, upsert=True):
+        self.conn = conn
+        self.table = qualified(table)
+        # Table temporaire (schéma pg_temp) : nom sans le préfixe de schéma
+        self.stage = sql.Identifier(f"{table.rpartition('.')[2]}_ingest_stage")
+        self.upsert = upsert
+
+    async def prepare(self):
+        if self.upsert:
+            await self.conn.execute(
+                sql.SQL(
+                    "CREATE TEMP TABLE IF NOT EXISTS {} "
+                    "(id text, embedding vector, metadata jsonb) ON COMMIT DELETE ROWS"
+                ).format(self.stage)
+            )
+
+    async def write(self, ids, vectors, metadata):
+        payload = encode_copy_binary(ids, vectors, metadata)
+        target = self.stage if self.upsert else self.table
+        async with self.conn.transaction():
+            async with self.conn.cursor() as cur:
+                async with cur.copy(
+                    sql.SQL("COPY {} (id, embedding, metadata) FROM STDIN (FORMAT BINARY)").format(target)
+                ) as copy:
+                    await copy.write(payload)
+                if self.upsert:
+                    # DISTINCT ON : un id répété dans le lot ne garde que sa dernière occurrence
+                    await cur.execute(
+                        sql.SQL(
+                            "INSERT INTO {table} (id, embedding, metadata) "
+                            "SELECT DISTINCT ON (id) id, embedding, metadata FROM {stage} ORDER BY id, ctid DESC "
+                            "ON CONFLICT (id) DO UPDATE SET embedding = EXCLUDED.embedding, "
+                            "metadata = EXCLUDED.metadata, updated_at = now()"
+                        ).format(table=self.table, stage=self.stage)
+                    )
+
+
+async def ingest_records(records, encode_fn, connection_factory, table, batch_size=256,
+                         upsert=True, progress_interval=10.0):
+    """Encode et écrit les enregistrements par lots ; renvoie les statistiques.
+
+    encode_fn est une coroutine (liste de textes -> matrice d'embeddings).
+    """
+    started = time.monotonic()
+    stats = {"rows": 0, "batches": 0}
+    last_report = started
+
+    def snapshot():
+        elapsed = time.monotonic() - started
+        return dict(
+            stats,
+            seconds=round(elapsed, 3),
+            rows_per_sec=round(stats["rows"] / elapsed, 1) if elapsed > 0 else 0.0,
+        )
+
+    async with connection_factory() as conn:
+        writer = PgVectorCopyWriter(conn, table, upsert=upsert)
+        await writer.prepare()
+        batch = []
+
+        async def flush():
+            ids, texts, metadata = zip(*batch)
+            vectors = await encode_fn(list(texts))
+            await writer.write(ids, vectors, metadata)
+            stats["rows"] += len(batch)
+            stats["batches"] += 1
+            batch.clear()
+
+        try:
+            async for record in records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    await flush()
+                    if time.monotonic() - last_report >= progress_interval:
+                        last_report = time.monotonic()
+                        logger.info("Ingest into %s: %s", table, snapshot())
+            if batch:
+                await flush()
+        except IngestError as e:
+            e.stats = snapshot()
+            raise
+    result = snapshot()
+    logger.info("Ingest into %s finished: %s", table, result)
+    return result
+
+
+def iter_file_chunks(stream, chunk_size, progress):
+    sent = 0
+    started = time.monotonic()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        sent += len(chunk)
+        if progress:
+            elapsed = max(time.monotonic() - started, 1e-9)
+            print(f"\rsent {sent / 1e6:.1f} MB ({sent / 1e6 / elapsed:.1f} MB/s)", end="", file=sys.stderr)
+        yield chunk
+    if progress:
+        print(file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a NDJSON/CSV corpus to POST /ingest")
+    parser.add_argument("path", help="input file, or - for stdin")
+    parser.add_argument("--url", default="http://127.0.0.1:10000")
+    parser.add_argument("--format", choices=("ndjson", "csv"), default=None)
+    parser.add_argument("--on-conflict", choices=("update", "error"), default="update")
+    parser.add_argument("--chunk-size", type=int, default=1 << 20)
+    parser.add_argument("--timeout", type=float, default=3600.0)
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    stream = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+    url = f"{args.url.rstrip('/')}/ingest?format={fmt}&on_conflict={args.on_conflict}"
+    content_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    # Corps itérable sans Content-Length : urllib l'envoie en Transfer-Encoding chunked
+    req = urllib.request.Request(
+        url,
+        data=iter_file_chunks(stream, args.chunk_size, not args.quiet),
+        headers={"Content-Type": content_type},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=args.timeout) as resp:
+            result = json.loads(resp.read())
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# mem_report.py
+"""
+Rapport mémoire des workers gunicorn (Linux, /proc/<pid>/smaps_rollup).
+
+Pour chaque processus : RSS, PSS (part proportionnelle des pages
+partagées), mémoire unique (Private_Clean + Private_Dirty) et partagée.
+La mémoire unique par worker est l'indicateur à comparer avant / après
+le préchargement du modèle :
+
+    python mem_report.py --pid <pid du maître gunicorn>
+"""
+
+import argparse
+import json
+import os
+
+
+def read_rollup(pid):
+    """Compteurs de /proc/<pid>/smaps_rollup, en kB."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                values[parts[0][:-1]] = int(parts[1])
+    return values
+
+
+def children(pid):
+    found = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                found.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return sorted(set(found))
+
+
+def process_report(pid):
+    rollup = read_rollup(pid)
+    unique = rollup.get("Private_Clean", 0) + rollup.get("Private_Dirty", 0)
+    return {
+        "pid": pid,
+        "rss_mb": round(rollup.get("Rss", 0) / 1024, 1),
+        "pss_mb": round(rollup.get("Pss", 0) / 1024, 1),
+        "unique_mb": round(unique / 1024, 1),
+        "shared_mb": round((rollup.get("Shared_Clean", 0) + rollup.get("Shared_Dirty", 0)) / 1024, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-worker unique/shared memory of a gunicorn master")
+    parser.add_argument("--pid", type=int, required=True, help="gunicorn master pid")
+    args = parser.parse_args(argv)
+
+    workers = [process_report(pid) for pid in children(args.pid)]
+    report = {
+        "master": process_report(args.pid),
+        "workers": workers,
+        "workers_unique_mb": round(sum(w["unique_mb"] for w in workers), 1),
+        "total_pss_mb": round(sum(w["pss_mb"] for w in workers) + process_report(args.pid)["pss_mb"], 1),
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# vector_store.py
+"""
+Stockage et recherche k-NN des embeddings dans PostgreSQL avec pgvector.
+
+PgVectorStore gère la table (id, embedding vector(dims), metadata jsonb),
+la création des index ANN (HNSW ou IVFFlat) et les requêtes k plus proches
+voisins avec réglage par requête de hnsw.ef_search / ivfflat.probes.
+"""
+
+import math
+import struct
+
+import numpy as np
+from psycopg import sql
+from psycopg.rows import dict_row
+
+# Opérateur de distance et classe d'opérateurs pgvector par métrique
+METRICS = {
+    "cosine": ("<=>", "vector_cosine_ops"),
+    "l2": ("<->", "vector_l2_ops"),
+    "ip": ("<#>", "vector_ip_ops"),
+}
+INDEX_KINDS = ("hnsw", "ivfflat")
+
+
+def qualified(name):
+    """Identifiant SQL d'une table, éventuellement préfixée par son schéma."""
+    return sql.Identifier(*name.split("."))
+
+
+def to_pgvector(vector):
+    """Représentation texte d'un vecteur pour un paramètre %s::vector."""
+    return "[" + ",".join(format(float(x), ".9g") for x in np.asarray(vector).ravel()) + "]"
+
+
+def from_pgvector(text):
+    """Vecteur numpy depuis la représentation texte '[x1,x2,...]' de pgvector."""
+    return np.array(text.strip("[]").split(","), dtype=np.float32)
+
+
+def decode_vectors(blobs):
+    """Matrice float32 depuis des vecteurs pgvector au format binaire (int16 dim, int16, float4[])."""
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    dims = struct.unpack_from(">h", blobs[0])[0]
+    data = b"".join(memoryview(blob)[4:] for blob in blobs)
+    return np.frombuffer(data, dtype=">f4").reshape(len(blobs), dims).astype(np.float32)
+
+
+class PgVectorStore:
+    """Table pgvector et index ANN associés."""
+
+    def __init__(self, connection_factory, table, dims):
+        # connection_factory() renvoie un context manager asynchrone
+        # (db_pool.connection) fournissant une connexion en autocommit
+        self.connection_factory = connection_factory
+        self.table_name = table
+        self.schema, _, self.relname = table.rpartition(".")
+        self.table = qualified(table)
+        # dims peut n'être connu qu'au démarrage (processus d'inférence partagé)
+        self.dims = dims
+
+    def index_name(self, kind, metric):
+        # Un index est toujours créé dans le schéma de sa table
+        return f"{self.relname}_embedding_{kind}_{metric}_idx"
+
+    async def ensure_schema(self):
+        async with self.connection_factory() as conn:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            await conn.execute(
+                sql.SQL(
+                    """
+                    CREATE TABLE IF NOT EXISTS {} (
+                        id text PRIMARY KEY,
+                        embedding vector({}) NOT NULL,
+                        metadata jsonb,
+                        updated_at timestamptz NOT NULL DEFAULT now()
+                    )
+                    """
+                ).format(self.table, sql.Literal(int(self.dims)))
+            )
+
+    async def sample_vectors(self, limit):
+        """Échantillon aléatoire (au plus limit lignes) des vecteurs stockés.
+
+        TABLESAMPLE SYSTEM lit une fraction des pages au lieu de trier toute
+        la table ; la fraction vient de l'estimation du planificateur
+        (reltuples), avec une marge, et est élargie si l'échantillon est court.
+        """
+        limit = int(limit)
+        async with self.connection_factory() as conn:
+            cur = await conn.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", (self.table_name,))
+            row = await cur.fetchone()
+            estimated = row[0] if row else 0
+            # reltuples vaut -1 (ou 0) tant que la table n'a pas été analysée
+            percent = 100.0 if estimated <= 0 else min(100.0, 200.0 * limit / estimated)
+            async with conn.cursor(binary=True) as cur:
+                while True:
+                    await cur.execute(
+                        sql.SQL(
+                            "SELECT embedding FROM {} TABLESAMPLE SYSTEM (%s) ORDER BY random() LIMIT %s"
+                        ).format(self.table),
+                        (percent, limit),
+                    )
+                    rows = await cur.fetchall()
+                    if len(rows) >= limit or percent >= 100.0:
+                        break
+                    percent = min(100.0, percent * 4)
+        return decode_vectors([row[0] for row in rows])
+
+    async def count(self):
+        async with self.connection_factory() as conn:
+            cur = await conn.execute(sql.SQL("SELECT count(*) FROM {}").format(self.table))
+            return (await cur.fetchone())[0]
+
+    async def create_index(self, kind="hnsw", metric="cosine", m=16, ef_construction=64,
+                           lists=None, concurrently=False):
+        """Crée (si absent) un index HNSW ou IVFFlat ; renvoie son nom et ses paramètres."""
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown index kind: {kind}")
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        opclass = METRICS[metric][1]
+        if kind == "hnsw":
+            params = {"m": int(m), "ef_construction": int(ef_construction)}
+        else:
+            if not lists:
+                # Recommandation pgvector : lignes / 1000 jusqu'à 1M, puis racine carrée
+                rows = await self.count()
+                lists = rows // 1000 if rows <= 1_000_000 else int(math.sqrt(rows))
+            params = {"lists": max(1, int(lists))}
+        name = self.index_name(kind, metric)
+        query = sql.SQL("CREATE INDEX {} IF NOT EXISTS {} ON {} USING {} (embedding {}) WITH ({})").format(
+            sql.SQL("CONCURRENTLY") if concurrently else sql.SQL(""),
+            sql.Identifier(name),
+            self.table,
+            sql.SQL(kind),
+            sql.SQL(opclass),
+            sql.SQL(", ").join(
+                sql.SQL("{} = {}").format(sql.SQL(key), sql.Literal(value)) for key, value in params.items()
+            ),
+        )
+        async with self.connection_factory() as conn:
+            await conn.execute(query)
+        return {"name": name, "kind": kind, "metric": metric, "params": params}
+
+    async def list_indexes(self):
+        async with self.connection_factory() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(
+                    "SELECT indexname AS name, indexdef AS definition FROM pg_indexes "
+                    "WHERE schemaname = coalesce(%s, current_schema()) AND tablename = %s",
+                    (self.schema or None, self.relname),
+                )
+                return await cur.fetchall()
+
+    async def drop_index(self, kind, metric):
+        async with self.connection_factory() as conn:
+            await conn.execute(
+                sql.SQL("DROP INDEX IF EXISTS {}").format(
+                    sql.Identifier(*filter(None, (self.schema, self.index_name(kind, metric))))
+                )
+            )
+
+    async def search(self, vector, k=10, metric="cosine", ef_search=None, probes=None,
+                     include_metadata=True):
+        """k plus proches voisins ; ef_search / probes ne valent que pour cette requête."""
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        operator = sql.SQL(METRICS[metric][0])
+        query = sql.SQL(
+            "SELECT id, embedding {op} %(q)s::vector AS distance{meta} FROM {table} "
+            "ORDER BY embedding {op} %(q)s::vector LIMIT %(k)s"
+        ).format(
+            op=operator,
+            meta=sql.SQL(", metadata") if include_metadata else sql.SQL(""),
+            table=self.table,
+        )
+        async with self.connection_factory() as conn:
+            # SET LOCAL (via set_config) limité à la transaction de cette recherche
+            async with conn.transaction():
+                if ef_search is not None:
+                    await conn.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(int(ef_search)),))
+                if probes is not None:
+                    await conn.execute("SELECT set_config('ivfflat.probes', %s, true)", (str(int(probes)),))
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute(query, {"q": to_pgvector(vector), "k": int(k)})
+                    rows = await cur.fetchall()
+        # Avec <#>, pgvector renvoie le produit scalaire négatif
+        return [dict(row, distance=float(row["distance"])) for row in rows]